@@ -362,6 +362,10 @@ if RTWindow != 0.8:
 ScriptNote = open(os.path.join(Drive,'Compound Reports',NewFolderName,'NOTE - Generated results with script ' + Current_Script_Version + ' updated ' + Update_Date +'.txt'),'w')
 ScriptNote.close()
 shutil.copy(ScriptFileName,os.path.join(Drive,'Compound Reports',NewFolderName,ScriptFileName.split('\\')[-1]))
+# Keep the MIDA run settings next to the script, so exact MIDA predictions use
+# the chemical data the MIDA database was generated with
+if os.path.exists(os.path.join(src,'run_data.py')):
+    shutil.copy(os.path.join(src,'run_data.py'),os.path.join(Drive,'Compound Reports',NewFolderName,'run_data.py'))
 
 print "CREATING PARAMETERS TEMPLATE..."
 # Create parameters template file
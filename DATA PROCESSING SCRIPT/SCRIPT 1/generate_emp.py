@@ -35,8 +35,9 @@ import scipy.optimize
 from scipy.stats import pearsonr
 
 # mida
-from mida.analysis import convert_p_to_abundances, renormalize
+from mida.analysis import convert_p_to_abundances, renormalize_distributions
 from mida import Peptide
+from mida.utils import kernels
 
 # local
 from run_data import chemical_data, enriched_aa_abundances, enriched_aa_fractions
@@ -68,6 +69,9 @@ parser.add_argument("-f", default="cubic",
 parser.add_argument("-s", default=0,
                     dest="sequence_format", type=int,
                     help="Expects integer. '0' for normal, '1' for (a)sequence(b)")
+parser.add_argument("-b", default=kernels.get_backend(),
+                    dest="backend", type=str,
+                    help="Expects the kernel backend name. 'numpy', 'jit' or 'parity' (runs both and checks they agree)")
 
 args = parser.parse_args()
 
@@ -79,6 +83,8 @@ if args.fit != "quad" and args.fit != "cubic":
 if args.sequence_format != 0 and args.sequence_format != 1:
     raise Exception("Sequence format error. The only formats are '0' and '1', got %i." % arg.sequence_format)
 
+kernels.set_backend(args.backend)
+
 ###
 # Define the fields we will add.
 ###
@@ -134,6 +140,7 @@ fields_string = fields_string[:-2]
 
 print "Using the sequences in '%s', in format %i." % (args.infile.name, args.sequence_format)
 print "Performing %s fits to %s." % (args.fit, ems_string)
+print "Using the %s kernel backend." % kernels.get_backend()
 print ""
 print "Adding the columns:"
 print fields_string
@@ -166,7 +173,6 @@ print "Generating EM(p) and computing fits for:"
 # the enrichment resolution
 num_ps = 50
 p_array = np.linspace(0.0, 0.05, num=num_ps)
-exp_abundances = np.zeros((len(p_array), 5))
 
 h_abundances = convert_p_to_abundances(p_array, chemical_data.natural_abundances[0])
 
@@ -217,20 +223,14 @@ for row in reader:
                      en_aa_abundances=enriched_aa_abundances,
                      en_aa_fraction=enriched_aa_fractions, mass_cutoff=4)
 
-    # experimentally renormalize and add to the list
-    for i in xrange(len(abundances)):
-        exp_abundances[i] = renormalize(peptide, abundances[i])
+    # experimentally renormalize every enrichment at once
+    exp_abundances = renormalize_distributions(peptide, abundances)
 
     ###
     # Generate the EM(p) data
     ###
     # 0-th element is the distribution at p=0 (natural abundances)
-    ems_array = np.zeros((5, num_ps))
-    ems_array[0] = exp_abundances[:, 0] - exp_abundances[0, 0]
-    ems_array[1] = exp_abundances[:, 1] - exp_abundances[0, 1]
-    ems_array[2] = exp_abundances[:, 2] - exp_abundances[0, 2]
-    ems_array[3] = exp_abundances[:, 3] - exp_abundances[0, 3]
-    ems_array[4] = exp_abundances[:, 4] - exp_abundances[0, 4]
+    ems_array = (exp_abundances - exp_abundances[0]).T
 
     ###
     # Create the list that we will write
@@ -27,6 +27,10 @@ the DEFAULT value of 0.04 (or any of the weird stringency values).
 On 12/12/16 Kelvin Li added the hidden ability to use "HUMAN25" in the minimum MIDA
 setting in the Parameters Template File to set the minimum EMX at 0.025 instead of
 the DEFAULT value of 0.04 (or any of the weird stringency values).
+
+Every stage saves a checkpoint in the 'Checkpoints' folder. If the script stops
+partway, run it again with --resume to skip the stages that already finished
+for the same input files.
     
 """
 
@@ -34,6 +38,7 @@ the DEFAULT value of 0.04 (or any of the weird stringency values).
 from __future__ import division
 import __main__
 from xlrd import open_workbook,xldate_as_tuple
+from xlrd import XL_CELL_EMPTY,XL_CELL_TEXT,XL_CELL_NUMBER,XL_CELL_DATE,XL_CELL_BOOLEAN,XL_CELL_ERROR,XL_CELL_BLANK
 from openpyxl import load_workbook
 import pandas as pd
 import itertools
@@ -44,9 +49,31 @@ import os
 from datetime import date,datetime
 import time
 import shutil
+import hashlib
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import threading
+import Queue
+import sys
+import re
+import ast
+import ctypes
 #import win32com.client as win32
 import urllib
 
+# MIDA is only needed for exact MIDA predictions. The chemical data come from
+# the run_data.py settings that generated the MIDA database when they are next
+# to the script, like in generate_emp.py, so both use the same abundances.
+try:
+    from mida import Molecule, get_distributions, chemical_data, labile_dtype, composition_dtype
+    from mida.analysis import convert_p_to_abundances, renormalize_distributions
+    try:
+        from run_data import chemical_data, enriched_aa_abundances
+    except ImportError:
+        enriched_aa_abundances = None
+except ImportError:
+    Molecule = None
+
 # Sort Compound Report files
 def sortFiles(inString):
     sortKey = inString[0][-5:]+inString[0][0:inString[0].find('-')]
@@ -94,6 +121,13 @@ def loadParameters(parameterFile):
     saturation = float(parametersData.row_values(21,1)[0])
     offsetSlope = [i for i in parametersData.row_values(22,1) if i != '']
     offsetIntercept = [i for i in parametersData.row_values(23,1) if i != '']
+    # Optional rows after the offset correction, found by their label
+    optionalRows = dict((str(parametersData.row_values(i,0)[0]).strip(),parametersData.row_values(i,1)) for i in xrange(24,parametersData.nrows))
+    if 'M Difference Mass Bins' in optionalRows:
+        massBins_input = [float(i) for i in optionalRows['M Difference Mass Bins'] if i != '']
+    else:
+        massBins_input = defaultMassBins
+    midaPredictions_input = 'Exact' if str(optionalRows.get('MIDA Predictions',['Cubic'])[0]).strip().upper() == 'EXACT' else 'Cubic'
     
     wb.unload_sheet('Parameters')
 
@@ -159,13 +193,51 @@ def loadParameters(parameterFile):
     elif minMIDA_input.upper() == 'HUMAN25':
         minMIDA = [0.025]*len(sortedBW)
     
-    return sortedSampled, sortedBW, rtDiff_input, totalAbund_input, mDiffCriteria_input, silacMasses_input, rmsError_input,dbScore_input,basePkAbund_input,em0Upper_input,em0Lower_input,peptideSD_input,isotopomerSD_input,useAllIsotopomers_input, combinePeptides_input,instrument, projectLeader, processedBy, submitDate, projectCode, notebookCode, tissueFluid, prep, minMIDA, upperSILAC, lowerSILAC, silacSD, fractions,minMIDA_input, saturation, offsetSlope, offsetIntercept
+    return sortedSampled, sortedBW, rtDiff_input, totalAbund_input, mDiffCriteria_input, silacMasses_input, rmsError_input,dbScore_input,basePkAbund_input,em0Upper_input,em0Lower_input,peptideSD_input,isotopomerSD_input,useAllIsotopomers_input, combinePeptides_input,instrument, projectLeader, processedBy, submitDate, projectCode, notebookCode, tissueFluid, prep, minMIDA, upperSILAC, lowerSILAC, silacSD, fractions,minMIDA_input, saturation, offsetSlope, offsetIntercept, massBins_input, midaPredictions_input
+
+# Columnar cache of parsed Compound Reports, kept next to the reports. Bump
+# the version whenever the parsed columns change.
+reportCacheFolder = 'CompoundReportCache'
+reportCacheVersion = 4
+
+# Cell text read as missing, as in pd.read_excel
+reportNAValues = set(['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN', 'N/A', 'NA', 'NULL', 'NaN', 'n/a', 'nan'])
+
+# Convert one column of Compound Report cells to a series, typed the way
+# pd.read_excel would type it
+def convertReportColumn(values, types, datemode):
+    column = []
+    for value, cellType in zip(values, types):
+        if cellType in (XL_CELL_EMPTY, XL_CELL_BLANK, XL_CELL_ERROR) or (cellType == XL_CELL_TEXT and value.strip() in reportNAValues):
+            column.append(np.nan)
+        elif cellType == XL_CELL_NUMBER:
+            column.append(int(value) if value == int(value) else value)
+        elif cellType == XL_CELL_DATE:
+            column.append(datetime(*xldate_as_tuple(value, datemode)))
+        elif cellType == XL_CELL_BOOLEAN:
+            column.append(bool(value))
+        else:
+            column.append(value)
+    column = pd.Series(column)
+    
+    # Text columns that only hold numbers are read as numbers
+    if column.dtype == object:
+        notNull = column[pd.notnull(column)]
+        try:
+            numbers = np.asarray([float(i) for i in notNull.values])
+        except (TypeError, ValueError):
+            return column
+        if len(numbers) > 0 and len(notNull) == len(column) and (numbers == np.round(numbers)).all():
+            column = pd.Series(numbers.astype(np.int64))
+        else:
+            column = pd.Series(np.nan, index=column.index)
+            column[notNull.index] = numbers
+    return column
 
-# Import individual Compound Report file and extract information
-def importCompoundReport(fileName):
+# Parse individual Compound Report file in a single pass over the sheet
+def readCompoundReport(fileName):
     wb = open_workbook(fileName,on_demand=True)
     sheet = wb.sheet_by_index(0)
-    sheetName = wb.sheet_names()[0]
     
     fileDate = str(sheet.row_values(7,0)[3])[0:str(sheet.row_values(7,0)[3]).find(' ')]
     
@@ -173,59 +245,183 @@ def importCompoundReport(fileName):
         if str(sheet.row_values(row,0)[0])=='MS Spectral Peaks':
             startRow = row
             break
-            
-    wb.release_resources()        
-
-    compoundData = pd.read_excel(fileName,sheetname=sheetName,skiprows=startRow+1,skip_footer=1)
-    compoundData = compoundData[compoundData['Acc#+Name']!='Acc#+Name']
-    del compoundData['ppm']
-    del compoundData['Formula']
     
+    # Header is the row after 'MS Spectral Peaks', and the last row is a footer
+    headerRow = startRow+1
+    endRow = sheet.nrows-1
+    headers = [unicode(i) for i in sheet.row_values(headerRow)]
+    for i in xrange(len(headers)):
+        if headers[i] == '':
+            headers[i] = 'Unnamed: '+str(i)
+        elif headers[i] in headers[0:i]:
+            headers[i] = headers[i]+'.'+str(headers[0:i].count(headers[i]))
+    
+    # Drop the header rows repeated inside the table, and empty rows
+    accColumn = headers.index('Acc#+Name')
+    keepRows = [i for i in xrange(headerRow+1,endRow) if sheet.cell_value(i,accColumn)!='Acc#+Name' and any(t not in (XL_CELL_EMPTY, XL_CELL_BLANK) for t in sheet.row_types(i,0,len(headers)))]
+    
+    compoundData = OrderedDict()
+    for j in xrange(len(headers)):
+        if headers[j] in ('ppm','Formula'):
+            continue
+        values = sheet.col_values(j,headerRow+1,endRow)
+        types = sheet.col_types(j,headerRow+1,endRow)
+        keepValues = [values[i-headerRow-1] for i in keepRows]
+        keepTypes = [types[i-headerRow-1] for i in keepRows]
+        compoundData[headers[j]] = convertReportColumn(keepValues, keepTypes, wb.datemode)
+    
+    wb.release_resources()
+    
+    compoundData = pd.DataFrame(compoundData, columns=compoundData.keys())
     return compoundData, fileDate
 
-# Extract accession number from compound report data
-def getAccession(inputString):
-    return str(inputString.split('+')[0])
+# Get the sidecar cache file for a Compound Report, and the key that must
+# match for the cache to be valid
+def getReportCache(fileName):
+    fullName = os.path.abspath(fileName)
+    fileStat = os.stat(fullName)
+    cacheKey = np.array([fullName, str(fileStat.st_size), repr(fileStat.st_mtime), str(reportCacheVersion)])
+    cacheName = hashlib.sha1(fullName.encode('utf-8') if isinstance(fullName, unicode) else fullName).hexdigest()+'.npz'
+    return os.path.join(os.path.dirname(fullName), reportCacheFolder, cacheName), cacheKey
+
+# Store the columns and index of a table in arrays for np.savez, under keys
+# starting with prefix. Text columns are stored as a text array plus a number
+# array, and categorical columns as their codes, so no pickling is needed.
+def packColumns(table, arrays, prefix=''):
+    arrays[prefix+'columns'] = np.array([unicode(i) for i in table.columns], dtype=np.unicode_)
+    arrays[prefix+'index'] = np.asarray(table.index.values)
+    for i in xrange(len(table.columns)):
+        column = table.iloc[:,i]
+        if str(column.dtype) == 'category':
+            arrays[prefix+'codes%i' % i] = np.asarray(column.cat.codes)
+            arrays[prefix+'categories%i' % i] = np.array([unicode(v) for v in column.cat.categories], dtype=np.unicode_)
+        elif column.dtype != object:
+            arrays[prefix+'values%i' % i] = column.values
+        else:
+            isText = np.array([isinstance(v, basestring) for v in column.values], dtype=bool)
+            arrays[prefix+'text%i' % i] = np.array([unicode(v) if t else u'' for v, t in zip(column.values, isText)], dtype=np.unicode_)
+            arrays[prefix+'isText%i' % i] = isText
+            arrays[prefix+'isInteger%i' % i] = np.array([isinstance(v, (int, long, np.integer)) for v in column.values], dtype=bool)
+            arrays[prefix+'numbers%i' % i] = np.array([np.nan if t else float(v) for v, t in zip(column.values, isText)], dtype=float)
+
+# Rebuild a table stored by packColumns
+def unpackColumns(cache, prefix=''):
+    table = OrderedDict()
+    for i, name in enumerate(cache[prefix+'columns']):
+        if prefix+'codes%i' % i in cache.files:
+            table[name] = pd.Series(pd.Categorical.from_codes(cache[prefix+'codes%i' % i], list(cache[prefix+'categories%i' % i])))
+        elif prefix+'values%i' % i in cache.files:
+            table[name] = pd.Series(cache[prefix+'values%i' % i])
+        else:
+            isText = cache[prefix+'isText%i' % i]
+            isInteger = cache[prefix+'isInteger%i' % i]
+            text = cache[prefix+'text%i' % i]
+            numbers = cache[prefix+'numbers%i' % i]
+            table[name] = pd.Series([text[j] if isText[j] else (np.nan if np.isnan(numbers[j]) else (int(numbers[j]) if isInteger[j] else numbers[j])) for j in xrange(len(isText))], dtype=object)
+    table = pd.DataFrame(table, columns=table.keys())
+    table.index = cache[prefix+'index']
+    return table
+
+# Write arrays to a cache file. The file is replaced in one step, so readers
+# never see a partly written cache.
+def writeCacheFile(cacheFile, arrays):
+    try:
+        if not os.path.exists(os.path.dirname(cacheFile)):
+            os.makedirs(os.path.dirname(cacheFile))
+        tempFile = cacheFile+'.'+str(os.getpid())+'.tmp.npz'
+        np.savez(tempFile, **arrays)
+        if os.path.exists(cacheFile):
+            os.remove(cacheFile)
+        os.rename(tempFile, cacheFile)
+    except (IOError, OSError):
+        # The cache is only an optimization. Read-only folders still work.
+        pass
+
+# Read a cache file written by writeCacheFile. Returns None if there is no
+# cache, or it was written for another key.
+def readCacheFile(cacheFile, cacheKey):
+    if not os.path.exists(cacheFile):
+        return None
+    try:
+        cache = np.load(cacheFile)
+        if cache['key'].shape != cacheKey.shape or (cache['key'] != cacheKey).any():
+            cache.close()
+            return None
+    except (IOError, OSError, KeyError, ValueError):
+        return None
+    return cache
+
+# Write parsed Compound Report columns to the sidecar cache
+def saveReportCache(fileName, compoundData, fileDate):
+    cacheFile, cacheKey = getReportCache(fileName)
+    arrays = {'key': cacheKey, 'fileDate': np.array([fileDate])}
+    packColumns(compoundData, arrays)
+    writeCacheFile(cacheFile, arrays)
+
+# Read parsed Compound Report columns back from the sidecar cache. Returns
+# None if there is no cache, or it was written for another version of the file.
+def loadReportCache(fileName):
+    cacheFile, cacheKey = getReportCache(fileName)
+    cache = readCacheFile(cacheFile, cacheKey)
+    if cache is None:
+        return None
+    try:
+        compoundData = unpackColumns(cache)
+        fileDate = str(cache['fileDate'][0])
+    except (IOError, OSError, KeyError, ValueError):
+        return None
+    finally:
+        cache.close()
+    return compoundData, fileDate
 
-# Extract protein name from compound report data    
-def getProteinName(inputString):
-    return str(inputString.split('+')[1])
+# SHA-1 of the contents of a file
+def fileContentHash(fileName):
+    digest = hashlib.sha1()
+    with open(fileName, 'rb') as contents:
+        for block in iter(lambda: contents.read(1<<20), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+# Import individual Compound Report file and extract information. The sheet
+# is parsed once, and reruns on an unchanged file read the columnar cache.
+def importCompoundReport(fileName):
+    cached = loadReportCache(fileName)
+    if cached is not None:
+        return cached
+    
+    compoundData, fileDate = readCompoundReport(fileName)
+    saveReportCache(fileName, compoundData, fileDate)
+    
+    return compoundData, fileDate
+
+# Patterns of the Compound Report identifiers, one per column. File names are
+# '<...species>_<code>_<fraction>..._D<sample>_MS...', 'Acc#+Name' is
+# '<accession>+<protein>' and 'Aastart+Sequ-Mods' is
+# '<AA start>+<sequence>-<modifications>'.
+fileNamePattern = re.compile(r'^(?=.*?_D(?P<SampleName>(?:(?!_D|_MS).)*))(?P<Prefix>[^_]*(?P<Species>[^_]))_(?P<Code>[^_]*)(?:_(?P<Fraction>[^_]*))?')
+accessionPattern = re.compile(r'^(?P<Accession>[^+]*)\+(?P<Protein>[^+]*)')
+peptidePattern = re.compile(r'^(?=(?P<AAStart>[^+]*)\+(?P<AASequence>[^+-]*))(?P<AAStartSeq>[^-]*)-(?P<Modifications>[^-]*)')
+
+# Parse a text column with a pattern of named groups. Each distinct string is
+# only parsed once: returns the code of every row and the fields of every
+# distinct string. Strings that miss one of the required groups raise a
+# ValueError.
+def extractFields(values, pattern, required=None):
+    codes, uniques = pd.factorize(np.asarray(values, dtype=object))
+    fields = pd.Series(uniques, dtype=object).str.extract(pattern)
+    if required is None:
+        required = list(fields.columns)
+    
+    unparsed = pd.isnull(fields[required]).any(axis=1).values
+    if unparsed.any():
+        raise ValueError('Could not parse '+repr(uniques[np.argmax(unparsed)])+' as '+', '.join(required))
+    if (codes < 0).any():
+        raise ValueError('Missing values where '+', '.join(required)+' are expected')
+    return codes, fields
 
 # Extract mass from compound report data    
 def getNeutralMass(inputValue):
     return round(inputValue,1)
-
-# Extract species from compound report data    
-def getSpecies(inputString):
-    return str(inputString.split('_')[0][-1])
-
-# Extract notebook code from compound report data
-def getNotebookCode(inputString):
-    return str(inputString.split('_')[1])
-
-# Extract fraction from compound report data
-def getFraction(inputString):
-    return str(inputString.split('_')[2])
-
-# Extract peptide sequence from compound report data    
-def getAASequence(inputString):
-    return str(inputString.split('+')[1].split('-')[0])
-
-# Extract full peptide sequence from compound report data
-def getAAStartSeq(inputString):
-    return str(inputString.split('-')[0])
-
-# Extract amino acid start number from compound report data
-def getAAStart(inputString):
-    return str(inputString.split('+')[0])
-    
-# Extract peptide modifications from compound report data
-def getModifications(inputString):
-    return str(inputString.split('-')[1])
-
-# Extract sample name from compound report data
-def getSampleName(inputString):
-    return inputString.split('_D')[1].split('_MS')[0]+"-"+inputString.split('_')[0]
     
 # Split data from Compound Report files
 def splitData(allData):
@@ -242,124 +438,151 @@ def splitData(allData):
 
     return newList, headerList
 
-# Parse Compound Report filenames and extract information
-def parseFileName(fileString,fractionOption):
-    speciesString = fileString[fileString.find('_')-1:fileString.find('_')]
-    codeString = fileString[fileString.find('_')+1:fileString[fileString.find('_')+1:].find('_')+fileString.find('_')+1]
-    if fractionOption == True:
-        fractionString = fileString[fileString.find(codeString)+len(codeString)+1:fileString.lower().find('_d')]
-    if fractionOption == False:
-        fractionString = ''
-
-    return speciesString, codeString, fractionString
-
-# Parse headers in Compound Report files
-def parseHeader(header,dictSample,takeFractions):
-    headerList = list(header)
-    accession = str(headerList[1][0:headerList[1].find('+')])
-    protein = str(headerList[1][headerList[1].find('+')+1:])
-    mass = headerList[2]
-    roundedNeutralMass = round(mass,1)
-    rt = headerList[3]
-    rtDiff = headerList[4]
-    fileName = str(headerList[5])
-    species, code, fraction = parseFileName(fileName,takeFractions)
-    sample = dictSample[fileName]
-    
-    fullSequence =str(headerList[6])
-    aaSequence = fullSequence[fullSequence.find('+')+1:fullSequence.find('-')]
-    aaStart = fullSequence[0:fullSequence.find('-')]
-    modifications = fullSequence[fullSequence.find('-')+1:]
-    scoreDB =  headerList[9]
-
-    return [fileName, species, code, fraction, sample, accession, protein, aaSequence, aaStart, modifications, mass, roundedNeutralMass, rt, rtDiff, scoreDB]
-
-# Calculate 'Mx' 
-def calculateMX(dataFrame):
-    massChargeList = [[dataFrame['Acc#+Name'][i],dataFrame['Mass'][i],dataFrame['z'][i]] for i in xrange(len(dataFrame))]
-    
-    splitList = [list(g) for k, g in itertools.groupby(massChargeList)]
-    mList = []
-    for i in xrange(len(splitList)):
-        for j in xrange(len(splitList[i])):
-            if splitList[i][0][0] < 2400 and j <= 4:
-                mList.append('M'+str(j))
-            elif splitList[i][0][0] >= 2400 and j <= 5:
-                mList.append('M'+str(j))
-            else:
-                mList.append('')
-
-    return mList
-
-# Calculate '%M' 
-def calculatePercentM(dataFrame):
-    mSequence1 = ['M0', 'M1', 'M2', 'M3']
-    mSequence2 = ['M0', 'M1', 'M2', 'M3','M4']
-
-    positions = [x for x in [([i,4] if dataFrame['M'][i:i+len(mSequence1)].tolist()==mSequence1 and dataFrame['Mass'][i]<2400 else ([i,5] if dataFrame['M'][i:i+len(mSequence2)].tolist()==mSequence2 and dataFrame['Mass'][i]>=2400 else ['',''])) for i in xrange(len(dataFrame['M']))] if x!=['','']]
-    percentM = [0]*len(dataFrame['M'])
-
-    for i in xrange(len(positions)):
-        if dataFrame['Mass'][positions[i][0]] < 2400:
-            abundSum = sum(dataFrame['Abund'][positions[i][0]:positions[i][0]+4].tolist())
-            percentM[positions[i][0]] = dataFrame['Abund'][positions[i][0]]/abundSum
-            percentM[positions[i][0]+1] = dataFrame['Abund'][positions[i][0]+1]/abundSum
-            percentM[positions[i][0]+2] = dataFrame['Abund'][positions[i][0]+2]/abundSum
-            percentM[positions[i][0]+3] = dataFrame['Abund'][positions[i][0]+3]/abundSum          
-        elif dataFrame['Mass'][positions[i][0]]  >= 2400:
-            abundSum = sum(dataFrame['Abund'][positions[i][0]:positions[i][0]+5].tolist())
-            percentM[positions[i][0]] = dataFrame['Abund'][positions[i][0]]/abundSum
-            percentM[positions[i][0]+1] = dataFrame['Abund'][positions[i][0]+1]/abundSum
-            percentM[positions[i][0]+2] = dataFrame['Abund'][positions[i][0]+2]/abundSum
-            percentM[positions[i][0]+3] = dataFrame['Abund'][positions[i][0]+3]/abundSum 
-            percentM[positions[i][0]+4] = dataFrame['Abund'][positions[i][0]+4]/abundSum
+# Find the runs of consecutive peaks from the same peptide ion of the same
+# data file (same 'FileName', 'Acc#+Name', 'Mass' and 'z'). Returns the run
+# number of every peak and its position within the run.
+def getPeakRuns(dataFrame):
+    newRun = np.zeros(len(dataFrame), dtype=bool)
+    newRun[0:1] = True
+    for column in ['FileName','Acc#+Name','Mass','z']:
+        values = dataFrame[column].values
+        newRun[1:] |= values[1:] != values[:-1]
+    runNumber = np.cumsum(newRun)-1
+    runPosition = dataFrame.groupby(runNumber).cumcount().values
+    return runNumber, runPosition
+
+# Index of the isotope clusters in a peak table: M0 to M3 for peptides under
+# 2400 amu, and M0 to M4 from 2400 amu. It is built once by convertReport and
+# shared by the %M, M Ratio and warning calculations, which reduce over all of
+# the clusters at once.
+class IsotopeClusters(object):
+    
+    def __init__(self, members, sizes, roundedMass, sampleId, samples, numRows):
+        # Rows of every cluster, M0 first, one cluster after another
+        self.members = members
+        self.sizes = sizes
+        self.offsets = np.cumsum(sizes)-sizes
+        self.roundedMass = roundedMass
+        # Sample of every cluster, as positions in samples
+        self.sampleId = sampleId
+        self.samples = samples
+        self.numRows = numRows
+    
+    # Build the index from the runs of peaks found by getPeakRuns
+    @classmethod
+    def fromPeaks(cls, dataFrame, runPosition):
+        runStarts = np.flatnonzero(runPosition == 0)
+        runLengths = np.diff(np.append(runStarts, len(dataFrame)))
+        startMass = dataFrame['Mass'].values[runStarts].astype(float)
+        
+        clusterSize = np.zeros(len(runStarts), dtype=int)
+        clusterSize[startMass < 2400] = 4
+        clusterSize[startMass >= 2400] = 5
+        isCluster = (clusterSize > 0) & (runLengths >= clusterSize)
+        starts = runStarts[isCluster]
+        sizes = clusterSize[isCluster]
+        
+        members = np.repeat(starts, sizes) + (np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes)-sizes, sizes))
+        roundedMass = np.array([round(i,1) for i in startMass[isCluster]])
+        sampleId, samples = pd.factorize(dataFrame['Sample'].values[starts])
+        
+        return cls(members, sizes, roundedMass, sampleId, samples, len(dataFrame))
+    
+    def __len__(self):
+        return len(self.sizes)
+    
+    # Rows of the k-th isotopomer of every cluster that has one
+    def isotopomerRows(self, k):
+        return self.members[self.offsets[self.sizes > k] + k]
+    
+    # Reduce the values of every cluster with a ufunc, like ufunc.reduceat.
+    # The isotopomers are combined strictly in peak order, so sums match a
+    # running sum exactly. Skip the first isotopomers with skip.
+    def reduce(self, ufunc, values, skip=0):
+        values = np.asarray(values)
+        result = values[self.isotopomerRows(skip)].astype(float)
+        for k in xrange(skip+1, self.sizes.max() if len(self) > 0 else 0):
+            hasK = self.sizes[self.sizes > skip] > k
+            result[hasK] = ufunc(result[hasK], values[self.isotopomerRows(k)])
+        return result
+    
+    # Spread one value per cluster to the rows of the peak table. Rows outside
+    # the clusters get fill.
+    def toRows(self, values, fill):
+        rowValues = np.empty(self.numRows, dtype=np.asarray(values).dtype)
+        rowValues[:] = fill
+        rowValues[self.members] = np.repeat(values, self.sizes)
+        return rowValues
+
+# Calculate 'Mx'. Every run of peaks is labelled M0 up to M5.
+def calculateMX(runPosition):
+    mLabels = np.array(['M0','M1','M2','M3','M4','M5',''], dtype=object)
+    
+    return mLabels[np.minimum(runPosition, 6)].tolist()
+
+# Calculate '%M'. Each isotope cluster is normalized to its total abundance.
+def calculatePercentM(dataFrame,clusters):
+    abund = dataFrame['Abund'].values.astype(float)
+    abundSum = clusters.reduce(np.add, abund)
+    
+    percentM = np.zeros(len(dataFrame))
+    percentM[clusters.members] = abund[clusters.members]/np.repeat(abundSum, clusters.sizes)
 
     return percentM
 
-# Calculate 'M Ratio'
-def calculateMRatio(dataFrame):
-    mRatio = [round(math.fabs(dataFrame['%M'][i]-dataFrame['%M'][i-1]),7) if dataFrame['M'][i]!='M0' and dataFrame['%M'][i]!=0 else '' for i in xrange(len(dataFrame['M']))]
+# Calculate 'M Ratio', the change in '%M' from the previous isotopomer. Peaks
+# that are not part of an isotope cluster get ''.
+def calculateMRatio(dataFrame,clusters):
+    percentM = dataFrame['%M'].values.astype(float)
+    rows = np.concatenate([clusters.isotopomerRows(k) for k in xrange(1,5)])
+    rows = np.sort(rows[percentM[rows] != 0])
     
-    return mRatio
+    mRatio = np.empty(len(dataFrame), dtype=object)
+    mRatio[:] = ''
+    mRatio[rows] = [round(i,7) for i in np.fabs(percentM[rows]-percentM[rows-1])]
+    
+    return mRatio.tolist()
+
+# Warning levels, in the order of their category codes
+warningLevels = ['OK','BAD','NO M4','LOW']
 
-# Calculate 'Warnings' to remove 'BAD' peptides
-def identifyWarnings(dataFrame,mDiff,abundFilter):
+# Default mass bins of the 'M Difference Criteria', as the lower edges of the
+# bins after the first: <900, 900-1100, 1100-1800 and from 1800 amu
+defaultMassBins = [900,1100,1800]
+
+# Calculate 'Warnings' to remove 'BAD' peptides. Each isotope cluster is put
+# in a mass bin, and is 'BAD' if its largest 'M Ratio' is above the 'M
+# Difference Criteria' of that bin. Returns a categorical with one warning per
+# peak.
+def identifyWarnings(dataFrame,clusters,mDiff,abundFilter,massBins=defaultMassBins):
     
-    maxDiff1 = mDiff[0]
-    maxDiff2 = mDiff[1]
-    maxDiff3 = mDiff[2]
-    maxDiff4 = mDiff[3]
+    if len([i for i in mDiff[0:len(massBins)+1] if i != '']) != len(massBins)+1:
+        print '*** M DIFFERENCE CRITERIA NEEDS ONE VALUE FOR EACH OF THE '+str(len(massBins)+1)+' MASS BINS! ***'
+        raise ValueError('Expected '+str(len(massBins)+1)+' M Difference Criteria, got '+str(mDiff))
+    maxDiff = np.asarray(mDiff[0:len(massBins)+1], dtype=float)
     
     maxSum = abundFilter
-    warnings = ['OK']*len(dataFrame['M'])
-    mSequence1 = ['M0', 'M1', 'M2', 'M3']
-    mSequence2 = ['M0', 'M1', 'M2', 'M3','M4']
-    
-    positions = [x for x in [([i,4] if dataFrame['M'][i:i+len(mSequence1)].tolist()==mSequence1 and dataFrame['Mass'][i]<2400 else ([i,5] if dataFrame['M'][i:i+len(mSequence2)].tolist()==mSequence2 and dataFrame['Mass'][i]>=2400 else ['',''])) for i in xrange(len(dataFrame['M']))] if x!=['','']]
-    
-    for i in xrange(len(positions)):
-        roundedMass = round(dataFrame['Mass'][positions[i][0]],1)
-        maxRatios = max(dataFrame['M Ratio'][positions[i][0]+1:positions[i][0]+positions[i][1]].tolist())
-        abundSum = sum(dataFrame['Abund'][positions[i][0]:positions[i][0]+positions[i][1]].tolist())
-
-        if dataFrame['Sample'][positions[i][0]].upper().find('SILAM')!=-1 or dataFrame['Sample'][positions[i][0]].upper().find('SILAC')!=-1:
-            warnings[positions[i][0]:positions[i][0]+positions[i][1]] = ['OK']*5 if positions[i][1]==5 else ['OK']*4
-        elif roundedMass < 900 and maxRatios > maxDiff1:
-            warnings[positions[i][0]:positions[i][0]+positions[i][1]] = ['BAD']*5 if positions[i][1]==5 else ['BAD']*4
-        elif roundedMass > 899.99 and roundedMass < 1100 and maxRatios > maxDiff2:
-            warnings[positions[i][0]:positions[i][0]+positions[i][1]] = ['BAD']*5 if positions[i][1]==5 else ['BAD']*4
-        elif roundedMass > 1099.99 and roundedMass < 1800 and maxRatios > maxDiff3:
-            warnings[positions[i][0]:positions[i][0]+positions[i][1]] = ['BAD']*5 if positions[i][1]==5 else ['BAD']*4
-        elif roundedMass > 1799.99 and maxRatios > maxDiff4:
-            warnings[positions[i][0]:positions[i][0]+positions[i][1]] = ['BAD']*5 if positions[i][1]==5 else ['BAD']*4
-        elif roundedMass >=2400 and positions[i][1]==4:
-            warnings[positions[i][0]:positions[i][0]+positions[i][1]] = ['NO M4']*4
-        elif abundSum < maxSum:
-            warnings[positions[i][0]:positions[i][0]+positions[i][1]] = ['LOW']*5 if positions[i][1]==5 else ['LOW']*4
-        else:
-            warnings[positions[i][0]:positions[i][0]+positions[i][1]] = ['OK']*5 if positions[i][1]==5 else ['OK']*4
+    
+    # Peaks without a ratio count as a ratio too large to pass
+    mRatio = np.array([np.inf if i == '' else i for i in dataFrame['M Ratio'].values], dtype=float)
+    maxRatios = clusters.reduce(np.maximum, mRatio, skip=1)
+    abundSums = clusters.reduce(np.add, dataFrame['Abund'].values.astype(float))
+    silacSamples = np.array([i.upper().find('SILAM')!=-1 or i.upper().find('SILAC')!=-1 for i in clusters.samples], dtype=bool)
+    
+    massBin = np.searchsorted(np.asarray(massBins, dtype=float), clusters.roundedMass, side='right')
+    
+    # The first matching rule wins: SILAC samples are always 'OK'
+    clusterCodes = np.select(
+        [silacSamples[clusters.sampleId],
+         maxRatios > maxDiff[massBin],
+         (clusters.roundedMass >= 2400) & (clusters.sizes == 4),
+         abundSums < maxSum],
+        [warningLevels.index('OK'), warningLevels.index('BAD'), warningLevels.index('NO M4'), warningLevels.index('LOW')],
+        default=warningLevels.index('OK'))
+    
+    warningCodes = clusters.toRows(clusterCodes, warningLevels.index('OK'))
 
-    return warnings
+    return pd.Categorical.from_codes(warningCodes, warningLevels)
 
 # Calculate new columns to be inserted in Converted Compound Report 
 def calculateNewColumns(massList,mList,abundList,sampleList,diffList,taFilter):
@@ -371,43 +594,59 @@ def calculateNewColumns(massList,mList,abundList,sampleList,diffList,taFilter):
 
     return percentMData, mRatioData, warningData
 
-# Convert Compound Reports to data frame
-def convertReport(peptideData,sDict,mdList,taList,useFractions):
-    peptideData.insert(1,'Species',map(getSpecies,peptideData['FileName'].tolist()))
-    peptideData.insert(2,'Code',map(getNotebookCode,peptideData['FileName'].tolist()))
-    if useFractions == True:
-        peptideData.insert(3,'Fraction',map(getFraction,peptideData['FileName'].tolist()))
-    else:
-        peptideData.insert(3,'Fraction',[np.nan]* len(peptideData['FileName'].tolist()))
-    peptideData.insert(4,'Sample',map(getSampleName,peptideData['FileName'].tolist()))
-    peptideData.insert(5,'Accession#',map(getAccession,peptideData['Acc#+Name'].tolist()))
-    peptideData.insert(6,'Protein',map(getProteinName,peptideData['Acc#+Name'].tolist()))
-    peptideData.insert(6,'AAstart+seq',map(getAAStartSeq,peptideData['Aastart+Sequ-Mods'].tolist()))
-    peptideData.insert(7,'AASequence',map(getAASequence,peptideData['Aastart+Sequ-Mods'].tolist()))
-    peptideData.insert(8,'AAStart',map(getAAStart,peptideData['Aastart+Sequ-Mods'].tolist()))
-    peptideData.insert(9,'Modifications',map(getModifications,peptideData['Aastart+Sequ-Mods'].tolist()))
+# Insert species, code, fraction and sample columns parsed from the file names
+# of a Compound Report. Each distinct file name is only parsed once.
+def parseReportFileNames(peptideData,useFractions):
+    required = ['SampleName','Prefix','Species','Code']+(['Fraction'] if useFractions == True else [])
+    codes, parsedNames = extractFields(peptideData['FileName'].values,fileNamePattern,required)
+    if useFractions != True:
+        parsedNames['Fraction'] = np.nan
+    parsedNames['Sample'] = parsedNames['SampleName']+'-'+parsedNames['Prefix']
+    
+    peptideData.insert(1,'Species',parsedNames['Species'].values[codes])
+    peptideData.insert(2,'Code',parsedNames['Code'].values[codes])
+    peptideData.insert(3,'Fraction',parsedNames['Fraction'].values[codes])
+    peptideData.insert(4,'Sample',parsedNames['Sample'].values[codes])
+    return peptideData
+
+# Convert Compound Reports to data frame. Species, code, fraction and sample
+# columns are already parsed by parseReportFileNames.
+def convertReport(peptideData,sDict,mdList,taList,useFractions,massBins=defaultMassBins):
+    accessionCodes, accessions = extractFields(peptideData['Acc#+Name'].values,accessionPattern)
+    peptideCodes, peptides = extractFields(peptideData['Aastart+Sequ-Mods'].values,peptidePattern)
+    peptideData.insert(5,'Accession#',accessions['Accession'].values[accessionCodes])
+    peptideData.insert(6,'Protein',accessions['Protein'].values[accessionCodes])
+    peptideData.insert(6,'AAstart+seq',peptides['AAStartSeq'].values[peptideCodes])
+    peptideData.insert(7,'AASequence',peptides['AASequence'].values[peptideCodes])
+    peptideData.insert(8,'AAStart',peptides['AAStart'].values[peptideCodes])
+    peptideData.insert(9,'Modifications',peptides['Modifications'].values[peptideCodes])
     
     peptideData.insert(11,'Rounded Neutral Mass',map(getNeutralMass,peptideData['Mass'].tolist()))
 
+    # Index the isotope clusters once for all of the calculations below
+    runNumber, runPosition = getPeakRuns(peptideData)
+    clusters = IsotopeClusters.fromPeaks(peptideData, runPosition)
+
     # Calculate 'Mx' columns
-    mxList = calculateMX(peptideData)
+    mxList = calculateMX(runPosition)
     peptideData.insert(15,'M',mxList)
     
     # Calculate '%M' column
-    percentMData = calculatePercentM(peptideData)
+    percentMData = calculatePercentM(peptideData,clusters)
     peptideData.insert(16,'%M',percentMData)
     
     # Calculate 'M Ratio ' column
-    mRatioData = calculateMRatio(peptideData)
+    mRatioData = calculateMRatio(peptideData,clusters)
     peptideData.insert(17,'M Ratio',mRatioData)
     
     # Calculate 'Warnings' column
-    warningList = identifyWarnings(peptideData,mdList,taList)
-    peptideData.insert(18,'Warning',warningList)
+    warningList = identifyWarnings(peptideData,clusters,mdList,taList,massBins)
     
     # Filter data frame to exclude any peptides with '%M' < 0
+    keepRows = np.flatnonzero(peptideData['%M'].values>0)
     peptideData = peptideData[peptideData['%M']>0]
     peptideData.fillna(0, inplace=True)
+    peptideData.insert(18,'Warning',warningList[keepRows])
     
     del peptideData['AASequence']
 
@@ -447,17 +686,194 @@ def getFiles(source):
     
     return parametersFile[0], midaFiles,crFiles
 
-# Convert all Comound Report files and append to one table
-def convertCompoundReport(crReports,dict1,var1, var2,useFractions):
-    compiledReports = []
-    
-    for i in xrange(len(crReports)):
-        report, reportDate = importCompoundReport(crReports[i])
-        compiledReports.append(report)
-        
-    allReports = pd.concat(compiledReports)
-    allReports = allReports.reset_index(drop=True)
-    outputTab = convertReport(allReports,dict1,var1, var2,useFractions)
+# Column types of the sorted Compound Report table that goes into the pivot
+# tables. 'number' columns keep integer types and are otherwise floats.
+# 'text' columns are typed by convertTextColumn.
+sortedSchema = OrderedDict([
+    ('File Name','text'),
+    ('Species','text'),
+    ('Code','text'),
+    ('Fraction','text'),
+    ('Sample','text'),
+    ('Accession#','text'),
+    ('Protein','text'),
+    ('AAstart+seq','text'),
+    ('Modifications','text'),
+    ('Mass','number'),
+    ('Rounded Neutral Mass','number'),
+    ('Rt','number'),
+    ('RtDiff','number'),
+    ('Score (DB)','number'),
+    ('M','text'),
+    ('Peptide m/z','number'),
+    ('Ion Cluster','number'),
+    ('Charge','number'),
+    ('Abund','number'),
+    ('%M','number'),
+    ('Saturated','number'),
+    ('Warning','text')])
+
+# Type a text column the way pd.read_csv would read it back. Missing text
+# becomes NaN, and a column that only holds numbers becomes numeric. Each
+# distinct value is only converted once.
+def convertTextColumn(values):
+    codes, uniques = pd.factorize(np.asarray(values, dtype=object))
+    uniques = [np.nan if isinstance(i, basestring) and i in reportNAValues else i for i in uniques]
+    isNull = np.array([isinstance(i, float) and np.isnan(i) for i in uniques] + [True], dtype=bool)
+    
+    numbers = []
+    isInteger = []
+    for value in uniques:
+        if isinstance(value, (bool, np.bool_)):
+            break
+        elif isinstance(value, (int, long, np.integer)):
+            numbers.append(value)
+            isInteger.append(True)
+        elif isinstance(value, (float, np.floating)):
+            numbers.append(value)
+            isInteger.append(False)
+        else:
+            try:
+                numbers.append(int(value))
+                isInteger.append(True)
+            except ValueError:
+                try:
+                    numbers.append(float(value))
+                    isInteger.append(False)
+                except ValueError:
+                    break
+    
+    hasNull = isNull[codes].any()
+    if len(numbers) == len(uniques) and len(uniques) > 0:
+        if all(isInteger) and not hasNull:
+            return np.array(numbers, dtype=np.int64)[codes]
+        return np.array(numbers + [np.nan], dtype=float)[codes]
+    
+    text = [np.nan if isNull[i] else (value if isinstance(value, basestring) else str(value)) for i, value in enumerate(uniques)]
+    return np.array(text + [np.nan], dtype=object)[codes]
+
+# Normalize the column types of a table to a schema, in memory
+def normalizeDtypes(dataFrame, schema):
+    normalized = OrderedDict()
+    for column, kind in schema.items():
+        values = np.asarray(dataFrame[column].values)
+        if kind == 'number' and values.dtype.kind in 'iu':
+            normalized[column] = values
+        elif kind == 'number' and values.dtype.kind in 'fb':
+            normalized[column] = values.astype(float)
+        else:
+            normalized[column] = convertTextColumn(values)
+    return pd.DataFrame(normalized, columns=schema.keys())
+
+# Get the cache file of a converted Compound Report, and its key: the hash of
+# the report contents and of the settings used to convert it. Replacing a report
+# with new contents, or changing the settings, gives a new key.
+def getConvertedReportCache(fileName,useFractions,mdList,taList,massBins):
+    contentHash = fileContentHash(fileName)
+    settings = repr((reportCacheVersion, useFractions == True, list(mdList), taList, list(massBins)))
+    cacheKey = np.array([contentHash, hashlib.sha1(settings).hexdigest()])
+    cacheName = hashlib.sha1(contentHash+settings).hexdigest()+'.converted.npz'
+    return os.path.join(os.path.dirname(os.path.abspath(fileName)), reportCacheFolder, cacheName), cacheKey
+
+# Write a converted Compound Report and its number of imported rows to the
+# cache
+def saveConvertedReport(cacheFile, cacheKey, report, reportDate, numRows):
+    arrays = {'key': cacheKey, 'fileDate': np.array([reportDate]), 'numRows': np.array([numRows])}
+    packColumns(report, arrays)
+    writeCacheFile(cacheFile, arrays)
+
+# Read a converted Compound Report back from the cache. Returns None if it
+# was not converted from the same contents with the same settings.
+def loadConvertedReport(cacheFile, cacheKey):
+    cache = readCacheFile(cacheFile, cacheKey)
+    if cache is None:
+        return None
+    try:
+        report = unpackColumns(cache)
+        reportDate = str(cache['fileDate'][0])
+        numRows = int(cache['numRows'][0])
+    except (IOError, OSError, KeyError, ValueError):
+        return None
+    finally:
+        cache.close()
+    return report, reportDate, numRows
+
+# Import and convert one Compound Report. Run in the worker processes of
+# convertCompoundReport, so only the converted frame is sent back. Reports
+# that were converted before with the same contents and settings are read
+# from the cache. Returns the converted frame, the report date, the number of
+# imported rows, the cache key and the cache file.
+def importReportWorker(args):
+    fileName, sDict, mdList, taList, useFractions, massBins = args
+    cacheFile, cacheKey = getConvertedReportCache(fileName,useFractions,mdList,taList,massBins)
+    converted = loadConvertedReport(cacheFile, cacheKey)
+    if converted is None:
+        report, reportDate = importCompoundReport(fileName)
+        numRows = len(report)
+        report = parseReportFileNames(report,useFractions)
+        report = convertReport(report,sDict,mdList,taList,useFractions,massBins)
+        saveConvertedReport(cacheFile, cacheKey, report, reportDate, numRows)
+        converted = report, reportDate, numRows
+    return converted+(cacheKey[0]+cacheKey[1],cacheFile)
+
+# Delete the converted Compound Reports in the cache folders of cacheFiles that
+# are not one of cacheFiles. They are left from reports that were replaced or
+# removed, or converted with other settings.
+def pruneReportCache(cacheFiles):
+    keep = set(os.path.normcase(os.path.abspath(i)) for i in cacheFiles)
+    for folder in set(os.path.dirname(i) for i in keep):
+        if not os.path.isdir(folder):
+            continue
+        for name in os.listdir(folder):
+            cacheFile = os.path.join(folder,name)
+            if name.endswith('.converted.npz') and os.path.normcase(cacheFile) not in keep:
+                try:
+                    os.remove(cacheFile)
+                except OSError:
+                    pass
+
+# Import and convert Compound Report files in a process pool. Reports come
+# back in the order of crReports, however the work is spread over the workers.
+# A pool that is passed in is used as is and left open, so a caller running in
+# a thread can create it before starting any threads.
+def importCompoundReports(crReports,sDict,mdList,taList,useFractions,massBins=defaultMassBins,jobs=None,pool=None):
+    workerArgs = [(i,sDict,mdList,taList,useFractions,massBins) for i in crReports]
+    if pool is not None:
+        return pool.map(importReportWorker,workerArgs)
+    
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+    jobs = min(jobs, len(crReports))
+    if jobs <= 1:
+        return map(importReportWorker,workerArgs)
+    
+    pool = multiprocessing.Pool(jobs)
+    try:
+        importedReports = pool.map(importReportWorker,workerArgs)
+    finally:
+        pool.close()
+        pool.join()
+    return importedReports
+
+# Convert all Comound Report files and append to one table. Each report is
+# converted on its own, so only new or replaced reports are converted again.
+# Also returns a hash of the reports of every sample.
+def convertCompoundReport(crReports,dict1,var1, var2,useFractions,massBins=defaultMassBins,jobs=None,pool=None):
+    importedReports = importCompoundReports(crReports,dict1,var1,var2,useFractions,massBins,jobs,pool)
+    pruneReportCache([i[4] for i in importedReports])
+    reportDate = importedReports[-1][1]
+    
+    # Number the rows as if the imported reports were converted as one table
+    rowOffset = 0
+    sampleReports = OrderedDict()
+    for report, fileDate, numRows, reportKey, cacheFile in importedReports:
+        report.index = report.index+rowOffset
+        rowOffset += numRows
+        for sample in pd.unique(report['Sample'].values):
+            sampleReports.setdefault(sample,[]).append(reportKey)
+    sampleHashes = OrderedDict((i,hashlib.sha1(','.join(sorted(sampleReports[i]))).hexdigest()) for i in sampleReports)
+    
+    outputTab = pd.concat([i[0] for i in importedReports])
     
     sortedTab = outputTab.sort_index(by=['Protein','AAstart+seq','Charge','M','Sample'],ascending = [True,True,True,True,True])
     sortedTab['Saturated'] = sortedTab['Saturated'].replace('S',np.nan)
@@ -466,79 +882,308 @@ def convertCompoundReport(crReports,dict1,var1, var2,useFractions):
     
     sortedTab = sortedTab[sortedTab['Warning']=='OK']
     sortedTab = sortedTab.reset_index(drop=True)
-    sortedTab.to_csv('SORTED.csv')
 
-    sortedTab2 = pd.read_csv('SORTED.csv')
-    pivotData = sortedTab2.pivot_table(['Mass','Rt','RtDiff','Score (DB)','Abund','%M','Saturated'],rows = ['Warning','Species','Protein','Accession#','AAstart+seq','Modifications','Charge','Fraction','Code','M'], cols = 'Sample')
-    newMasses = [np.nanmin(pivotData.Mass.iloc[i].values) for i in xrange(len(pivotData.Mass))]
-    
-    del pivotData['Mass']
-    os.remove('SORTED.csv')
-    pivotData.insert(0,'Mass ',newMasses)
+    sortedTab2 = normalizeDtypes(sortedTab, sortedSchema)
     
-    return outputTab, pivotData, sortedTab2, reportDate
+    return outputTab, sortedTab2, reportDate, sampleHashes
+
+# Text columns of the MIDA database files
+midaTextColumns = ['Formula',' Cpd','Notes','sequence','modifications','composition','All Swissprot IDs']
 
 # Merge multiple MIDA databases into one
 def condenseFiles(mida_file):
-    tempMIDA = pd.read_csv(mida_file[0])
-    for i in xrange(len(mida_file[1:])):
-        tempMIDA = tempMIDA.append(pd.read_csv(mida_file[1:][i]))
-    return tempMIDA
+    return pd.concat([pd.read_csv(i,dtype=dict((j,object) for j in midaTextColumns)) for i in mida_file],ignore_index=True)
+
+# Positions of the rows to keep so that every key appears once: the row with
+# the latest RT (missing RT counts as latest), or the last of those rows
+def lastByRT(table,keys,rtColumn=' RT'):
+    codes = np.zeros(len(table),dtype=np.int64)
+    for key in keys:
+        keyCodes = pd.factorize(table[key].values)[0]
+        keyCodes[keyCodes<0] = keyCodes.max()+1
+        codes = pd.factorize(codes*(keyCodes.max()+1)+keyCodes)[0]
+    
+    rt = table[rtColumn].values.astype(float)
+    rt[np.isnan(rt)] = np.inf
+    latestRT = np.empty(codes.max()+1)
+    latestRT[:] = -np.inf
+    np.maximum.at(latestRT,codes,rt)
+    isLatest = np.flatnonzero(rt==latestRT[codes])
+    lastRow = np.zeros(codes.max()+1,dtype=np.int64)
+    np.maximum.at(lastRow,codes[isLatest],isLatest)
+    return np.sort(lastRow)
+
+# Integer codes of peptides, by protein and sequence with modifications. The
+# Compound Report and MIDA tables are merged on these codes instead of on
+# their text columns, and each distinct peptide's text is only handled once.
+class PeptideKeys(object):
+    
+    def __init__(self):
+        self.codes = {}
+    
+    def __len__(self):
+        return len(self.codes)
+    
+    # Codes of every row, adding new peptides. The sequence is 'AAstart+seq',
+    # joined to the modifications with '-' when they are given separately, as
+    # in the 'Notes' of the MIDA database. Rows with missing text get -1.
+    def intern(self, proteins, sequences, modifications=None):
+        columns = [proteins,sequences] if modifications is None else [proteins,sequences,modifications]
+        combined = np.zeros(len(proteins),dtype=np.int64)
+        for column in columns:
+            columnCodes, columnValues = pd.factorize(np.asarray(column,dtype=object))
+            combined = combined*(len(columnValues)+1)+columnCodes+1
+        rowCodes, uniqueRows = pd.factorize(combined)
+        firstRows = np.unique(rowCodes,return_index=True)[1]
+        
+        peptideCodes = np.empty(len(firstRows),dtype=np.int64)
+        for i in xrange(len(firstRows)):
+            values = [column[firstRows[i]] for column in columns]
+            if not all(isinstance(v,basestring) for v in values):
+                peptideCodes[i] = -1
+                continue
+            key = (values[0],'-'.join([v.rstrip() for v in values[1:]]))
+            peptideCodes[i] = self.codes.setdefault(key,len(self.codes))
+        return peptideCodes[rowCodes]
+
+# Exact MIDA EMx evaluated so far, by MIDA composition, number of labile
+# hydrogens and body water, and the natural M0 to M4 by composition and number
+# of labile hydrogens
+exactMidaCache = {}
+naturalMidaCache = {}
+
+# Convert a MIDA composition like 'H47C25N9O9S0' to the number of atoms of
+# every MIDA element
+def parseComposition(composition):
+    atoms = dict((symbol,int(count)) for symbol,count in re.findall(r'([A-Z][a-z]?)(\d+)',composition))
+    return np.array([atoms.get(symbol,0) for symbol in chemical_data.element_symbols],dtype=composition_dtype)
+
+# Exact MIDA EM0 to EM4 of peptides at every body water, as a peptides x body
+# water x EMx array, and the natural M0 to M4 of the peptides. Peptides are
+# (composition, n) pairs. The peptides that are not cached yet are computed
+# together at every body water, in one batched MIDA call.
+def calculateExactMIDA(peptides,bodyWater):
+    bwValues = sorted(set(p for p in bodyWater if np.isfinite(p)))
+    newPeptides = sorted(set(i for i in peptides if i not in naturalMidaCache or any((i[0],i[1],p) not in exactMidaCache for p in bwValues)))
+    if newPeptides:
+        molecules = [Molecule(parseComposition(composition),chemical_data,labiles=np.array([(0,n)],dtype=labile_dtype)) for composition,n in newPeptides]
+        hAbundances = convert_p_to_abundances(np.asarray([0.0]+bwValues),chemical_data.natural_abundances[0])
+        distributions = get_distributions(molecules,labile_abundances=(hAbundances,),mass_cutoff=4)
+        for (composition,n),molecule,distribution in zip(newPeptides,molecules,distributions):
+            naturalMidaCache[(composition,n)] = distribution[0,0:5]
+            distribution = renormalize_distributions(molecule,distribution)
+            for p,em in zip(bwValues,distribution[1:,0:5]-distribution[0,0:5]):
+                exactMidaCache[(composition,n,p)] = em
+    midaEMx = np.array([[exactMidaCache.get((composition,n,p),[np.nan]*5) for p in bodyWater] for composition,n in peptides]).reshape(len(peptides),len(bodyWater),5)
+    naturalMx = np.array([naturalMidaCache[i] for i in peptides]).reshape(len(peptides),5)
+    return midaEMx, naturalMx
+
+# Peptide columns of the Summary Table. Its rows are sorted on these columns,
+# like the rows of a pivot table.
+summaryKeys = ['Species','Code','Protein','Accession#','AAstart+seq','Modifications','n','Charge','Fraction',' RT','Formula','M0', 'M1', 'M2', 'M3', 'M4', 'EM0 cubic coeff 3', 'EM0 cubic coeff 2', 'EM0 cubic coeff 1', 'EM1 cubic coeff 3', 'EM1 cubic coeff 2', 'EM1 cubic coeff 1', 'EM2 cubic coeff 3', 'EM2 cubic coeff 2', 'EM2 cubic coeff 1', 'EM3 cubic coeff 3', 'EM3 cubic coeff 2', 'EM3 cubic coeff 1', 'EM4 cubic coeff 3', 'EM4 cubic coeff 2', 'EM4 cubic coeff 1', 'All Swissprot IDs', 'multiple IDs (1=yes)']
+
+# Measures kept for every peptide, sample and isotopomer M0 to M4
+cubeMeasures = ['Mass','Rt','Abund','%M']
+isotopomerLabels = ['M0','M1','M2','M3','M4']
+
+# Dense isotopomer data of the merged Compound Report and MIDA table: the mean
+# of every measure for each peptide, sample and isotopomer, with the peptide
+# columns in a separate table
+class IsotopomerCube(object):
+    
+    def __init__(self, values, present, peptides, samples, measures):
+        # Array of peptides x samples x isotopomers x measures, NaN if missing
+        self.values = values
+        # Array of samples x isotopomers x measures, True where any peptide
+        # has a value
+        self.present = present
+        self.peptides = peptides
+        self.samples = list(samples)
+        self.measures = list(measures)
+    
+    def __len__(self):
+        return len(self.peptides)
+    
+    # Array of peptides x samples x isotopomers for one measure
+    def measure(self, measure):
+        return self.values[:,:,:,self.measures.index(measure)]
+    
+    # Values of one measure and sample, in the columns of a pivot table: one
+    # column for every isotopomer that has a value for any peptide
+    def sampleValues(self, measure, sample):
+        s = self.samples.index(sample)
+        m = self.measures.index(measure)
+        return self.values[:,s,:,m][:,self.present[s,:,m]]
+    
+    # Check whether a sample has values of a measure for an isotopomer
+    def hasColumn(self, measure, sample, isotopomer):
+        if sample not in self.samples:
+            return False
+        return self.present[self.samples.index(sample),isotopomerLabels.index(isotopomer),self.measures.index(measure)]
+
+# Build the isotopomer cube from integer codes of the peptide columns, samples
+# and isotopomers. Rows with a missing peptide column are left out, and means
+# skip missing values, like pivot_table. The samples in unchangedSamples are
+# copied from the previous cube instead, as long as they still have values for
+# the same peptides.
+def buildIsotopomerCube(mergedData, keys=summaryKeys, measures=cubeMeasures, previous=None, unchangedSamples=()):
+    keyCodes = np.column_stack([pd.factorize(mergedData[k].values, sort=True)[0] for k in keys])
+    isotopomerCodes = np.array([isotopomerLabels.index(i) if i in isotopomerLabels else -1 for i in mergedData['M'].values], dtype=int)
+    valid = (keyCodes >= 0).all(axis=1) & (isotopomerCodes >= 0) & pd.notnull(mergedData['Sample']).values
+    rows = np.flatnonzero(valid)
+    keyCodes = keyCodes[rows]
+    sampleCodes, samples = pd.factorize(mergedData['Sample'].values[rows], sort=True)
+    
+    # Number the peptides in the sort order of their columns
+    order = np.lexsort(keyCodes.T[::-1])
+    newPeptide = np.ones(len(order), dtype=bool)
+    newPeptide[1:] = (keyCodes[order][1:] != keyCodes[order][:-1]).any(axis=1)
+    peptideCodes = np.empty(len(order), dtype=int)
+    peptideCodes[order] = np.cumsum(newPeptide)-1
+    peptides = mergedData[keys].iloc[rows[order[newPeptide]]].reset_index(drop=True)
+    
+    # Find the previous samples to copy, and where their peptides are now
+    copied = OrderedDict()
+    if previous is not None and previous.measures == list(measures):
+        peptidePositions = dict((tuple(peptides.values[i]),i) for i in xrange(len(peptides)))
+        previousPositions = np.array([peptidePositions.get(tuple(i),-1) for i in previous.peptides.values], dtype=int)
+        for s in xrange(len(samples)):
+            if samples[s] not in unchangedSamples or samples[s] not in previous.samples:
+                continue
+            previousValues = previous.values[:,previous.samples.index(samples[s])]
+            hasValues = ~np.isnan(previousValues.reshape(len(previous),-1)).all(axis=1)
+            if (previousPositions[hasValues] < 0).any():
+                continue
+            hadValues = np.zeros(len(peptides), dtype=bool)
+            hadValues[previousPositions[hasValues]] = True
+            hasRows = np.zeros(len(peptides), dtype=bool)
+            hasRows[peptideCodes[sampleCodes == s]] = True
+            if (hadValues == hasRows).all():
+                copied[s] = previousValues[hasValues], previousPositions[hasValues]
+    computed = ~np.in1d(sampleCodes, copied.keys())
+    
+    numCells = len(peptides)*len(samples)*len(isotopomerLabels)
+    cells = (peptideCodes*len(samples) + sampleCodes)*len(isotopomerLabels) + isotopomerCodes[rows]
+    values = np.empty((numCells, len(measures)))
+    for m in xrange(len(measures)):
+        measureValues = mergedData[measures[m]].values[rows].astype(float)
+        hasValue = ~np.isnan(measureValues) & computed
+        sums = np.bincount(cells[hasValue], weights=measureValues[hasValue], minlength=numCells)
+        counts = np.bincount(cells[hasValue], minlength=numCells)
+        values[:,m] = np.where(counts > 0, sums/np.maximum(counts, 1), np.nan)
+    values = values.reshape(len(peptides), len(samples), len(isotopomerLabels), len(measures))
+    for s, (sampleValues, positions) in copied.items():
+        values[positions,s] = sampleValues
+    present = ~np.isnan(values).all(axis=0)
+    
+    return IsotopomerCube(values, present, peptides, samples, measures)
+
+# Write the isotopomer cube to a cache file, with the hash of the Compound
+# Reports of every sample
+def saveIsotopomerCube(cacheFile, cacheKey, cube, sampleHashes):
+    arrays = {'key': cacheKey, 'values': cube.values,
+              'samples': np.array([unicode(i) for i in cube.samples], dtype=np.unicode_),
+              'measures': np.array(cube.measures),
+              'sampleHashes': np.array([sampleHashes.get(i,'') for i in cube.samples])}
+    packColumns(cube.peptides, arrays, 'peptides')
+    writeCacheFile(cacheFile, arrays)
+
+# Read an isotopomer cube back from a cache file. Returns the cube and the
+# hash of the Compound Reports of every sample, or None if there is no cube
+# for this key.
+def loadIsotopomerCube(cacheFile, cacheKey):
+    cache = readCacheFile(cacheFile, cacheKey)
+    if cache is None:
+        return None
+    try:
+        values = cache['values']
+        cube = IsotopomerCube(values, ~np.isnan(values).all(axis=0), unpackColumns(cache, 'peptides').reset_index(drop=True), list(cache['samples']), [str(i) for i in cache['measures']])
+        sampleHashes = dict(zip(cube.samples, [str(i) for i in cache['sampleHashes']]))
+    except (IOError, OSError, KeyError, ValueError):
+        return None
+    finally:
+        cache.close()
+    return cube, sampleHashes
 
 # Generate Summary File        
-def generateSummaryFile(sampleList,midaDB,sortedTab,bodyWaterInput,silacMasses,satFilter,offsetSlope,offsetIntercept):
+def generateSummaryFile(sampleList,midaDB,sortedTab,bodyWaterInput,silacMasses,satFilter,offsetSlope,offsetIntercept,midaPredictions='Cubic',cubeCacheFile=None,sampleHashes=None):
+    
+    if midaPredictions == 'Exact' and Molecule is None:
+        print '*** Exact MIDA predictions need the mida package, which could not be imported ***'
+        raise ImportError('No module named mida')
+    if midaPredictions == 'Exact' and enriched_aa_abundances is not None:
+        print '*** Exact MIDA predictions can not rebuild the enriched amino acids of run_data.py from the MIDA database ***'
+        raise ValueError('Exact MIDA predictions do not support enriched amino acids')
     
     # Get MIDA database(s) and filter
     midaTable = condenseFiles(midaDB)
-    midaTable = midaTable.sort(columns=['Formula',' Cpd','Notes',' Mass',' RT'])
-    midaTable=midaTable.drop_duplicates(cols=['Formula',' Cpd','Notes',' Mass'],take_last=True).reset_index()
+    midaTable = midaTable.iloc[lastByRT(midaTable,['Formula',' Cpd','Notes',' Mass'])]
     
-    midaTable = midaTable.drop(['sequence','modifications','score','composition'],axis=1)
-    midaTable[' Cpd'] = midaTable[' Cpd'].astype(object)
-    midaTable = midaTable[midaTable[' Cpd'].map(len)>6]
+    midaTable = midaTable.drop(['sequence','modifications','score'],axis=1)
+    midaTable = midaTable[midaTable[' Cpd'].str.len()>6]
     
-    midaNames = [midaTable[' Cpd'].iloc[i][7:] for i in xrange(len(midaTable))]
-    midaTable.insert(0,'Protein',midaNames)
-    midaTable = midaTable.drop([' Cpd'],axis=1).reset_index().rename(columns = {'Notes': 'Sequence',' Mass':'Mass'})
-
-    midaTable['Sequence'] = [midaTable['Sequence'][i].rstrip() for i in xrange(len(midaTable))]
+    peptideKeys = PeptideKeys()
+    midaTable.insert(0,'Peptide Key',peptideKeys.intern(midaTable[' Cpd'].str.slice(7).values,midaTable['Notes'].values))
+    midaTable = midaTable.drop([' Cpd','Notes'],axis=1).reset_index(drop=True).rename(columns = {' Mass':'Mass'})
+    
+    # Keep the MIDA composition of every peptide for exact MIDA predictions
+    midaComposition = dict(zip(midaTable['Peptide Key'],zip(midaTable['composition'],midaTable['n'])))
+    midaTable = midaTable.drop(['composition'],axis=1)
     # COPY RESULTS FROM COMPOUND REPORT
     cpdReport = sortedTab.copy()
     
-    newSequence = ['-'.join([cpdReport['AAstart+seq'].iloc[i].rstrip(),cpdReport['Modifications'].iloc[i].rstrip()]) for i in xrange(len(cpdReport))]
-    cpdReport.insert(4,'Sequence',newSequence)
+    cpdReport.insert(4,'Peptide Key',peptideKeys.intern(cpdReport['Protein'].values,cpdReport['AAstart+seq'].values,cpdReport['Modifications'].values))
     cpdReport = cpdReport.drop(['Mass'],axis=1) ### REV 02.17.2015 ###
     
     # Merge Compound Report data frame and MIDA data frame
     
-    mergedData = pd.merge(cpdReport,midaTable, on=['Protein','Sequence'], how ='outer')
+    mergedData = pd.merge(cpdReport,midaTable, on='Peptide Key', how ='outer')
     mergedData = mergedData[pd.notnull(mergedData['Code'])]
     if len(list(set(mergedData['Code']))) > 1:		
         mergedData['Code'] = [mergedData['Code'][0]]*len(mergedData)
 
-    pivotData2 = mergedData.pivot_table(['Mass','Rt','RtDiff','Score (DB)','Abund','%M','Saturated'],rows = ['Species','Code','Protein','Accession#','AAstart+seq','Modifications','n','Charge','Fraction',' RT','Formula','M0', 'M1', 'M2', 'M3', 'M4', 'EM0 cubic coeff 3', 'EM0 cubic coeff 2', 'EM0 cubic coeff 1', 'EM1 cubic coeff 3', 'EM1 cubic coeff 2', 'EM1 cubic coeff 1', 'EM2 cubic coeff 3', 'EM2 cubic coeff 2', 'EM2 cubic coeff 1', 'EM3 cubic coeff 3', 'EM3 cubic coeff 2', 'EM3 cubic coeff 1', 'EM4 cubic coeff 3', 'EM4 cubic coeff 2', 'EM4 cubic coeff 1', 'All Swissprot IDs', 'multiple IDs (1=yes)'], cols = ['Sample','M'])
-    massCheck = pivotData2.Mass.min(axis=1,skipna=True).values > 2400
+    # Collect the isotopomer data of every peptide and sample. With a cube cache,
+    # the samples whose Compound Reports did not change since the last run are
+    # copied from the cached cube.
+    if cubeCacheFile is None:
+        cube = buildIsotopomerCube(mergedData)
+    else:
+        cubeKey = np.array([hashlib.sha1(','.join(fileContentHash(i) for i in midaDB)).hexdigest(), str(reportCacheVersion)])
+        cached = loadIsotopomerCube(cubeCacheFile, cubeKey)
+        if cached is None:
+            cube = buildIsotopomerCube(mergedData)
+        else:
+            unchangedSamples = [i for i in sampleHashes if cached[1].get(i) == sampleHashes[i]]
+            cube = buildIsotopomerCube(mergedData, previous=cached[0], unchangedSamples=unchangedSamples)
+        saveIsotopomerCube(cubeCacheFile, cubeKey, cube, sampleHashes)
+    peptides = cube.peptides
+    peptideMass = np.nanmin(cube.measure('Mass').reshape(len(cube),-1),axis=1)
+    massCheck = peptideMass > 2400
 
     # Calculate Baseline Mx
-    baselineM0 = np.asarray((pivotData2.reset_index().iloc[:,11].values/np.where(massCheck,pivotData2.reset_index().iloc[:,11:16].sum(axis=1),pivotData2.reset_index().iloc[:,11:15].sum(axis=1))))
-    baselineM1 = np.asarray((pivotData2.reset_index().iloc[:,12].values/np.where(massCheck,pivotData2.reset_index().iloc[:,11:16].sum(axis=1),pivotData2.reset_index().iloc[:,11:15].sum(axis=1))))
-    baselineM2 = np.asarray((pivotData2.reset_index().iloc[:,13].values/np.where(massCheck,pivotData2.reset_index().iloc[:,11:16].sum(axis=1),pivotData2.reset_index().iloc[:,11:15].sum(axis=1))))
-    baselineM3 = np.asarray((pivotData2.reset_index().iloc[:,14].values/np.where(massCheck,pivotData2.reset_index().iloc[:,11:16].sum(axis=1),pivotData2.reset_index().iloc[:,11:15].sum(axis=1))))
-    baselineM4 = np.asarray((pivotData2.reset_index().iloc[:,15].values/np.where(massCheck,pivotData2.reset_index().iloc[:,11:16].sum(axis=1),pivotData2.reset_index().iloc[:,11:15].sum(axis=1))))
-    
-    def multiplyBW(inData):
-        return map(np.sum,inData* np.asarray(bodyWaterInput)[np.newaxis].T**np.asarray([3,2,1]))
-        
-    # Calculate MIDA Mx
-    midaEM0 =  map(multiplyBW,pivotData2.reset_index().iloc[:,16:19].values)
-    midaEM1 =  map(multiplyBW,pivotData2.reset_index().iloc[:,19:22].values)
-    midaEM2 =  map(multiplyBW,pivotData2.reset_index().iloc[:,22:25].values)
-    midaEM3 =  map(multiplyBW,pivotData2.reset_index().iloc[:,25:28].values)
-    midaEM4 =  map(multiplyBW,pivotData2.reset_index().iloc[:,28:31].values)
-    
-    summaryTable = pivotData2.reset_index().ix[0:,0:33]
+    baselineSum = np.where(massCheck,peptides[['M0','M1','M2','M3','M4']].sum(axis=1),peptides[['M0','M1','M2','M3']].sum(axis=1))
+    baselineM0 = peptides['M0'].values/baselineSum
+    baselineM1 = peptides['M1'].values/baselineSum
+    baselineM2 = peptides['M2'].values/baselineSum
+    baselineM3 = peptides['M3'].values/baselineSum
+    baselineM4 = peptides['M4'].values/baselineSum
+    
+    # Calculate MIDA Mx of every peptide at every body water
+    if midaPredictions == 'Exact':
+        peptideCodes = peptideKeys.intern(peptides['Protein'].values,peptides['AAstart+seq'].values,peptides['Modifications'].values)
+        midaEMx, naturalMx = calculateExactMIDA([midaComposition[i] for i in peptideCodes],bodyWaterInput)
+        # The natural M0 to M4 differ from the MIDA database when it was
+        # generated with other chemical data
+        mismatched = ~np.isclose(naturalMx,peptides[isotopomerLabels].values.astype(float),rtol=1e-6,atol=1e-9).all(axis=1)
+        if mismatched.any():
+            print '*** EXACT MIDA M0-M4 OF '+str(mismatched.sum())+' PEPTIDES DO NOT MATCH THE MIDA DATABASE, CHECK run_data.py ***'
+    else:
+        # From the cubic coefficients as a peptides x EMx x (p^3,p^2,p) array
+        midaCoeffs = peptides[summaryKeys[16:31]].values.astype(float).reshape(len(cube),5,3)
+        bwPowers = np.asarray(bodyWaterInput)[np.newaxis].T**np.asarray([3,2,1])
+        midaEMx = (midaCoeffs[:,np.newaxis,:,:]*bwPowers[np.newaxis,:,np.newaxis,:]).sum(axis=-1)
     
-    summaryTable.columns = [str(i[0]) for i in summaryTable.columns]
+    summaryTable = peptides.copy()
     
     summaryTable = summaryTable.rename(columns = {' RT':'Target RT'})
     
@@ -548,11 +1193,11 @@ def generateSummaryFile(sampleList,midaDB,sortedTab,bodyWaterInput,silacMasses,s
         return [x for x in samples if not (x in seen or seen_add(x))]
     sampleWaterData = OrderedDict((x,y) for (x,y) in zip(sampleList,bodyWaterInput))
     
-    sampleList = redefineSamples([i for i in sampleList for j in pivotData2.columns if j[1].find(i)!=-1])
+    sampleList = redefineSamples([i for i in sampleList for j in cube.samples if j.find(i)!=-1])
     bwList = [sampleWaterData[i] for i in sampleList]
     
     # Calculate Base Peak Abundance
-    basePkAbund = map(list,zip(*[pivotData2['Abund',sampleList[i]].max(axis=1,skipna=True).values for i in xrange(len(sampleList))]))
+    basePkAbund = map(list,zip(*[np.nanmax(cube.sampleValues('Abund',sampleList[i]),axis=1) for i in xrange(len(sampleList))]))
     
     # Calculate Sample Score
     summaryTable.insert(0,'Sample Score',map(np.count_nonzero,map(np.nan_to_num,basePkAbund)))
@@ -567,7 +1212,7 @@ def generateSummaryFile(sampleList,midaDB,sortedTab,bodyWaterInput,silacMasses,s
     summaryTable.insert(2, 'Sample*Abund Score',summaryTable['Sample Score'] * summaryTable['Abund Score'])
     
     # Insert additional columns in data frame for Corrected Mx and Mass
-    summaryTable.insert(9,'Mass',map(np.nanmin,pivotData2.Mass.values))
+    summaryTable.insert(9,'Mass',peptideMass)
     summaryTable.insert(20,'M0_c',baselineM0)
     summaryTable.insert(21,'M1_c',baselineM1)
     summaryTable.insert(22,'M2_c',baselineM2)
@@ -584,152 +1229,82 @@ def generateSummaryFile(sampleList,midaDB,sortedTab,bodyWaterInput,silacMasses,s
         return np.nansum(inData[0:2])
     
     # Calculate Summed Abundance
-    sumAbund = [map(calcSumAbund2,pivotData2['Abund',sampleList[i]].values) if sampleList[i].find('SILAC')!=-1 and silacMasses==2 else map(calcSumAbundALL,pivotData2['Abund',sampleList[i]].values) for i in xrange(len(sampleList))]
+    sumAbund = [map(calcSumAbund2,cube.sampleValues('Abund',sampleList[i])) if sampleList[i].find('SILAC')!=-1 and silacMasses==2 else map(calcSumAbundALL,cube.sampleValues('Abund',sampleList[i])) for i in xrange(len(sampleList))]
     
     def calcSat(a):
         return 1 if a >satFilter else np.nan
     
     # Calculate Saturation
-    sat = [map(calcSat,pivotData2['Abund',sampleList[i]].max(axis=1,skipna=True).values) for i in xrange(len(sampleList))]
-    
-    # Calculate EMx
-    EM0 = map(list,zip(*[[a - b for a, b in zip(list(zip(*pivotData2['%M',sampleList[i]].values)[0]), baselineM0)] for i in xrange(len(sampleList))]))
-    EM1 = map(list,zip(*[[a - b for a, b in zip(list(zip(*pivotData2['%M',sampleList[i]].values)[1]), baselineM1)] for i in xrange(len(sampleList))]))
-    EM2 = map(list,zip(*[[a - b for a, b in zip(list(zip(*pivotData2['%M',sampleList[i]].values)[2]), baselineM2)] for i in xrange(len(sampleList))]))
-    EM3 = map(list,zip(*[[a - b for a, b in zip(list(zip(*pivotData2['%M',sampleList[i]].values)[3]), baselineM3)] for i in xrange(len(sampleList))]))
+    sat = [map(calcSat,np.nanmax(cube.sampleValues('Abund',sampleList[i]),axis=1)) for i in xrange(len(sampleList))]
+    
+    # Collect EMx of every peptide, sample and isotopomer. M4 counts as no
+    # enrichment for samples without M4 data.
+    hasM4 = 'M4' in list(set(cpdReport['M'].tolist()))
+    numIsotopomers = 5 if hasM4 else 4
+    baselineMx = np.column_stack([baselineM0,baselineM1,baselineM2,baselineM3,baselineM4])[:,np.newaxis,:]
+    EMx = np.zeros((len(cube),len(sampleList),5))
+    for j in xrange(len(sampleList)):
+        samplePercentM = cube.sampleValues('%M',sampleList[j])
+        EMx[:,j,0:4] = samplePercentM[:,0:4] - baselineMx[:,0,0:4]
+        if hasM4 and cube.hasColumn('%M',sampleList[j],'M4'):
+            EMx[:,j,4] = samplePercentM[:,4] - baselineMx[:,0,4]
+    
+    # MIDA EMx of the samples, paired in the order of the Parameters Template
+    midaEMx = midaEMx[:,0:len(sampleList),:]
+    
+    def calcTheoEMx(EMx):
+        with np.errstate(divide='ignore',invalid='ignore'):
+            return np.where(midaEMx!=0,EMx/midaEMx,np.nan)
     
-    if 'M4' in list(set(cpdReport['M'].tolist())):
-        EM4 = map(list,zip(*[[a - b for a, b in zip(list(zip(*pivotData2['%M',sampleList[i]].values)[4]), baselineM4)] if ('%M',sampleList[i],'M4') in pivotData2.columns else [0 for a, b in zip(list(zip(*pivotData2['%M',sampleList[0]].values)[0]), baselineM4)] for i in xrange(len(sampleList))]))
-    else:
-        EM4 = map(list,zip(*[[0 for a, b in zip(list(zip(*pivotData2['%M',sampleList[0]].values)[0]), baselineM0)] for i in xrange(len(sampleList))]))
-    
-    # Calculate Theoretical Mx
-    theoEM0 = [[c/t if t!=0 else np.nan for c,t in zip(EM0[i],midaEM0[i])] for i in xrange(len(EM0))]
-    theoEM1 = [[c/t if t!=0 else np.nan for c,t in zip(EM1[i],midaEM1[i])] for i in xrange(len(EM1))]
-    theoEM2 = [[c/t if t!=0 else np.nan for c,t in zip(EM2[i],midaEM2[i])] for i in xrange(len(EM2))]
-    theoEM3 = [[c/t if t!=0 else np.nan for c,t in zip(EM3[i],midaEM3[i])] for i in xrange(len(EM3))]
-    if 'M4' in list(set(cpdReport['M'].tolist())):
-        theoEM4 = [[c/t if t!=0 else np.nan for c,t in zip(EM4[i],midaEM4[i])] for i in xrange(len(EM4))]
-    #else:
-    #    theoEM4 = ['']*len(theoEM0)
-
     # Calculate Observed Mx
-    M0obs = [map(lambda x:x+baselineM0[i], EM0[i]) for i in xrange(len(EM0))]
-    M1obs = [map(lambda x:x+baselineM1[i], EM1[i]) for i in xrange(len(EM1))]
-    M2obs = [map(lambda x:x+baselineM2[i], EM2[i]) for i in xrange(len(EM2))]
-    M3obs = [map(lambda x:x+baselineM3[i], EM3[i]) for i in xrange(len(EM3))]
-    if 'M4' in list(set(cpdReport['M'].tolist())):
-        M4obs = [map(lambda x:x+baselineM4[i], EM4[i]) for i in xrange(len(EM4))]
+    Mxobs = EMx + baselineMx
     
     # Perform Offset Correction
     if len(offsetSlope) == 1:
-        fitSlope = [[offsetSlope[0]]*len(sampleList)]*len(EM0)
-        fitIntercept = [[offsetIntercept[0]]*len(sampleList)]*len(EM0)
+        fitSlope = np.empty((len(cube),len(sampleList)))
+        fitSlope[:] = offsetSlope[0]
+        fitIntercept = np.empty((len(cube),len(sampleList)))
+        fitIntercept[:] = offsetIntercept[0]
     elif len(offsetSlope) == 4:
-        fitSlope = map(list,zip(*[map(lambda x:offsetSlope[0]*np.log2(x)**3 + offsetSlope[1]*np.log2(x)**2 + offsetSlope[2]*np.log2(x) + offsetSlope[3], sumAbund[i]) for i in xrange(len(sampleList))]))
-        fitIntercept = map(list,zip(*[map(lambda x:offsetIntercept[0]*np.log2(x)**3 + offsetIntercept[1]*np.log2(x)**2 + offsetIntercept[2]*np.log2(x) + offsetIntercept[3], sumAbund[i]) for i in xrange(len(sampleList))]))
+        logAbund = np.log2(np.asarray(sumAbund,dtype=float).reshape(len(sampleList),len(cube)).T)
+        fitSlope = offsetSlope[0]*np.power(logAbund,3.0) + offsetSlope[1]*np.power(logAbund,2.0) + offsetSlope[2]*logAbund + offsetSlope[3]
+        fitIntercept = offsetIntercept[0]*np.power(logAbund,3.0) + offsetIntercept[1]*np.power(logAbund,2.0) + offsetIntercept[2]*logAbund + offsetIntercept[3]
     elif len(offsetSlope) == 0:
-        fitSlope = [1]*len(EM0)
-        fitIntercept = [0]*len(EM0)  
-    
-    # Re-Calculate Corrected Mx with Offset Correction
-    M0cor = [map(lambda x,y,z:((x+baselineM0[i])-y)/z, EM0[i],fitIntercept[i],fitSlope[i]) for i in xrange(len(EM0))]
-    M1cor = [map(lambda x,y,z:((x+baselineM1[i])-y)/z, EM1[i],fitIntercept[i],fitSlope[i]) for i in xrange(len(EM1))]
-    M2cor = [map(lambda x,y,z:((x+baselineM2[i])-y)/z, EM2[i],fitIntercept[i],fitSlope[i]) for i in xrange(len(EM2))]
-    M3cor = [map(lambda x,y,z:((x+baselineM3[i])-y)/z, EM3[i],fitIntercept[i],fitSlope[i]) for i in xrange(len(EM3))]
-    if 'M4' in list(set(cpdReport['M'].tolist())):
-        M4cor = [map(lambda x,y,z:((x+baselineM4[i])-y)/z, EM4[i],fitIntercept[i],fitSlope[i]) for i in xrange(len(EM4))]
-    
-    def squareFunc(a):
-        return a**2
-    
-    # Re-Calculate EMx with Offset Correction
-    EM0 = [map(lambda x:x-baselineM0[i], M0cor[i]) for i in xrange(len(M0cor))]
-    EM1 = [map(lambda x:x-baselineM1[i], M1cor[i]) for i in xrange(len(M1cor))]
-    EM2 = [map(lambda x:x-baselineM2[i], M2cor[i]) for i in xrange(len(M2cor))]
-    EM3 = [map(lambda x:x-baselineM3[i], M3cor[i]) for i in xrange(len(M3cor))]
-    if 'M4' in list(set(cpdReport['M'].tolist())):
-        EM4 = [map(lambda x:x-baselineM4[i], M4cor[i]) for i in xrange(len(M4cor))]
-    
-    # Re-Calculate Theoretical EMx with Offset Correction
-    theoEM0 = [[c/t if t!=0 else np.nan for c,t in zip(EM0[i],midaEM0[i])] for i in xrange(len(EM0))]
-    theoEM1 = [[c/t if t!=0 else np.nan for c,t in zip(EM1[i],midaEM1[i])] for i in xrange(len(EM1))]
-    theoEM2 = [[c/t if t!=0 else np.nan for c,t in zip(EM2[i],midaEM2[i])] for i in xrange(len(EM2))]
-    theoEM3 = [[c/t if t!=0 else np.nan for c,t in zip(EM3[i],midaEM3[i])] for i in xrange(len(EM3))]
-    if 'M4' in list(set(cpdReport['M'].tolist())):
-        theoEM4 = [[c/t if t!=0 else np.nan for c,t in zip(EM4[i],midaEM4[i])] for i in xrange(len(EM4))]
-
-    # Calculate RMS Error
-    rmsError = []
-    dummyMass = zip(*[list(zip(*pivotData2['Mass',sampleList[i]].values)[0]) for i in xrange(len(sampleList))])
-    for i in xrange(len(EM0)):
-        dummyData = zip(*[EM0[i],EM1[i],EM2[i],EM3[i],EM4[i]])         
-        rmsError.append([np.sqrt(np.nansum(map(squareFunc,dummyData[j]))/5) if dummyMass[i][j]>2400 else np.sqrt(np.nansum(map(squareFunc,dummyData[j][0:4]))/4) for j in xrange(len(dummyData))])    
+        fitSlope = np.ones((len(cube),len(sampleList)))
+        fitIntercept = np.zeros((len(cube),len(sampleList)))
+    else:
+        raise ValueError('Offset correction needs 0, 1 or 4 coefficients, got '+str(offsetSlope))
+    
+    # Re-Calculate Corrected Mx and EMx with Offset Correction
+    Mxcor = ((EMx + baselineMx) - fitIntercept[:,:,np.newaxis])/fitSlope[:,:,np.newaxis]
+    EMx[:,:,0:numIsotopomers] = Mxcor[:,:,0:numIsotopomers] - baselineMx[:,:,0:numIsotopomers]
+    theoEMx = calcTheoEMx(EMx)
+
+    # Calculate RMS Error, over M0 to M4 above 2400 amu and M0 to M3 below
+    firstMass = np.column_stack([cube.sampleValues('Mass',sampleList[j])[:,0] for j in xrange(len(sampleList))]).reshape(len(cube),-1)
+    squaredEMx = np.power(EMx,2.0)
+    with np.errstate(invalid='ignore'):
+        rmsError = np.where(firstMass>2400,np.sqrt(np.nansum(squaredEMx,axis=2)/5),np.sqrt(np.nansum(squaredEMx[:,:,0:4],axis=2)/4))
     
     # Calculate Retention Time
-    newRt = map(list,zip(*[[pivotData2['Rt',sampleList[i]].iloc[j][3] for i in xrange(len(sampleList))] for j in xrange(len(pivotData2))]))
+    newRt = [list(cube.sampleValues('Rt',sampleList[i])[:,3]) for i in xrange(len(sampleList))]
         
     ######################
     # Define Dictionary to output data
-    if 'M4' in list(set(cpdReport['M'].tolist())):
-        columnsToInsert = OrderedDict([
-            ('RMS Error', map(list,zip(*rmsError))),
-            ('RT', newRt),
-            ('Sum Abund', sumAbund),
-            ('sat', sat),
-            ('Base Pk Abund', map(list,zip(*basePkAbund))),
-            ('EM0', map(list,zip(*EM0))),
-            ('%Theo EM0', map(list,zip(*theoEM0))),
-            ('MIDA EM0', map(list,zip(*midaEM0))),
-            ('EM1', map(list,zip(*EM1))),
-            ('%Theo EM1', map(list,zip(*theoEM1))),
-            ('MIDA EM1', map(list,zip(*midaEM1))),
-            ('EM2', map(list,zip(*EM2))),
-            ('%Theo EM2', map(list,zip(*theoEM2))),
-            ('MIDA EM2', map(list,zip(*midaEM2))),
-            ('EM3', map(list,zip(*EM3))),
-            ('%Theo EM3', map(list,zip(*theoEM3))),
-            ('MIDA EM3', map(list,zip(*midaEM3))),
-            ('EM4', map(list,zip(*EM4))),
-            ('%Theo EM4', map(list,zip(*theoEM4))),
-            ('MIDA EM4', map(list,zip(*midaEM4))),
-            ('M0_obs', map(list,zip(*M0obs))),
-            ('M1_obs', map(list,zip(*M1obs))),
-            ('M2_obs', map(list,zip(*M2obs))),
-            ('M3_obs', map(list,zip(*M3obs))),
-            ('M4_obs', map(list,zip(*M4obs))),
-            ('M0_cor', map(list,zip(*M0cor))),
-            ('M1_cor', map(list,zip(*M1cor))),
-            ('M2_cor', map(list,zip(*M2cor))),
-            ('M3_cor', map(list,zip(*M3cor))),
-            ('M4_cor', map(list,zip(*M4cor)))])
-    else:
-        columnsToInsert = OrderedDict([
-            ('RMS Error', map(list,zip(*rmsError))),
-            ('RT', newRt),
-            ('Sum Abund', sumAbund),
-            ('sat', sat),
-            ('Base Pk Abund', map(list,zip(*basePkAbund))),
-            ('EM0', map(list,zip(*EM0))),
-            ('%Theo EM0', map(list,zip(*theoEM0))),
-            ('MIDA EM0', map(list,zip(*midaEM0))),
-            ('EM1', map(list,zip(*EM1))),
-            ('%Theo EM1', map(list,zip(*theoEM1))),
-            ('MIDA EM1', map(list,zip(*midaEM1))),
-            ('EM2', map(list,zip(*EM2))),
-            ('%Theo EM2', map(list,zip(*theoEM2))),
-            ('MIDA EM2', map(list,zip(*midaEM2))),
-            ('EM3', map(list,zip(*EM3))),
-            ('%Theo EM3', map(list,zip(*theoEM3))),
-            ('MIDA EM3', map(list,zip(*midaEM3))),
-            ('M0_obs', map(list,zip(*M0obs))),
-            ('M1_obs', map(list,zip(*M1obs))),
-            ('M2_obs', map(list,zip(*M2obs))),
-            ('M3_obs', map(list,zip(*M3obs))),
-            ('M0_cor', map(list,zip(*M0cor))),
-            ('M1_cor', map(list,zip(*M1cor))),
-            ('M2_cor', map(list,zip(*M2cor))),
-            ('M3_cor', map(list,zip(*M3cor)))])
+    columnsToInsert = OrderedDict([
+        ('RMS Error', rmsError.T),
+        ('RT', newRt),
+        ('Sum Abund', sumAbund),
+        ('sat', sat),
+        ('Base Pk Abund', map(list,zip(*basePkAbund)))])
+    for k in xrange(numIsotopomers):
+        columnsToInsert['EM'+str(k)] = EMx[:,:,k].T
+        columnsToInsert['%Theo EM'+str(k)] = theoEMx[:,:,k].T
+        columnsToInsert['MIDA EM'+str(k)] = midaEMx[:,:,k].T
+    for k in xrange(numIsotopomers):
+        columnsToInsert['M'+str(k)+'_obs'] = Mxobs[:,:,k].T
+    for k in xrange(numIsotopomers):
+        columnsToInsert['M'+str(k)+'_cor'] = Mxcor[:,:,k].T
     
     for i in xrange(len(columnsToInsert)):
         for j in xrange(len(sampleList)):
@@ -741,7 +1316,7 @@ def generateSummaryFile(sampleList,midaDB,sortedTab,bodyWaterInput,silacMasses,s
     # Add body wter data to dataframe
     for i in xrange(len(sampleList)):
         headers = ['BW'+' - '+sampleList[j] for j in xrange(len(sampleList))]
-        summaryTable[headers[i]] =  map(list,zip(*[bwList] * len(pivotData2)))[i]  
+        summaryTable[headers[i]] =  map(list,zip(*[bwList] * len(cube)))[i]  
     
     summaryTable = summaryTable.rename(columns = {'All Swissprot IDs':'All Acc #s','AAstart+seq':'Sequence'})
     
@@ -749,14 +1324,120 @@ def generateSummaryFile(sampleList,midaDB,sortedTab,bodyWaterInput,silacMasses,s
     return summaryTable, map(list,zip(*basePkAbund)), summaryTablev2,sampleList
 
 # Generate Data Filter   
+# Mean and sample standard deviation of every row, skipping NaN. The values of
+# each row are moved to the front and added in order, like np.mean and np.std
+# add up to 7 values, so the results are the same. Longer rows use np.std.
+def rowMeanStdDev(values):
+    values = np.asarray(values,dtype=float)
+    shape = values.shape[:-1]
+    values = values.reshape(-1,values.shape[-1])
+    missing = np.isnan(values)
+    counts = values.shape[1]-missing.sum(axis=1)
+    order = np.argsort(missing,axis=1,kind='mergesort')
+    compact = values[np.arange(len(values))[:,np.newaxis],order]
+    width = min(values.shape[1],7)
+    valid = np.arange(width)[np.newaxis,:] < counts[:,np.newaxis]
+    
+    means = np.zeros(len(values))
+    squares = np.zeros(len(values))
+    with np.errstate(invalid='ignore',divide='ignore'):
+        for k in xrange(width):
+            means += np.where(valid[:,k],compact[:,k],0)
+        means = means/counts
+        for k in xrange(width):
+            deviation = np.where(valid[:,k],compact[:,k]-means,0)
+            squares += deviation*deviation
+        stdDevs = np.sqrt(squares/(counts-1))
+    stdDevs[counts<=1] = np.nan
+    for i in np.flatnonzero(counts>7):
+        means[i] = np.mean(compact[i,0:counts[i]])
+        stdDevs[i] = np.std(compact[i,0:counts[i]],ddof=1)
+    return means.reshape(shape), stdDevs.reshape(shape)
+
+# Peptides of every protein, sorted by accession once. Protein statistics of
+# samples x peptides values are computed over a proteins x samples x peptides
+# block, skipping NaN and adding values in table order, like groupby does.
+class ProteinGroups(object):
+    
+    def __init__(self, accessions):
+        self.codes, self.accessions = pd.factorize(np.asarray(accessions,dtype=object),sort=True)
+        rows = np.flatnonzero(self.codes>=0)
+        self.order = rows[np.argsort(self.codes[rows],kind='mergesort')]
+        self.sizes = np.bincount(self.codes[rows],minlength=len(self.accessions))
+        self.starts = np.cumsum(self.sizes)-self.sizes
+        # Proteins in the order of their first peptide
+        self.firstSeen = np.argsort(self.order[self.starts],kind='mergesort')
+    
+    def __len__(self):
+        return len(self.accessions)
+    
+    # Gather samples x peptides values into proteins x samples x peptides,
+    # padded with NaN
+    def block(self, values):
+        values = np.asarray(values,dtype=float)
+        block = np.empty((len(self),len(values),max(self.sizes.max(),1)))
+        block[:] = np.nan
+        for k in xrange(self.sizes.max()):
+            hasK = self.sizes > k
+            block[hasK,:,k] = values[:,self.order[self.starts[hasK]+k]].T
+        return block
+    
+    # Spread proteins x samples statistics back to samples x peptides
+    def toPeptides(self, stats):
+        return np.where(self.codes[np.newaxis,:]>=0,stats[self.codes].T,np.nan)
+    
+    # Number of values of every protein and sample
+    def count(self, block):
+        return (~np.isnan(block)).sum(axis=2)
+    
+    def mean(self, block):
+        sums = np.zeros(block.shape[0:2])
+        for k in xrange(block.shape[2]):
+            sums += np.where(np.isnan(block[:,:,k]),0,block[:,:,k])
+        with np.errstate(invalid='ignore',divide='ignore'):
+            return sums/self.count(block)
+    
+    # Sample standard deviation, updated one value at a time
+    def std(self, block):
+        counts = np.zeros(block.shape[0:2])
+        means = np.zeros(block.shape[0:2])
+        squares = np.zeros(block.shape[0:2])
+        with np.errstate(invalid='ignore',divide='ignore'):
+            for k in xrange(block.shape[2]):
+                hasValue = ~np.isnan(block[:,:,k])
+                counts += hasValue
+                oldMeans = means
+                means = np.where(hasValue,oldMeans+(block[:,:,k]-oldMeans)/counts,oldMeans)
+                squares = np.where(hasValue,squares+(block[:,:,k]-means)*(block[:,:,k]-oldMeans),squares)
+            return np.where(counts>=2,np.sqrt(squares/(counts-1)),np.nan)
+    
+    # Median, from the values sorted with NaN last
+    def median(self, block):
+        counts = self.count(block).ravel()
+        ordered = np.sort(block,axis=2).reshape(len(counts),-1)
+        rows = np.arange(len(counts))
+        lower = ordered[rows,np.maximum(counts-1,0)//2]
+        upper = ordered[rows,counts//2]
+        medians = np.where(counts%2==1,lower,(upper+lower)/2)
+        return np.where(counts>0,medians,np.nan).reshape(block.shape[0:2])
+
+# Stack the columns of every sample into a samples x peptides x columns array,
+# padded with NaN where a sample has fewer columns
+def sampleColumnBlock(sTable,columnLists):
+    block = np.empty((len(columnLists),len(sTable),max(len(i) for i in columnLists)))
+    block[:] = np.nan
+    for k in xrange(len(columnLists)):
+        block[k,:,0:len(columnLists[k])] = sTable[columnLists[k]].values.astype(float)
+    return block
+
 def generateDataFilter(sTable, sampleList, basePkAbund,basePkAbundFilter,em0UpperLimit,em0LowerLimit,isotopomerSDFilter,minMIDAforEMx,peptideSDFilter,RMSEFilter,useAllIsotopomers,saturation):
     dataFilter = sTable.ix[0:,3:13]
     dataFilter.columns = [str(i) for i in dataFilter.columns]
     
     df2 = sTable.copy()
-    # Extract Isotopomer data
+    # Extract Isotopomer data as samples x peptides x isotopomers
     
-    isotopomerData = [[i for i in sTable[[j for j in sTable.columns if j.find(str(sampleList[k]))!=-1 and j.find("%Theo")!=-1]].values] for k in xrange(len(sampleList))]
+    isotopomerData = sampleColumnBlock(sTable,[[j for j in sTable.columns if j.find(str(sampleList[k]))!=-1 and j.find("%Theo")!=-1] for k in xrange(len(sampleList))])
     #isotopomerData = [[i for i in sTable[[j for j in sTable.columns if j.find(str(sampleList[k]))!=-1 and j.find("EM")!=-1 and j.find("EM")!=-1 and j.find('MIDA')==-1 and j.find('cubic')==-1 and j.find('Theo')==-1]].values] for k in xrange(len(sampleList))]
     
     ### Optional code to perform calculations for control samples
@@ -768,72 +1449,81 @@ def generateDataFilter(sTable, sampleList, basePkAbund,basePkAbundFilter,em0Uppe
     ##    if len([i for i in sampleList if i.upper().find("CONTROL")!=-1])>0:
     ##        minControlRMSE = map(np.nanmin,[i for i in sTable[[j for j in sTable.columns if j.upper().find("CONTROL")!=-1 and j.find("RMS Error")!=-1]].values])
     ##    else:
-    minControlRMSE = [np.nan]*len(isotopomerData[0])
-    
-    isoMIDA = [[i for i in sTable[[j for j in sTable.columns if j.find(sampleList[k])!=-1 and j.find("MIDA")!=-1]].values] for k in xrange(len(sampleList))]
-    
-    # Filter isotopomer data
-    for i in xrange(len(isotopomerData)):
-        for j in xrange(len(isotopomerData[i])):
-            if basePkAbund[i][j]<basePkAbundFilter or saturation[i][j]==1 or np.greater(isotopomerData[i][j][0],em0UpperLimit) or np.less_equal(isotopomerData[i][j][0],em0LowerLimit) or minControlRMSE[j]>=RMSEFilter:
-                isotopomerData[i][j][0:] = [np.nan]*len(isotopomerData[i][j])
-            elif abs(isoMIDA[i][j][1])<abs(minMIDAforEMx[i]) or saturation[i][j]==1:
-                isotopomerData[i][j][1] = np.nan
-            elif abs(isoMIDA[i][j][2])<abs(minMIDAforEMx[i]) or saturation[i][j]==1:
-                isotopomerData[i][j][2] = np.nan
-            elif abs(isoMIDA[i][j][3])<abs(minMIDAforEMx[i]) or saturation[i][j]==1:
-                isotopomerData[i][j][3] = np.nan
+    minControlRMSE = np.array([np.nan]*len(sTable))
+    
+    isoMIDA = sampleColumnBlock(sTable,[[j for j in sTable.columns if j.find(sampleList[k])!=-1 and j.find("MIDA")!=-1] for k in xrange(len(sampleList))])
+    
+    # Filter isotopomer data. Peptides failing the sample filters lose all
+    # isotopomers, otherwise only the first of EM1 to EM3 with too low a MIDA
+    # EMx is dropped.
+    basePkAbund = np.asarray(basePkAbund,dtype=float)
+    saturation = np.asarray(saturation,dtype=float)
+    minMIDA = np.abs(np.asarray(minMIDAforEMx[0:len(sampleList)],dtype=float))[:,np.newaxis]
+    with np.errstate(invalid='ignore'):
+        rejectPeptide = (basePkAbund<basePkAbundFilter) | (saturation==1) | (isotopomerData[:,:,0]>em0UpperLimit) | (isotopomerData[:,:,0]<=em0LowerLimit) | (minControlRMSE>=RMSEFilter)[np.newaxis,:]
+        lowMIDA = np.abs(isoMIDA[:,:,1:4]) < minMIDA[:,:,np.newaxis]
+    rejectEM1 = ~rejectPeptide & lowMIDA[:,:,0]
+    rejectEM2 = ~rejectPeptide & ~lowMIDA[:,:,0] & lowMIDA[:,:,1]
+    rejectEM3 = ~rejectPeptide & ~lowMIDA[:,:,0] & ~lowMIDA[:,:,1] & lowMIDA[:,:,2]
+    isotopomerData[rejectPeptide] = np.nan
+    isotopomerData[:,:,1][rejectEM1] = np.nan
+    isotopomerData[:,:,2][rejectEM2] = np.nan
+    isotopomerData[:,:,3][rejectEM3] = np.nan
     
     # Calculate isotopomer distribution    
-    isotopomerSD = [[np.std([a for a,a in enumerate(isotopomerData[j][i]) if np.isnan(a)==False],ddof=1)  for i in xrange(len(isotopomerData[j]))] for j in xrange(len(isotopomerData))]
+    isotopomerMean, isotopomerSD = rowMeanStdDev(isotopomerData)
     
     if useAllIsotopomers ==False:
-        filteredAvgF = [[isotopomerData[j][i][0] if isotopomerSD[j][i]<isotopomerSDFilter else np.nan for i in xrange(len(isotopomerData[j]))] for j in xrange(len(isotopomerData))]
-        filteredAvgFraw = [[isotopomerData[j][i][0] for i in xrange(len(isotopomerData[j]))] for j in xrange(len(isotopomerData))]
-        
+        filteredAvgFraw = isotopomerData[:,:,0]
+    
     if useAllIsotopomers ==True:
-        filteredAvgF = [[np.mean([a for a,a in enumerate(isotopomerData[j][i]) if np.isnan(a)==False]) if isotopomerSD[j][i]<isotopomerSDFilter else np.nan for i in xrange(len(isotopomerData[j]))] for j in xrange(len(isotopomerData))]
-        filteredAvgFraw = [[np.mean([a for a,a in enumerate(isotopomerData[j][i]) if np.isnan(a)==False]) for i in xrange(len(isotopomerData[j]))] for j in xrange(len(isotopomerData))]
+        filteredAvgFraw = isotopomerMean
+    
+    with np.errstate(invalid='ignore'):
+        filteredAvgF = np.where(isotopomerSD<isotopomerSDFilter,filteredAvgFraw,np.nan)
         
+    headers = ['Filtered Avg f'+' - '+sampleList[j] for j in xrange(len(sampleList))]
+    headers1 = ['Avg f'+' - '+sampleList[j] for j in xrange(len(sampleList))]
+    headers1b = ['Isotopomer SD'+' - '+sampleList[j] for j in xrange(len(sampleList))]
     for i in xrange(len(sampleList)):
-        headers = ['Filtered Avg f'+' - '+sampleList[j] for j in xrange(len(sampleList))]
         df2[headers[i]] = filteredAvgF[i]
-
     for i in xrange(len(sampleList)):
-        headers1 = ['Avg f'+' - '+sampleList[j] for j in xrange(len(sampleList))]
         df2[headers1[i]] = filteredAvgFraw[i]
-    
     for i in xrange(len(sampleList)):
-        headers1b = ['Isotopomer SD'+' - '+sampleList[j] for j in xrange(len(sampleList))]
         df2[headers1b[i]] = isotopomerSD[i]
-        
-    def getSDF(x):
-        return [i for i in x if np.isnan(i)==False][0] if len([i for i in x if np.isnan(i)==False])==1 else np.std([i for i in x if np.isnan(i)==False],ddof=1)
-
-    # Calculate Protein Average f and standard deviation
-    accessionNumbers = np.sort(list(set(df2['Accession#'])))
-    proteinAverageF = pd.DataFrame(data=map(list,zip(*[df2[headers[i]].groupby(df2['Accession#'],sort=True).mean().values for i in xrange(len(headers))])),index=accessionNumbers,columns=['Protein Avg f'+' - '+sampleList[j] for j in xrange(len(sampleList))])
-    proteinStdDevF = pd.DataFrame(data=map(list,zip(*[map(getSDF,df2[headers[i]].groupby(df2['Accession#'],sort=True).values) for i in xrange(len(headers))])),index=accessionNumbers,columns=['Peptide SD f'+' - '+sampleList[j] for j in xrange(len(sampleList))])
-    testDataFrame = pd.merge(df2,proteinAverageF,left_on='Accession#',right_index=True,how='left',sort=False)
-    testDataFrame2 = pd.merge(testDataFrame,proteinStdDevF,left_on='Accession#',right_index=True,how='left',sort=False)
 
+    # Calculate Protein Average f and standard deviation of every peptide's
+    # protein. A protein with a single f uses that f as its standard deviation.
     headers2 = ['Protein Avg f'+' - '+sampleList[j] for j in xrange(len(sampleList))]
     headers3 = ['Peptide SD f'+' - '+sampleList[j] for j in xrange(len(sampleList))]
+    proteins = ProteinGroups(df2['Accession#'].values)
+    peptideF = proteins.block(filteredAvgF)
+    proteinAverageF = proteins.toPeptides(proteins.mean(peptideF))
+    proteinStdDevF = proteins.toPeptides(np.where(proteins.count(peptideF)==1,np.nansum(peptideF,axis=2),rowMeanStdDev(peptideF)[1]))
+    
+    testDataFrame2 = df2.copy()
+    for i in xrange(len(sampleList)):
+        testDataFrame2[headers2[i]] = proteinAverageF[i]
+    for i in xrange(len(sampleList)):
+        testDataFrame2[headers3[i]] = proteinStdDevF[i]
 
     # Calculate Filtered Average f
-    filteredF2 = [[testDataFrame2[headers[i]][j] if np.less_equal(testDataFrame2[headers[i]][j],testDataFrame2[headers2[i]][j]+(peptideSDFilter*testDataFrame2[headers3[i]][j])) and np.greater_equal(testDataFrame2[headers[i]][j],testDataFrame2[headers2[i]][j]-(peptideSDFilter*testDataFrame2[headers3[i]][j])) else np.nan for i in xrange(len(sampleList))] for j in xrange(len(testDataFrame2))]
+    with np.errstate(invalid='ignore'):
+        insideSD = (filteredAvgF<=proteinAverageF+(peptideSDFilter*proteinStdDevF)) & (filteredAvgF>=proteinAverageF-(peptideSDFilter*proteinStdDevF))
+    filteredF2 = np.where(insideSD,filteredAvgF,np.nan)
 
-    dummy1 = map(list,zip(*filteredF2))
+    headers4 = ['Filtered Avg f2'+' - '+sampleList[j] for j in xrange(len(sampleList))]
     for i in xrange(len(sampleList)):
-        headers4 = ['Filtered Avg f2'+' - '+sampleList[j] for j in xrange(len(sampleList))]
-        testDataFrame2[headers4[i]] = dummy1[i]
+        testDataFrame2[headers4[i]] = filteredF2[i]
 
     groupedByProtein = pd.DataFrame(testDataFrame2.groupby(testDataFrame2['Accession#'],axis=0,sort=False).first())
     groupedByProtein = groupedByProtein.drop(['n','Charge'],axis=1).reset_index(drop=True)
 
-    averageF = [testDataFrame2[headers4[i]].groupby(testDataFrame2['Accession#'],sort=False).median().round(3).values for i in xrange(len(headers))]
-    stddevF = [testDataFrame2[headers4[i]].groupby(testDataFrame2['Accession#'],sort=False).std().round(3).values for i in xrange(len(headers))]
-    countF = [testDataFrame2[headers4[i]].groupby(testDataFrame2['Accession#'],sort=False).count().values for i in xrange(len(headers))]
+    # Protein statistics of the filtered f, in the order of groupedByProtein
+    peptideF2 = proteins.block(filteredF2)[proteins.firstSeen]
+    averageF = np.round(proteins.median(peptideF2),3).T
+    stddevF = np.round(proteins.std(peptideF2),3).T
+    countF = proteins.count(peptideF2).T
     
     proteinColumns = OrderedDict([
         ('Protein f',averageF),
@@ -849,7 +1539,8 @@ def generateDataFilter(sTable, sampleList, basePkAbund,basePkAbundFilter,em0Uppe
     del groupedByProtein['Mass']
     del groupedByProtein['Fraction']    
     
-    groupedByProtein.insert(4,'Mean Peptide Count',[np.round(np.mean([x for x in map(list,zip(*countF))[i] if x>0]),1) for i in xrange(len(groupedByProtein))])
+    with np.errstate(invalid='ignore'):
+        groupedByProtein.insert(4,'Mean Peptide Count',np.round(np.where(countF>0,countF,0).sum(axis=0)/(countF>0).sum(axis=0),1))
     ##    if len([i for i in sampleList if i.upper().find("CONTROL")!=-1])>0:
     ##        testDataFrame2.insert(11,'Min Control RMSE',minControlRMSE)
     ##        peptideColumns = ['Species','Code','Protein','Accession#','Sequence','Modifications','Mass','n','Charge','Fraction','Target RT','Min Control RMSE']+headers4
@@ -1101,28 +1792,325 @@ def formatExcel(fileName,numSheets,nPeptides,nProteins,nSamples,workSheetA,workS
     wb.save(fileName)
 
 # Functions to match and sort compound report to sample names
-def getFullSamples(fName,sName):
-    c = ['']*len(fName)
-    for i in range(len(fName)):
-        for j in range(len(sName)):
-            if fName[i].find(sName[j][0:len(sName[j])-sName[j][::-1].find('-')-1])!=-1 and fName[i].find(sName[j][-5:])!=-1 and sName[j].find(fName[i][fName[i].find('_D')+2:fName[i].find('_MS')])!=-1:
-                c[i]= sName[j]
-    return c
-    
-def getFullSamples2(fName,sName):
-    dummy = []
-    dummy2 = []
-    for i in xrange(len(sName)):
-        for j in xrange(len(fName)):
-            if sName[i][-5:]==fName[j][0:5] and sName[i][0:(len(sName[i])-1-sName[i][::-1].find('-'))]==fName[j][::-1][fName[j][::-1].find('SM_')+3:fName[j][::-1].find('D_')][::-1]:
-                dummy.append(sName[i])
-                dummy2.append(fName[j])
-    return dummy, dummy2
+
+# Matching tokens of a Compound Report file name: its first five characters
+# (the species) and the sample between the last '_D' and the last '_MS'. The
+# subject code, timepoint and fraction are not matched on their own, only as
+# part of these two tokens, like the original name comparison. Returns None for
+# file names without a sample.
+def sampleFileKey(fileName):
+    sampleStart = fileName.rfind('_D')
+    sampleEnd = fileName.rfind('_MS')
+    if sampleStart == -1 or sampleEnd == -1:
+        return None
+    return fileName[0:5], fileName[sampleStart+2:sampleEnd]
+
+# Matching tokens of a Parameters Template sample name '<sample>-<species>'
+def sampleNameKey(sampleName):
+    sampleEnd = sampleName.rfind('-') if '-' in sampleName else len(sampleName)
+    return sampleName[-5:], sampleName[0:sampleEnd]
+
+# Match Compound Report file names to Parameters Template sample names through
+# an index of the file name tokens. Returns the matched samples and files, in
+# sample order. Samples and files without a match are reported and skipped.
+# Ambiguous matches raise a ValueError before any Compound Report is converted.
+def matchSamplesToFiles(fileNames,sampleNames):
+    fileIndex = OrderedDict()
+    for fileName in fileNames:
+        fileIndex.setdefault(sampleFileKey(fileName),[]).append(fileName)
+    
+    matchedSamples = []
+    matchedFiles = []
+    ambiguous = []
+    samplesOfFile = OrderedDict((i,set()) for i in fileNames)
+    for sampleName in sampleNames:
+        sampleFiles = fileIndex.get(sampleNameKey(sampleName),[])
+        if len(sampleFiles) == 0:
+            print '*** NO COMPOUND REPORT MATCHES SAMPLE '+sampleName+'! ***'
+        elif len(sampleFiles) > 1:
+            print '*** SAMPLE '+sampleName+' MATCHES '+str(len(sampleFiles))+' COMPOUND REPORTS: '+', '.join(sampleFiles)+'! ***'
+            ambiguous.append(sampleName+' -> '+', '.join(sampleFiles))
+        for fileName in sampleFiles:
+            matchedSamples.append(sampleName)
+            matchedFiles.append(fileName)
+            samplesOfFile[fileName].add(sampleName)
+    
+    for fileName, fileSamples in samplesOfFile.items():
+        if len(fileSamples) == 0:
+            print '*** NO SAMPLE IN PARAMETERS TEMPLATE MATCHES COMPOUND REPORT '+fileName+'! ***'
+        elif len(fileSamples) > 1:
+            print '*** COMPOUND REPORT '+fileName+' MATCHES '+str(len(fileSamples))+' SAMPLES: '+', '.join(sorted(fileSamples))+'! ***'
+            ambiguous.append(fileName+' -> '+', '.join(sorted(fileSamples)))
+    if ambiguous:
+        raise ValueError('Ambiguous Compound Report matches: '+'; '.join(ambiguous))
+    return matchedSamples, matchedFiles
 
 ################################################################################
 
-# Main loop
-def main(fileLoc):
+# Checkpoints of the stages of main, kept in the project folder. Bump the
+# version whenever the checkpointed values change.
+checkpointFolder = 'Checkpoints'
+checkpointVersion = 1
+
+# Get the checkpoint file of a stage
+def getCheckpointFile(fileLoc, stage):
+    return os.path.join(fileLoc, checkpointFolder, stage+'.checkpoint.npz')
+
+# Get the key of the checkpoints for the contents of the input files
+def getCheckpointKey(inputFiles, scriptVersion):
+    inputHash = hashlib.sha1(','.join(fileContentHash(i) for i in inputFiles)).hexdigest()
+    return np.array([inputHash, scriptVersion, str(checkpointVersion), str(reportCacheVersion)])
+
+# Write the values made by a stage to its checkpoint. Tables are stored by
+# packColumns, dictionaries as their items and other values as their repr,
+# so no pickling is needed.
+def saveCheckpoint(checkpointFile, checkpointKey, values):
+    arrays = {'key': checkpointKey, 'names': np.array(values.keys()), 'kinds': np.array(['']*len(values), dtype='S7'), 'values': np.array(['']*len(values), dtype=object)}
+    for i, name in enumerate(values):
+        if isinstance(values[name], pd.DataFrame):
+            arrays['kinds'][i] = 'table'
+            packColumns(values[name], arrays, 'table%i' % i)
+        elif isinstance(values[name], dict):
+            arrays['kinds'][i] = 'dict'
+            arrays['values'][i] = repr(values[name].items())
+        else:
+            arrays['kinds'][i] = 'literal'
+            arrays['values'][i] = repr(values[name])
+    arrays['values'] = arrays['values'].astype(str)
+    writeCacheFile(checkpointFile, arrays)
+
+# Read the values of a stage back from its checkpoint. Returns None if there
+# is no checkpoint for this key.
+def loadCheckpoint(checkpointFile, checkpointKey):
+    cache = readCacheFile(checkpointFile, checkpointKey)
+    if cache is None:
+        return None
+    try:
+        values = OrderedDict()
+        for i, (name, kind) in enumerate(zip(cache['names'], cache['kinds'])):
+            if kind == 'table':
+                values[str(name)] = unpackColumns(cache, 'table%i' % i)
+            elif kind == 'dict':
+                values[str(name)] = OrderedDict(ast.literal_eval(str(cache['values'][i])))
+            else:
+                values[str(name)] = ast.literal_eval(str(cache['values'][i]))
+    except (IOError, OSError, KeyError, ValueError, SyntaxError):
+        return None
+    finally:
+        cache.close()
+    return values
+
+# Graph of pipeline stages. Every stage declares the values it needs and the
+# values it makes, and starts as soon as all of its inputs are there, so
+# independent stages run at the same time. Stages run in threads, or in worker
+# processes with process=True for CPU-bound work; the functions of those
+# stages must be defined at module level, and their values must pickle.
+class StageGraph(object):
+    
+    def __init__(self):
+        self.stages = OrderedDict()
+    
+    # Add a stage that calls function with its inputs, in order. The function
+    # returns the single output, or a tuple of the outputs if there are several.
+    def add(self, name, function, inputs=(), outputs=(), process=False):
+        if name in self.stages:
+            raise ValueError('Stage '+name+' is already in the graph')
+        self.stages[name] = (function, list(inputs), list(outputs), process)
+    
+    # Run the stages from the values that are already known, and return all of
+    # the values. Stages whose outputs are all known already are not run. The
+    # first stage to fail stops any new stages from starting, and its error is
+    # raised once the running stages are done. A pool that is passed in runs
+    # the process stages and is left open.
+    def run(self, values=None, jobs=None, pool=None):
+        values = dict(values or {})
+        known = set(values)
+        for name, (function, inputs, outputs, process) in self.stages.items():
+            known.update(outputs)
+        for name, (function, inputs, outputs, process) in self.stages.items():
+            if not known.issuperset(inputs):
+                raise ValueError('Stage '+name+' needs '+', '.join(sorted(set(inputs)-known))+', which no stage makes')
+        
+        ownPool = pool is None
+        numProcessStages = len([i for i in self.stages.values() if i[3]])
+        if ownPool and numProcessStages > 0:
+            pool = multiprocessing.Pool(min(jobs or multiprocessing.cpu_count(), numProcessStages))
+        
+        waiting = OrderedDict((name, stage) for name, stage in self.stages.items() if len(stage[2]) == 0 or not all(i in values for i in stage[2]))
+        finished = Queue.Queue()
+        running = 0
+        error = None
+        try:
+            while True:
+                if error is None:
+                    for name in [i for i in waiting if all(j in values for j in waiting[i][1])]:
+                        function, inputs, outputs, process = waiting.pop(name)
+                        stageArgs = (finished, pool if process else None, name, function, [values[i] for i in inputs])
+                        thread = threading.Thread(target=StageGraph.runStage, args=stageArgs)
+                        thread.daemon = True
+                        thread.start()
+                        running += 1
+                if running == 0:
+                    break
+                
+                # Wait in steps, since a Queue.get without a timeout can not
+                # be interrupted with Ctrl-C
+                while True:
+                    try:
+                        name, result, excInfo = finished.get(timeout=1)
+                        break
+                    except Queue.Empty:
+                        pass
+                running -= 1
+                if excInfo is not None:
+                    error = error or excInfo
+                    continue
+                outputs = self.stages[name][2]
+                if len(outputs) == 1:
+                    result = (result,)
+                values.update(zip(outputs, result if len(outputs) > 0 else ()))
+        finally:
+            if ownPool and pool is not None:
+                pool.close()
+                pool.join()
+        
+        if error is not None:
+            raise error[0], error[1], error[2]
+        if len(waiting) > 0:
+            raise ValueError('Stages '+', '.join(waiting)+' wait on each other and can never run')
+        return values
+    
+    # Run one stage in its thread, and report the result or the error. Any
+    # error is reported, SystemExit included, or run would wait for it forever.
+    @staticmethod
+    def runStage(finished, pool, name, function, args):
+        try:
+            if pool is None:
+                result = function(*args)
+            else:
+                result = pool.apply(function, args)
+        except BaseException:
+            finished.put((name, None, sys.exc_info()))
+        else:
+            finished.put((name, result, None))
+
+# Sort and write the Summary Table. Run as a pipeline stage in a worker process.
+def writeSummaryTable(stSummary3, SToutputFileName):
+    stSummary4 = stSummary3.sort(columns=['Protein','Sequence','Charge'])
+    stSummary4.to_excel(SToutputFileName, sheet_name = 'SUMMARY TABLE',index=False)
+    return SToutputFileName
+
+# Write and format the Data Filter. Run as a pipeline stage in a worker process.
+def writeDataFilter(DFoutputFileName, dfPeptides, dfProteins, parameterData, projectData, nSamples):
+    writer2 = pd.ExcelWriter(DFoutputFileName) 
+    dfPeptides.to_excel(writer2,'PEPTIDE OUTPUT',index=False) 
+    dfProteins.to_excel(writer2,'PROTEIN OUTPUT',index=False)
+    parameterData.to_excel(writer2,'PARAMETERS',index=False) 
+    projectData.to_excel(writer2,'PROJECT DETAILS',index=False) 
+    writer2.save()  
+    
+    print 'FORMATTING OUTPUT...'
+    formatExcel(DFoutputFileName,2,len(dfPeptides),len(dfProteins),nSamples,0,1)#fileName,numSheets,nPeptides,nProteins,nSamples
+    return DFoutputFileName
+
+# Number of files copied to the network at the same time
+publishJobs = 8
+
+# Folders of the analysis folder that are not copied to the network
+publishExcludedFolders = [reportCacheFolder, checkpointFolder]
+
+# Get the folder for a new copy of folderName in parentFolder, from a single
+# listing of parentFolder. If folderName is taken, the copy gets the next
+# '_VersionN' name.
+def getVersionedFolder(parentFolder, folderName):
+    existing = os.listdir(parentFolder) if os.path.isdir(parentFolder) else []
+    if folderName not in existing:
+        return os.path.join(parentFolder, folderName)
+    versionPattern = re.compile(re.escape(folderName)+r'_Version(\d+)$')
+    versions = [int(match.group(1)) for match in map(versionPattern.match, existing) if match is not None]
+    return os.path.join(parentFolder, folderName+'_Version'+str(max(versions+[0])+1))
+
+# Make the folders on the network for the copy of the analysis folder in
+# 'ExtractedResults' and for the output files in 'LCMS Results'. Folders that
+# exist already get the next '_VersionN' name.
+def makePublishFolders(src, NetworkDirectory, ProjectLeader, ProjectCode, AnalysisYear, NotebookCode):
+    CurrentFolder = os.path.basename(os.path.normpath(src))
+    CopyLocation1 = getVersionedFolder(os.path.join(NetworkDirectory,'ExtractedResults',ProjectLeader[0]+ProjectLeader.split(' ')[-1],ProjectCode,AnalysisYear),CurrentFolder)
+    CopyLocation2 = getVersionedFolder(os.path.join(NetworkDirectory,'LCMS Results',ProjectLeader,ProjectCode,AnalysisYear),NotebookCode)
+    os.makedirs(CopyLocation1)
+    os.makedirs(CopyLocation2)
+    return CopyLocation1, CopyLocation2
+
+# Rename a file over another in one step, so the destination is never missing.
+# os.rename can not replace a file on Windows, so MoveFileExW does it there.
+def replaceFile(source, destination):
+    if os.name == 'nt':
+        toUnicode = lambda i: i if isinstance(i, unicode) else i.decode(sys.getfilesystemencoding())
+        # MOVEFILE_REPLACE_EXISTING | MOVEFILE_WRITE_THROUGH
+        if not ctypes.windll.kernel32.MoveFileExW(toUnicode(source), toUnicode(destination), 0x1 | 0x8):
+            raise ctypes.WinError()
+    else:
+        os.rename(source, destination)
+
+# Copy a file to the network. The copy is written to a temporary file that
+# replaces the destination in one step, so the destination is never partly
+# written or missing, and the temporary file is removed if the copy fails.
+# Files whose size and contents match the destination are skipped. Returns
+# True if the file was copied.
+def publishFile(fileName, destination):
+    if os.path.exists(destination) and os.path.getsize(destination) == os.path.getsize(fileName) and fileContentHash(destination) == fileContentHash(fileName):
+        return False
+    try:
+        os.makedirs(os.path.dirname(destination))
+    except OSError:
+        # Made by another thread, or already there
+        if not os.path.isdir(os.path.dirname(destination)):
+            raise
+    tempFile = destination+'.'+str(os.getpid())+'.'+str(threading.current_thread().ident)+'.tmp'
+    try:
+        shutil.copy2(fileName, tempFile)
+        replaceFile(tempFile, destination)
+    except Exception:
+        excInfo = sys.exc_info()
+        try:
+            os.remove(tempFile)
+        except OSError:
+            pass
+        raise excInfo[0], excInfo[1], excInfo[2]
+    return True
+
+# Copy files to the network with a bounded pool of threads. Takes pairs of
+# file and destination, and returns the number of files that were copied. All
+# of the files of a run are passed in one call, so no more than jobs files are
+# copied at the same time.
+def publishFiles(files, jobs=publishJobs):
+    if len(files) == 0:
+        return 0
+    pool = ThreadPool(min(jobs, len(files)))
+    try:
+        copied = pool.map(lambda pair: publishFile(*pair), files)
+    finally:
+        pool.close()
+        pool.join()
+    return sum(copied)
+
+# Pairs of file and destination to copy files into a folder on the network
+def getFolderCopies(folder, *fileNames):
+    return [(i, os.path.join(folder, os.path.basename(i))) for i in fileNames]
+
+# Pairs of file and destination to copy the analysis folder to the network,
+# without the cache folders
+def getAnalysisFolderCopies(src, folder):
+    files = []
+    for dirpath, dirs, fileNames in os.walk(src):
+        dirs[:] = [i for i in dirs if i not in publishExcludedFolders]
+        files += [(os.path.join(dirpath, i), os.path.join(folder, os.path.relpath(os.path.join(dirpath, i), src))) for i in fileNames]
+    return files
+
+# Main loop. With a network directory, the output is also copied to the network.
+# With resume, the stages that have a checkpoint for the same input files are
+# not run again.
+def main(fileLoc, NetworkDirectory=None, resume=False):
     
     today = datetime.today()
     scriptVersion = "Script_v5.0"
@@ -1130,60 +2118,35 @@ def main(fileLoc):
     print 'IMPORTING DATA...'
     # Import data and parameters
     parametersData, midaDatabases,compoundReports = getFiles(fileLoc)
-    sampleInput, bodyWaterData, rtDiffFilter, totalAbundFilter, mDiffCriteria, silacMasses, rmsErrorFilter, dbScoreFilter, basePkAbundFilter, em0UpperLimit, em0LowerLimit, peptideSDFilter, isotopomerSDFilter, useAllIsotopomers, combinePeptides, instrument, projectLeader, processedBy, submitDate, projectCode, notebookCode, tissueFluid, prep, minMIDAEMx, upperSILAC, lowerSILAC, silacSD, fractionated, minMIDAstring, saturationLevel, correctionSlope, correctionIntercept = loadParameters(parametersData)
     
     # Sort Compound Report files
     compoundReports.sort(key=sortFiles2)
     
-    if os.name == 'nt':
-        crFileSet = [i.split('\\')[-1][0:i.split('\\')[-1].find('Compound')-1]+'.d' for i in compoundReports]
-    elif os.name == 'posix':
-        crFileSet = [i.split('/')[-1][0:i.split('/')[-1].find('Compound')-1]+'.d' for i in compoundReports]
-    newSamples, newCRFiles = getFullSamples2(crFileSet,sampleInput)
-    sampleDict = OrderedDict((x,y) for (x,y) in zip(newCRFiles,newSamples))
-    
-    print 'CONVERTING COMPOUND REPORTS...'
-    # Convert Compound Report Files to sorted and filtered dataframe for subsequent calculations
-    crOutput, crSummaryOutput, crSorted, acquiredDate = convertCompoundReport(compoundReports,sampleDict,mDiffCriteria,totalAbundFilter,fractionated)
+    checkpointKey = getCheckpointKey([parametersData]+midaDatabases+compoundReports, scriptVersion)
+    checkpoints = OrderedDict((stage, loadCheckpoint(getCheckpointFile(fileLoc,stage),checkpointKey) if resume else None) for stage in ['parameters','convert','summary','dataFilter','publish'])
     
-    def checkDate(inDate):
-        dummyDate = inDate.replace('\\','-').replace('/','-')
-        if len(dummyDate[0:dummyDate.find('-')])==1:
-            dummyDate = '0'+dummyDate
-        if len(dummyDate[dummyDate.find('-')+1:][0:dummyDate[dummyDate.find('-')+1:].find('-')])==1:
-            dummyDate = dummyDate[0:dummyDate.find('-')]+'-0'+dummyDate[-6:]
-        return dummyDate                
-    
-    dateInstrument = checkDate(acquiredDate)+instrument
-    
-    # Define output filenames
-    SToutputFileName = [i for i in crOutput.Code if i!=0][0]+'_'+list(set(crOutput.Fraction))[0]+'_'+dateInstrument+'_'+'SummaryTable_'+scriptVersion+'_done'+today.strftime("%m%d%Y")+'.xlsx'
-    DFoutputFileName = [i for i in crOutput.Code if i!=0][0]+'_'+list(set(crOutput.Fraction))[0]+'_'+dateInstrument+'_'+'DataFilter_'+scriptVersion+'_done'+today.strftime("%m%d%Y")+'.xlsx'
-    PDFoutputFileName = [i for i in crOutput.Code if i!=0][0]+'_'+list(set(crOutput.Fraction))[0]+'_'+dateInstrument+'_'+'AnalysisSummary'+'_done'+today.strftime("%m%d%Y")+'.pdf'
-    
-    # END COMPOUND REPORT CONVERTER
-    ######################################################################################################################
-    # BEGIN SUMMARY FILE 
-    print 'GENERATING SUMMARY TABLE...'
-    # Calculate and export Summary Table
-    stSummary, basePeakAbundance, stSummaryV2,newSampleList = generateSummaryFile(sampleInput,midaDatabases,crSorted,bodyWaterData,silacMasses,saturationLevel,correctionSlope, correctionIntercept)
-    stSummary2 = stSummary.groupby(by=['Sample Score','Abund Score','Sample*Abund Score','Species','Code','Protein','Accession#','Sequence','Mass','n','Charge','Fraction'])
-    stSummary3 = stSummary2.agg(np.max).reset_index()
-    stSummary4 = stSummary3.sort(columns=['Protein','Sequence','Charge'])
-    stSummary4.to_excel(SToutputFileName, sheet_name = 'SUMMARY TABLE',index=False)
+    if checkpoints['parameters'] is None:
+        parameters = loadParameters(parametersData)
+        
+        if os.name == 'nt':
+            crFileSet = [i.split('\\')[-1][0:i.split('\\')[-1].find('Compound')-1]+'.d' for i in compoundReports]
+        elif os.name == 'posix':
+            crFileSet = [i.split('/')[-1][0:i.split('/')[-1].find('Compound')-1]+'.d' for i in compoundReports]
+        newSamples, newCRFiles = matchSamplesToFiles(crFileSet,parameters[0])
+        saveCheckpoint(getCheckpointFile(fileLoc,'parameters'), checkpointKey, OrderedDict([('parameters',list(parameters)),('newSamples',newSamples),('newCRFiles',newCRFiles)]))
+    else:
+        print 'RESUMING FROM CHECKPOINT: parameters'
+        parameters, newSamples, newCRFiles = checkpoints['parameters'].values()
     
-    # END SUMMARY FILE
-    #############################################################################################
-    bPA = map(list,zip(*stSummary3[[j for j in stSummary4.columns if j.find("Base Pk Abund")!=-1]].values))
-    sat = map(list,zip(*stSummary3[[j for j in stSummary4.columns if j.find("sat")!=-1]].values))
-    # BEGIN DATA FILTER
-    print 'GENERATING DATA FILTER...'
-    dfPeptides, dfProteins = generateDataFilter(stSummary3, newSampleList, bPA,basePkAbundFilter,em0UpperLimit,em0LowerLimit,isotopomerSDFilter,minMIDAEMx,peptideSDFilter,rmsErrorFilter,useAllIsotopomers,sat)
+    sampleInput, bodyWaterData, rtDiffFilter, totalAbundFilter, mDiffCriteria, silacMasses, rmsErrorFilter, dbScoreFilter, basePkAbundFilter, em0UpperLimit, em0LowerLimit, peptideSDFilter, isotopomerSDFilter, useAllIsotopomers, combinePeptides, instrument, projectLeader, processedBy, submitDate, projectCode, notebookCode, tissueFluid, prep, minMIDAEMx, upperSILAC, lowerSILAC, silacSD, fractionated, minMIDAstring, saturationLevel, correctionSlope, correctionIntercept, mDiffMassBins, midaPredictions = parameters
+    sampleDict = OrderedDict((x,y) for (x,y) in zip(newCRFiles,newSamples))
     
     parameterNames = [
         'Rt Difference Filter',
         'Total Abundance Filter',
         'M Difference Criteria',
+        'M Difference Mass Bins',
+        'MIDA Predictions',
         'SILAC Masses',
         'RMS Error Filter',
         'DB Score Filter',
@@ -1206,6 +2169,8 @@ def main(fileLoc):
         rtDiffFilter,
         totalAbundFilter,
         ', '.join([str(i) for i in mDiffCriteria]),
+        ', '.join([str(i) for i in mDiffMassBins]),
+        midaPredictions,
         silacMasses,
         rmsErrorFilter,
         dbScoreFilter,
@@ -1243,33 +2208,141 @@ def main(fileLoc):
                 
     parameterData = pd.DataFrame({'Parameter':parameterNames,'Value':parameterValues})
     projectData = pd.DataFrame({'Parameter':projectDetailNames,'Value':projectDetailValues})
-    dfProteins = dfProteins.reset_index()
-    dfProteins['Uniprot Link'] = [str('http://www.uniprot.org/uniprot/'+dfProteins['Accession#'][i]) for i in xrange(len(dfProteins))]
-    del dfProteins['index']
     
-    writer2 = pd.ExcelWriter(DFoutputFileName) 
-    dfPeptides.to_excel(writer2,'PEPTIDE OUTPUT',index=False) 
-    dfProteins.to_excel(writer2,'PROTEIN OUTPUT',index=False)
-    parameterData.to_excel(writer2,'PARAMETERS',index=False) 
-    projectData.to_excel(writer2,'PROJECT DETAILS',index=False) 
-    writer2.save()  
+    # Stages of the analysis. Each stage starts as soon as its inputs are ready,
+    # so the Analysis Summary is made while the reports are summarized, the
+    # Summary Table is written while the Data Filter is calculated, and the
+    # files are copied to the network at the same time once every output file
+    # is finished. The stages that save a checkpoint are skipped when their
+    # values come from the checkpoint.
+    pipeline = StageGraph()
+    resumedValues = {}
+    for stage in ['convert','summary','dataFilter','publish']:
+        if checkpoints[stage] is not None:
+            print 'RESUMING FROM CHECKPOINT: '+stage
+            resumedValues.update(checkpoints[stage])
+    
+    def checkDate(inDate):
+        dummyDate = inDate.replace('\\','-').replace('/','-')
+        if len(dummyDate[0:dummyDate.find('-')])==1:
+            dummyDate = '0'+dummyDate
+        if len(dummyDate[dummyDate.find('-')+1:][0:dummyDate[dummyDate.find('-')+1:].find('-')])==1:
+            dummyDate = dummyDate[0:dummyDate.find('-')]+'-0'+dummyDate[-6:]
+        return dummyDate                
+    
+    def convertReports():
+        print 'CONVERTING COMPOUND REPORTS...'
+        # Convert Compound Report Files to sorted and filtered dataframe for subsequent calculations
+        importPool = pool if min(multiprocessing.cpu_count(), len(compoundReports)) > 1 else None
+        crOutput, crSorted, acquiredDate, crSampleHashes = convertCompoundReport(compoundReports,sampleDict,mDiffCriteria,totalAbundFilter,fractionated,mDiffMassBins,pool=importPool)
+        
+        # Code and fraction for the output filenames
+        outputCode = [i for i in crOutput.Code if i!=0][0]
+        textCode = list(set(crOutput.Code))[0]
+        outputFraction = list(set(crOutput.Fraction))[0]
+        
+        values = OrderedDict([('crSorted',crSorted),('crSampleHashes',crSampleHashes),('acquiredDate',acquiredDate),('outputCode',outputCode),('textCode',textCode),('outputFraction',outputFraction)])
+        saveCheckpoint(getCheckpointFile(fileLoc,'convert'), checkpointKey, values)
+        return tuple(values.values())
+    
+    pipeline.add('convert', convertReports, [], ['crSorted','crSampleHashes','acquiredDate','outputCode','textCode','outputFraction'])
+    
+    # Define output filenames
+    def outputFileNames(acquiredDate, outputCode, textCode, outputFraction):
+        dateInstrument = checkDate(acquiredDate)+instrument
+        
+        SToutputFileName = outputCode+'_'+outputFraction+'_'+dateInstrument+'_'+'SummaryTable_'+scriptVersion+'_done'+today.strftime("%m%d%Y")+'.xlsx'
+        DFoutputFileName = outputCode+'_'+outputFraction+'_'+dateInstrument+'_'+'DataFilter_'+scriptVersion+'_done'+today.strftime("%m%d%Y")+'.xlsx'
+        PDFoutputFileName = outputCode+'_'+outputFraction+'_'+dateInstrument+'_'+'AnalysisSummary'+'_done'+today.strftime("%m%d%Y")+'.pdf'
+        textFile = textCode+'_'+outputFraction+'_'+dateInstrument+'_'+'Python'+scriptVersion+'_done'+today.strftime("%m%d%Y")+'.txt'
+        return SToutputFileName, DFoutputFileName, PDFoutputFileName, textFile
+    
+    pipeline.add('outputFileNames', outputFileNames, ['acquiredDate','outputCode','textCode','outputFraction'], ['SToutputFileName','DFoutputFileName','PDFoutputFileName','textFile'])
+    
+    # END COMPOUND REPORT CONVERTER
+    ######################################################################################################################
+    # BEGIN SUMMARY FILE 
+    def summarizeReports(crSorted, crSampleHashes):
+        print 'GENERATING SUMMARY TABLE...'
+        # Calculate and export Summary Table
+        cubeCacheFile = os.path.join(os.path.dirname(os.path.abspath(compoundReports[0])),reportCacheFolder,'IsotopomerCube.npz')
+        stSummary, basePeakAbundance, stSummaryV2,newSampleList = generateSummaryFile(sampleInput,midaDatabases,crSorted,bodyWaterData,silacMasses,saturationLevel,correctionSlope, correctionIntercept, midaPredictions, cubeCacheFile, crSampleHashes)
+        stSummary2 = stSummary.groupby(by=['Sample Score','Abund Score','Sample*Abund Score','Species','Code','Protein','Accession#','Sequence','Mass','n','Charge','Fraction'])
+        stSummary3 = stSummary2.agg(np.max).reset_index()
+        saveCheckpoint(getCheckpointFile(fileLoc,'summary'), checkpointKey, OrderedDict([('stSummary3',stSummary3),('newSampleList',newSampleList)]))
+        return stSummary3, newSampleList
+    
+    pipeline.add('summary', summarizeReports, ['crSorted','crSampleHashes'], ['stSummary3','newSampleList'])
+    pipeline.add('writeSummaryTable', writeSummaryTable, ['stSummary3','SToutputFileName'], ['summaryTableFile'], process=True)
+    
+    # END SUMMARY FILE
+    #############################################################################################
+    # BEGIN DATA FILTER
+    def filterData(stSummary3, newSampleList):
+        bPA = map(list,zip(*stSummary3[[j for j in stSummary3.columns if j.find("Base Pk Abund")!=-1]].values))
+        sat = map(list,zip(*stSummary3[[j for j in stSummary3.columns if j.find("sat")!=-1]].values))
+        print 'GENERATING DATA FILTER...'
+        dfPeptides, dfProteins = generateDataFilter(stSummary3, newSampleList, bPA,basePkAbundFilter,em0UpperLimit,em0LowerLimit,isotopomerSDFilter,minMIDAEMx,peptideSDFilter,rmsErrorFilter,useAllIsotopomers,sat)
+        
+        dfProteins = dfProteins.reset_index()
+        dfProteins['Uniprot Link'] = [str('http://www.uniprot.org/uniprot/'+dfProteins['Accession#'][i]) for i in xrange(len(dfProteins))]
+        del dfProteins['index']
+        saveCheckpoint(getCheckpointFile(fileLoc,'dataFilter'), checkpointKey, OrderedDict([('dfPeptides',dfPeptides),('dfProteins',dfProteins)]))
+        return dfPeptides, dfProteins
+    
+    pipeline.add('dataFilter', filterData, ['stSummary3','newSampleList'], ['dfPeptides','dfProteins'])
+    pipeline.add('writeDataFilter', writeDataFilter, ['DFoutputFileName','dfPeptides','dfProteins','parameterData','projectData','nSamples'], ['dataFilterFile'], process=True)
     #END DATA FILTER
     ################################################################################
-    print 'GENERATING ANALYSIS SUMMARY...'
-    exportParameterPDF(PDFoutputFileName,acquiredDate,instrument,today,sampleInput, bodyWaterData, 
-    rtDiffFilter, totalAbundFilter, mDiffCriteria, silacMasses, rmsErrorFilter, 
-    dbScoreFilter, basePkAbundFilter, em0UpperLimit, em0LowerLimit, 
-    peptideSDFilter, isotopomerSDFilter,midaDatabases, compoundReports,
-    projectLeader, processedBy,notebookCode,projectCode,scriptVersion,minMIDAstring,upperSILAC, 
-    lowerSILAC, silacSD,useAllIsotopomers, combinePeptides,fractionated,minMIDAEMx,saturationLevel,
-    correctionSlope, correctionIntercept)
-
-    print 'FORMATTING OUTPUT...'
-    formatExcel(DFoutputFileName,2,len(dfPeptides),len(dfProteins),len(list(set(sampleInput))),0,1)#fileName,numSheets,nPeptides,nProteins,nSamples
+    def exportAnalysisSummary(PDFoutputFileName, acquiredDate):
+        print 'GENERATING ANALYSIS SUMMARY...'
+        exportParameterPDF(PDFoutputFileName,acquiredDate,instrument,today,sampleInput, bodyWaterData, 
+        rtDiffFilter, totalAbundFilter, mDiffCriteria, silacMasses, rmsErrorFilter, 
+        dbScoreFilter, basePkAbundFilter, em0UpperLimit, em0LowerLimit, 
+        peptideSDFilter, isotopomerSDFilter,midaDatabases, compoundReports,
+        projectLeader, processedBy,notebookCode,projectCode,scriptVersion,minMIDAstring,upperSILAC, 
+        lowerSILAC, silacSD,useAllIsotopomers, combinePeptides,fractionated,minMIDAEMx,saturationLevel,
+        correctionSlope, correctionIntercept)
+        return PDFoutputFileName
+    
+    pipeline.add('analysisSummary', exportAnalysisSummary, ['PDFoutputFileName','acquiredDate'], ['analysisSummaryFile'])
+    
+    # Copy folder/files to both ExtractedResult and LCMS Results folders on the network.
+    # Nothing is copied until all of the output files exist, so a failed run
+    # leaves no folders on the network. A resumed run copies into the folders
+    # of the run it resumes, and skips the files that were copied already.
+    if NetworkDirectory is not None:
+        AnalysisYear = today.strftime("%Y")
+        TextNotes = [os.path.join(dirpath,n) for dirpath, dirs, files in os.walk(fileLoc) for n in files if n.find('NOTE')!=-1 and n.endswith('.txt')]
+        
+        def publishFolders(*outputFiles):
+            print 'COPYING OUTPUT TO NETWORK...'
+            extractedFolder, resultsFolder = makePublishFolders(fileLoc,NetworkDirectory,projectLeader,projectCode,AnalysisYear,notebookCode)
+            saveCheckpoint(getCheckpointFile(fileLoc,'publish'), checkpointKey, OrderedDict([('extractedFolder',extractedFolder),('resultsFolder',resultsFolder)]))
+            return extractedFolder, resultsFolder
+        
+        pipeline.add('publishFolders', publishFolders, ['summaryTableFile','dataFilterFile','analysisSummaryFile'], ['extractedFolder','resultsFolder'])
+        
+        # Copy every file of both folders in one bounded pool
+        def publishResults(extractedFolder, resultsFolder, inputFiles, *outputFiles):
+            return publishFiles(getFolderCopies(resultsFolder, *(list(inputFiles)+list(outputFiles)))+getAnalysisFolderCopies(fileLoc, extractedFolder))
+        
+        pipeline.add('publishResults', publishResults, ['extractedFolder','resultsFolder','inputFiles','summaryTableFile','dataFilterFile','analysisSummaryFile'])
+        resumedValues['inputFiles'] = [midaDatabases[0]]+TextNotes
     
-    textFile = list(set(crOutput.Code))[0]+'_'+list(set(crOutput.Fraction))[0]+'_'+dateInstrument+'_'+'Python'+scriptVersion+'_done'+today.strftime("%m%d%Y")+'.txt'
+    resumedValues.update({'parameterData':parameterData, 'projectData':projectData, 'nSamples':len(list(set(sampleInput)))})
     
-    return textFile, projectLeader, projectCode, processedBy, notebookCode, today.strftime("%Y"), midaDatabases[0], parametersData, DFoutputFileName, SToutputFileName, PDFoutputFileName
+    # The reports are imported, and the process stages run, in one process
+    # pool. It is made here, before the pipeline starts any threads, as forking
+    # a process while other threads are running can deadlock.
+    pool = multiprocessing.Pool(multiprocessing.cpu_count())
+    try:
+        values = pipeline.run(resumedValues, pool=pool)
+    finally:
+        pool.close()
+        pool.join()
+    
+    return values['textFile'], projectLeader, projectCode, processedBy, notebookCode, today.strftime("%Y"), midaDatabases[0], parametersData, values['DFoutputFileName'], values['SToutputFileName'], values['PDFoutputFileName']
 
 # Create and save email message to project leader and research associate
 def CreateEmailMessage(ProjectLeader, ProcessedBy, Subject, FolderLocation1, FolderLocation2, Comments):
@@ -1308,8 +2381,10 @@ if __name__ == "__main__":
     #textOut = main(src)
     #try:
     start = time.time()
-    # Execute script and return all output files and information
-    Result, ProjectLeader, ProjectCode, ProcessedBy, NotebookCode, AnalysisYear, MidaDBFilename, ParametersFilename, DataFilterFilename, SummaryTableFilename, AnalysisSummaryFilename = main(src)
+    # Execute script, copy the output to the network and return all output files and information
+    # Run with --resume to restart from the checkpoints of a failed run
+    NetworkDirectory = 'D:\\AnalyticalCore\\'
+    Result, ProjectLeader, ProjectCode, ProcessedBy, NotebookCode, AnalysisYear, MidaDBFilename, ParametersFilename, DataFilterFilename, SummaryTableFilename, AnalysisSummaryFilename = main(src, NetworkDirectory, '--resume' in sys.argv[1:])
     
     # If successful, update data processing log    
     if os.name == 'nt':
@@ -1317,52 +2392,10 @@ if __name__ == "__main__":
             with open('D:\\ResultsLog\\GOOD--'+Result, "a") as myfile:
                 myfile.write('Script Successful'+'\n')
                 myfile.write(src+'\n')
-        
-    print 'COPYING OUTPUT TO NETWORK...'
-    # Copy folder/files to both ExtractedResult and LCMS Results folders on the network
-    CurrentFolder = src.split('\\')[-1]
-    NetworkDirectory = 'D:\\AnalyticalCore\\'
-    CopyLocation1 = os.path.join(NetworkDirectory,'ExtractedResults',ProjectLeader[0]+ProjectLeader.split(' ')[-1],ProjectCode,AnalysisYear,CurrentFolder)
-    CopyLocation2 = os.path.join(NetworkDirectory,'LCMS Results',ProjectLeader,ProjectCode,AnalysisYear,NotebookCode)
-
-    # Create new folder on network drives
-    # If folder/files already exist, append folder name with Version number
-    if os.path.exists(CopyLocation1) == False:
-        shutil.copytree(src,CopyLocation1)
-    else:
-        FolderList = [i[0] for i in os.walk(os.path.join(NetworkDirectory,'ExtractedResults',ProjectLeader[0]+ProjectLeader.split(' ')[-1],ProjectCode,AnalysisYear)) if i[0].find(CurrentFolder)!=-1]
-        FolderList.sort()
-        if FolderList[-1].find('Version')==-1:
-            CurrentFolder = CurrentFolder+'_Version1'
-        else:
-            CurrentFolder = CurrentFolder+'_Version'+str(int(FolderList[-1].split('_')[-1].split('Version')[-1])+1)
-        CopyLocation1 = os.path.join(NetworkDirectory,'ExtractedResults',ProjectLeader[0]+ProjectLeader.split(' ')[-1],ProjectCode,AnalysisYear,CurrentFolder)
-        shutil.copytree(src,CopyLocation1)
-        
-    TextNotes = [n for n in [i for j in [k[2] for k in os.walk(src)] for i in j] if n.find('NOTE')!=-1 and n.endswith('.txt')]
-
+    
     MidaDBFilename = MidaDBFilename.split('\\')[-1]
     ParametersFilename = ParametersFilename.split('\\')[-1]
     
-    if os.path.exists(CopyLocation2) == False:
-        os.makedirs(CopyLocation2)
-    else:
-        FolderList = [i[0] for i in os.walk(os.path.join(NetworkDirectory,'LCMS Results',ProjectLeader,ProjectCode,AnalysisYear)) if i[0].find(NotebookCode)!=-1]
-        FolderList.sort()
-        if FolderList[-1].find('Version')==-1:
-            CurrentFolder = NotebookCode+'_Version1'
-        else:
-            CurrentFolder = NotebookCode+'_Version'+str(int(FolderList[-1].split('_')[-1].split('Version')[-1])+1)
-        CopyLocation2 = os.path.join(NetworkDirectory,'LCMS Results',ProjectLeader,ProjectCode,AnalysisYear,CurrentFolder)
-        os.makedirs(CopyLocation2)# ,mode=0777)
-
-    shutil.copy(MidaDBFilename,CopyLocation2)
-    shutil.copy(DataFilterFilename,CopyLocation2)
-    shutil.copy(SummaryTableFilename,CopyLocation2)
-    shutil.copy(AnalysisSummaryFilename,CopyLocation2)
-    for i in xrange(len(TextNotes)):
-        shutil.copy(TextNotes[i],CopyLocation2)
-    
     #print 'CREATING COPIES FOR THE ATLAS...'
     # Create copies of all output files in deisgnated folder for the Atlas
 ##        AtlasDirectory = '\\\\kinemed-data\\Scientists\\Documents\\Marc Colangelo\\ADD_TO_ATLAS\\'
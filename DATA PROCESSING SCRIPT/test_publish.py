@@ -0,0 +1,125 @@
+"""
+Checks of copying the analysis results to the network, against a temporary
+folder. Run with 'python test_publish.py' from this folder.
+"""
+import imp
+import os
+import shutil
+import tempfile
+import unittest
+
+scriptFile = os.path.join(os.path.dirname(os.path.abspath(__file__)),'SCRIPT 2','DataProcessingScript_v5.3_Correction_Automated_MHPC KL25.py')
+dps = imp.load_source('DataProcessingScript', scriptFile)
+
+# Write text to a file, making its folder
+def writeFile(fileName, text):
+    if not os.path.isdir(os.path.dirname(fileName)):
+        os.makedirs(os.path.dirname(fileName))
+    with open(fileName, 'w') as f:
+        f.write(text)
+
+# List the files under a folder, relative to the folder
+def listFiles(folder):
+    return sorted(os.path.relpath(os.path.join(dirpath, i), folder) for dirpath, dirs, fileNames in os.walk(folder) for i in fileNames)
+
+class PublishTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.src = os.path.join(self.folder, 'analysis')
+        self.network = os.path.join(self.folder, 'network')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    # Files that match the destination are not copied again
+    def testSkipsUnchangedFiles(self):
+        fileName = os.path.join(self.src, 'SummaryTable.xlsx')
+        destination = os.path.join(self.network, 'NB1', 'SummaryTable.xlsx')
+        writeFile(fileName, 'abc')
+        self.assertEqual(dps.publishFiles([(fileName, destination)]), 1)
+        self.assertEqual(dps.publishFiles([(fileName, destination)]), 0)
+        # Same size, other contents
+        writeFile(fileName, 'abd')
+        self.assertEqual(dps.publishFiles([(fileName, destination)]), 1)
+        self.assertEqual(open(destination).read(), 'abd')
+        self.assertEqual(listFiles(self.network), [os.path.join('NB1', 'SummaryTable.xlsx')])
+
+    # New copies of a folder get the next version number
+    def testVersionedFolder(self):
+        self.assertEqual(dps.getVersionedFolder(self.network, 'NB1'), os.path.join(self.network, 'NB1'))
+        for i in ['NB1', 'NB1_Version9', 'NB1_VersionX', 'NB10']:
+            os.makedirs(os.path.join(self.network, i))
+        self.assertEqual(dps.getVersionedFolder(self.network, 'NB1'), os.path.join(self.network, 'NB1_Version10'))
+        os.makedirs(os.path.join(self.network, 'NB1_Version10'))
+        self.assertEqual(dps.getVersionedFolder(self.network, 'NB1'), os.path.join(self.network, 'NB1_Version11'))
+
+    # The cache and checkpoint folders stay in the analysis folder
+    def testExcludedFolders(self):
+        for i in ['notes.txt', os.path.join('Reports', 'report.xls'), os.path.join(dps.reportCacheFolder, 'report.converted.npz'), os.path.join(dps.checkpointFolder, 'summary.npz')]:
+            writeFile(os.path.join(self.src, i), i)
+        self.assertEqual(dps.publishFiles(dps.getAnalysisFolderCopies(self.src, self.network)), 2)
+        self.assertEqual(listFiles(self.network), sorted(['notes.txt', os.path.join('Reports', 'report.xls')]))
+
+    # A failed copy keeps the old destination and leaves no temporary file
+    def testFailedCopy(self):
+        fileName = os.path.join(self.src, 'SummaryTable.xlsx')
+        destination = os.path.join(self.network, 'SummaryTable.xlsx')
+        writeFile(fileName, 'new')
+        writeFile(destination, 'old')
+
+        def failingCopy(source, target):
+            writeFile(target, 'ne')
+            raise IOError('network dropped')
+        copy2 = dps.shutil.copy2
+        dps.shutil.copy2 = failingCopy
+        try:
+            self.assertRaises(IOError, dps.publishFile, fileName, destination)
+        finally:
+            dps.shutil.copy2 = copy2
+        self.assertEqual(listFiles(self.network), ['SummaryTable.xlsx'])
+        self.assertEqual(open(destination).read(), 'old')
+
+    # The copy replaces an older destination in one step
+    def testReplacesDestination(self):
+        fileName = os.path.join(self.src, 'SummaryTable.xlsx')
+        destination = os.path.join(self.network, 'SummaryTable.xlsx')
+        writeFile(fileName, 'new')
+        writeFile(destination, 'old')
+        self.assertTrue(dps.publishFile(fileName, destination))
+        self.assertEqual(listFiles(self.network), ['SummaryTable.xlsx'])
+        self.assertEqual(open(destination).read(), 'new')
+
+    # A failed replace on Windows keeps the old destination, and never removes
+    # it before the new file is in place
+    def testFailedWindowsReplace(self):
+        fileName = os.path.join(self.src, 'SummaryTable.xlsx')
+        destination = os.path.join(self.network, 'SummaryTable.xlsx')
+        writeFile(fileName, 'new')
+        writeFile(destination, 'old')
+
+        class Kernel32(object):
+            def MoveFileExW(self, source, target, flags):
+                self.call = (source, target, flags)
+                return 0
+        class Windll(object):
+            kernel32 = Kernel32()
+        class Ctypes(object):
+            windll = Windll()
+            @staticmethod
+            def WinError():
+                return OSError('access denied')
+        ctypes, osName = dps.ctypes, os.name
+        dps.ctypes = Ctypes()
+        os.name = 'nt'
+        try:
+            self.assertRaises(OSError, dps.publishFile, fileName, destination)
+        finally:
+            dps.ctypes = ctypes
+            os.name = osName
+        self.assertEqual(Ctypes.windll.kernel32.call[1:], (unicode(destination), 0x1 | 0x8))
+        self.assertEqual(listFiles(self.network), ['SummaryTable.xlsx'])
+        self.assertEqual(open(destination).read(), 'old')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -20,4 +20,4 @@ from mida.default_data import element_data, isotope_data, amino_acid_data, \
 
 from mida.abundance_groups import AbundanceGroup, EnrichedAAGroup
 
-from mida.molecule_objects import Molecule, AminoAcid, Peptide
+from mida.molecule_objects import Molecule, AminoAcid, Peptide, get_distributions
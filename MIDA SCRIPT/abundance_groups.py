@@ -17,6 +17,7 @@ import numpy as np
 import scipy.misc
 
 from mida.utils.numerics import binnings
+from mida.utils import kernels
 
 class AbundanceGroup:
     """
@@ -45,6 +46,9 @@ class AbundanceGroup:
         # multinomial coeffs -- row product of the combinations
         self.mn_coeffs = scipy.misc.comb(coeffs, self.combos).prod(axis=1)
 
+        # mass binnings of the combos, cached by the number of mass bins
+        self._bin_indices = {}
+
     def __repr__(self):
         return "Abundance group: %i atoms of element %i, %i isotopes with masses %s" % (self.num_atoms, self.element_id, self.num_isotopes, self.isotope_mis)
 
@@ -91,13 +95,13 @@ class AbundanceGroup:
         # only go up to the highest mass combo or the cutoff
         num_mass_bins = min(np.max(self.combo_mis), mass_cutoff) + 1
 
-        # make the distribution array and loop over the bins
-        distribution = np.zeros((combo_abs.shape[0], num_mass_bins))
-        for mass in xrange(num_mass_bins):
-            abundances_at_mass = combo_abs[:, self.combo_mis == mass]
-            distribution[:, mass] = abundances_at_mass.sum(axis=1)
+        # sort the combos into mass bins once, then sum each bin
+        if num_mass_bins not in self._bin_indices:
+            self._bin_indices[num_mass_bins] = kernels.mass_bin_index(
+                self.combo_mis, num_mass_bins)
 
-        return distribution
+        return kernels.bin_combo_abundances(combo_abs,
+            self._bin_indices[num_mass_bins], num_mass_bins)
 
 
 class EnrichedAAGroup(AbundanceGroup):
@@ -14,6 +14,8 @@ License:
 import numpy as np
 import scipy
 
+from mida.utils import kernels
+
 def renormalize(molecule, distribution):
     """
     Renormalize the fractional isotopomer distribution to match how the
@@ -33,26 +35,81 @@ def renormalize(molecule, distribution):
     # sum it, and divide the distribution by it.
     return distribution / (distribution[:cut]).sum()
 
-def convert_p_to_abundances(p_values, natural_abundances):
+def renormalize_distributions(molecule, distributions):
+    """
+    Renormalize every row of a (num_enrichments, num_mass_bins) distribution
+    array at once. Same rules as `renormalize`.
+
+    """
+    if molecule.base_mass < 2400:
+        cut = 4
+    else:
+        cut = 5
+
+    return kernels.renormalize_rows(distributions, cut)
+
+def convert_p_to_abundances(p_values, natural_abundances, out=None):
     """
     Takes an array of p values and converts them to isotopic abundance values.
     Note that this only works for elements with only two isotopes. Otherwise,
-    p values are not enough information.
+    p values are not enough information -- use
+    `convert_excess_to_abundances` to say which isotopes are enriched.
 
     """
-    # grab the "p" isotope natural abundance
-    na0 = natural_abundances[0]
-    na1 = natural_abundances[1]
-
     # validations before we continue
     if natural_abundances.shape[0] > 2:
-        raise Exception("p values are ill-defined for elements with more than 2 elements. Please convert to abundances manually.")
+        raise Exception("p values are ill-defined for elements with more than 2 elements. Please convert with convert_excess_to_abundances.")
+
+    return convert_excess_to_abundances(p_values, natural_abundances,
+                                        isotopes=1, out=out)
+
+def convert_excess_to_abundances(excess, natural_abundances, isotopes=None,
+                                 out=None):
+    """
+    Converts excess (over natural) abundances of the heavy isotopes of an
+    element to full isotopic abundance vectors. The excess is taken out of the
+    lightest isotope, so every vector still sums to one.
+
+    `natural_abundances` is the element's entry in
+    `chemical_data.natural_abundances`. `isotopes` says which isotopes the
+    last axis of `excess` belongs to, as indexes into `natural_abundances`.
+    By default it is every heavy isotope. A single int means `excess` has no
+    isotope axis, e.g. `isotopes=2` with an array of excess 18O values.
+
+    Leading axes of `excess` broadcast, so the result is in the shape
+    (..., num_isotopes). For a (num_enrichments, num_isotopes) result, the
+    rows can go straight into `Molecule.get_distribution`. Pass `out` to
+    reuse an array instead of allocating a new one.
+
+    """
+    natural_abundances = np.asarray(natural_abundances, dtype=np.float64)
+    num_isotopes = natural_abundances.shape[0]
+    excess = np.asarray(excess, dtype=np.float64)
+
+    if isotopes is None:
+        isotopes = np.arange(1, num_isotopes)
+    elif np.isscalar(isotopes):
+        isotopes = [isotopes]
+        excess = excess[..., np.newaxis]
+    isotopes = np.asarray(isotopes, dtype=np.intp)
+
+    # validations before we continue
+    if excess.ndim == 0 or excess.shape[-1] != isotopes.shape[0]:
+        raise Exception("Expected excess values for %i isotopes in the last axis, got shape %s." % (isotopes.shape[0], excess.shape))
+    if (isotopes <= 0).any() or (isotopes >= num_isotopes).any():
+        raise Exception("Enriched isotopes must be heavy isotopes of the element (1 to %i), got %s." % (num_isotopes - 1, isotopes))
+
+    shape = excess.shape[:-1] + (num_isotopes,)
+    if out is None:
+        out = np.empty(shape)
+    elif out.shape != shape:
+        raise Exception("The out array has shape %s, expected %s." % (out.shape, shape))
 
-    abundances = np.zeros((len(p_values), len(natural_abundances)))
-    abundances[:, 0] = na0 - p_values
-    abundances[:, 1] = na1 + p_values
+    out[...] = natural_abundances
+    out[..., isotopes] += excess
+    out[..., 0] -= excess.sum(axis=-1)
 
-    if (abundances < 0.0).any() or (abundances > 1.0).any():
+    if (out < 0.0).any() or (out > 1.0).any():
         raise Exception("The supplied p values created bad abundance values! Please make sure that they are positive and small enough.")
 
-    return abundances
+    return out
@@ -17,6 +17,7 @@ DEFAULT_CUTOFF = 15
 import numpy as np
 
 from mida.abundance_groups import AbundanceGroup, EnrichedAAGroup
+from mida.utils import kernels
 from mida.data_types import composition_dtype, labile_dtype, aa_enrichment_dtype
 
 
@@ -105,11 +106,14 @@ class Molecule:
 
     def get_distribution(self, labile_abundances=None,
                          en_aa_abundances=None, en_aa_fraction=None,
-                         mass_cutoff=DEFAULT_CUTOFF):
+                         mass_cutoff=DEFAULT_CUTOFF, group_cache=None):
         """
         Get distribution of all the groups and combine them into the total
         distribution for this molecule.
 
+        `group_cache` is a dict that keeps the group distributions between
+        calls with the same abundances. See `get_distributions`.
+
         """
         # List to store the distribution arrays in. We use a list here because
         # the distributions can be different shapes (much messier to handle for
@@ -123,8 +127,10 @@ class Molecule:
         # (num_enrichments, max_mass).
         for group in self.na_groups:
             # compute the distribution
-            dist = group.get_distribution(natural_abs[group.element_id],
-                                          mass_cutoff=mass_cutoff)
+            dist = _group_distribution(group_cache,
+                ("na", group.element_id, group.num_atoms),
+                lambda: group.get_distribution(natural_abs[group.element_id],
+                                               mass_cutoff=mass_cutoff))
 
             #if dist.shape[0] != num_enrichments:
             #    dist = np.ones((num_enrichments, dist.shape[1])) * dist
@@ -135,20 +141,23 @@ class Molecule:
         if self.active_labile_groups:
             # Note that we rely on the order of the groups and abundances being
             # the same!
-            for group, group_it_abundances in zip(self.labile_groups,
-                                                  labile_abundances):
-                distributions.append(
-                    group.get_distribution(group_it_abundances,
-                                           mass_cutoff=mass_cutoff))
+            for i, (group, group_it_abundances) in enumerate(zip(
+                    self.labile_groups, labile_abundances)):
+                distributions.append(_group_distribution(group_cache,
+                    ("labile", i, group.element_id, group.num_atoms),
+                    lambda: group.get_distribution(group_it_abundances,
+                                                   mass_cutoff=mass_cutoff)))
 
         if self.active_en_aa_groups:
-            for group, group_it_abundances, group_en_fraction \
-            in zip(self.en_aa_groups, en_aa_abundances, en_aa_fraction):
+            for i, (group, group_it_abundances, group_en_fraction) \
+            in enumerate(zip(self.en_aa_groups, en_aa_abundances,
+                             en_aa_fraction)):
                 # compute and append the distribution to aa_dists
-                distributions.append(
-                    group.get_en_aa_distribution(natural_abs[group.element_id],
-                        group_it_abundances, group_en_fraction,
-                        mass_cutoff=mass_cutoff))
+                distributions.append(_group_distribution(group_cache,
+                    ("en_aa", i, group.element_id, group.num_atoms),
+                    lambda: group.get_en_aa_distribution(
+                        natural_abs[group.element_id], group_it_abundances,
+                        group_en_fraction, mass_cutoff=mass_cutoff)))
 
         ###
         # Combine distributions of all groups
@@ -175,21 +184,10 @@ class Molecule:
             # add the length of two distributions, we must get rid of one.
             new_dist_size = min(max_mass_bins, total_dist_size + dist_size - 1)
 
-            num_enrichments = max(dist.shape[0], total_dist.shape[0])
-
-            # Create a fresh array for the combined distribution.
-            new_dist = np.zeros((num_enrichments, new_dist_size))
-
-            for i in xrange(total_dist_size):
-                for j in xrange(dist_size):
-                    mass = i + j
-                    if mass < new_dist_size:
-                        new_dist[:, mass] += total_dist[:, i] * dist[:, j]
-                    else:
-                        break  # `j` will only increase, so go to next `i`
-
-            # save the new abundances
-            total_dist = new_dist
+            # Combine by mass into a fresh array. Masses past `new_dist_size`
+            # are dropped.
+            total_dist = kernels.convolve_distributions(total_dist,
+                dist[:, :dist_size], new_dist_size)
 
         return total_dist
 
@@ -230,6 +228,35 @@ class Molecule:
             self._formula = formula_string
         return self._formula
 
+def _group_distribution(group_cache, key, compute):
+    """
+    Look up the distribution of an abundance group in `group_cache`, or compute
+    it. Without a cache, it is always computed.
+
+    """
+    if group_cache is None:
+        return compute()
+    if key not in group_cache:
+        group_cache[key] = compute()
+    return group_cache[key]
+
+def get_distributions(molecules, labile_abundances=None,
+                      en_aa_abundances=None, en_aa_fraction=None,
+                      mass_cutoff=DEFAULT_CUTOFF):
+    """
+    Get the distributions of many molecules at the same abundances in one
+    call. Molecules share most of their abundance groups (the same number of
+    atoms of an element), so each group distribution is only computed once.
+    Returns the list of what `Molecule.get_distribution` gives for every
+    molecule.
+
+    """
+    group_cache = {}
+    return [molecule.get_distribution(labile_abundances, en_aa_abundances,
+                                      en_aa_fraction, mass_cutoff,
+                                      group_cache)
+            for molecule in molecules]
+
 class Peptide(Molecule):
     """ Representation of a peptide, a sequence of amino acids. """
 
@@ -0,0 +1,214 @@
+"""
+Numerical kernels for the MIDA inner loops.
+
+`convolve_distributions` combines two isotopomer distributions by mass,
+`bin_combo_abundances` sums combo abundances into mass bins, and
+`renormalize_rows` renormalizes a batch of distributions the same way as
+`mida.analysis.renormalize`.
+
+Every kernel has a vectorized numpy version and a loop version that is JIT
+compiled with numba, if numba is installed. The backend is picked at runtime
+with `set_backend`:
+
+  "jit"    - compiled loops (the default when numba is importable)
+  "numpy"  - vectorized numpy (the default otherwise)
+  "parity" - run both and assert that they give identical output
+
+Author: Casey W. Stark <caseywstark@gmail.com>
+Affiliation: UC Berkeley
+Homepage: http://caseywstark.com
+License:
+  Copyright (C) 2011, 2012 Casey W. Stark. All Rights Reserved.
+
+  This file is part of `MIDA`.
+
+"""
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+BACKENDS = ("numpy", "jit", "parity")
+
+if numba is not None:
+    _backend = "jit"
+else:
+    _backend = "numpy"
+
+def set_backend(name):
+    """
+    Select the kernel backend. Asking for "jit" or "parity" without numba
+    installed is an error -- there is nothing to compile or compare against.
+
+    """
+    global _backend
+
+    if name not in BACKENDS:
+        raise Exception("Unknown kernel backend %s. Expected one of %s." % (name, ", ".join(BACKENDS)))
+    if name != "numpy" and numba is None:
+        raise Exception("The %s kernel backend needs numba, which is not installed." % name)
+
+    _backend = name
+
+def get_backend():
+    """ Returns the name of the current kernel backend. """
+    return _backend
+
+###
+# numpy versions
+###
+
+def _convolve_numpy(total_dist, dist, new_dist_size):
+    num_enrichments = max(total_dist.shape[0], dist.shape[0])
+    new_dist = np.zeros((num_enrichments, new_dist_size))
+
+    # Add the whole (shifted) `dist` for each mass bin of `total_dist`. Every
+    # mass bin gets its terms in order of increasing `i`, just like the loops.
+    for i in xrange(min(total_dist.shape[1], new_dist_size)):
+        width = min(dist.shape[1], new_dist_size - i)
+        new_dist[:, i:i+width] += total_dist[:, i:i+1] * dist[:, :width]
+
+    return new_dist
+
+def _bin_numpy(combo_abs, order, bin_starts, bin_counts, num_mass_bins):
+    distribution = np.zeros((combo_abs.shape[0], num_mass_bins))
+    sorted_abs = combo_abs[:, order]
+
+    # Add the k-th combo of every bin that has one, for all bins at once. Each
+    # bin is summed in combo order, just like the loops.
+    for k in xrange(bin_counts.max() if num_mass_bins > 0 else 0):
+        has_k = bin_counts > k
+        distribution[:, has_k] += sorted_abs[:, bin_starts[has_k] + k]
+
+    return distribution
+
+def _renormalize_numpy(distributions, cut):
+    return distributions / distributions[:, :cut].sum(axis=1)[:, np.newaxis]
+
+###
+# JIT versions
+###
+
+if numba is not None:
+    @numba.njit(cache=True)
+    def _convolve_jit(total_dist, dist, new_dist_size):
+        num_total = total_dist.shape[0]
+        num_dist = dist.shape[0]
+        num_enrichments = max(num_total, num_dist)
+        new_dist = np.zeros((num_enrichments, new_dist_size))
+
+        for e in range(num_enrichments):
+            # broadcast single-enrichment distributions
+            et = e if num_total > 1 else 0
+            ed = e if num_dist > 1 else 0
+            for i in range(min(total_dist.shape[1], new_dist_size)):
+                for j in range(min(dist.shape[1], new_dist_size - i)):
+                    new_dist[e, i + j] += total_dist[et, i] * dist[ed, j]
+
+        return new_dist
+
+    @numba.njit(cache=True)
+    def _bin_jit(combo_abs, order, bin_starts, bin_counts, num_mass_bins):
+        distribution = np.zeros((combo_abs.shape[0], num_mass_bins))
+
+        for e in range(combo_abs.shape[0]):
+            for mass in range(num_mass_bins):
+                total = 0.0
+                for k in range(bin_starts[mass], bin_starts[mass] + bin_counts[mass]):
+                    total += combo_abs[e, order[k]]
+                distribution[e, mass] = total
+
+        return distribution
+
+    @numba.njit(cache=True)
+    def _renormalize_jit(distributions, cut):
+        out = np.empty(distributions.shape)
+
+        for e in range(distributions.shape[0]):
+            norm = 0.0
+            for m in range(cut):
+                norm += distributions[e, m]
+            for m in range(distributions.shape[1]):
+                out[e, m] = distributions[e, m] / norm
+
+        return out
+
+def _dispatch(numpy_kernel, jit_name, *args):
+    """
+    Call the kernel for the current backend. In parity mode, run both and
+    make sure they agree exactly.
+
+    """
+    if _backend == "numpy":
+        return numpy_kernel(*args)
+
+    jit_kernel = globals()[jit_name]
+    if _backend == "jit":
+        return jit_kernel(*args)
+
+    expected = numpy_kernel(*args)
+    result = jit_kernel(*args)
+    if expected.shape != result.shape:
+        raise AssertionError("Kernel parity failure in %s: shape %s from numpy, %s from jit." % (jit_name, expected.shape, result.shape))
+    if not np.array_equal(expected, result):
+        raise AssertionError("Kernel parity failure in %s: max abs difference %g." % (jit_name, np.nanmax(np.abs(expected - result))))
+    return result
+
+###
+# Public kernels
+###
+
+def convolve_distributions(total_dist, dist, new_dist_size):
+    """
+    Combine two distributions by mass, keeping `new_dist_size` mass bins.
+
+    Both arrays are in the shape (num_enrichments, num_mass_bins). A
+    distribution with a single enrichment is broadcast against the other.
+
+    """
+    return _dispatch(_convolve_numpy, "_convolve_jit",
+                     np.ascontiguousarray(total_dist, dtype=np.float64),
+                     np.ascontiguousarray(dist, dtype=np.float64),
+                     int(new_dist_size))
+
+def mass_bin_index(combo_mis, num_mass_bins):
+    """
+    Precompute the mass binning of the combos for `bin_combo_abundances`.
+
+    Returns the combo order (stable sort by mass), and the start and number of
+    the sorted combos in every mass bin. Combos above the last bin are left
+    out.
+
+    """
+    order = np.argsort(combo_mis, kind="mergesort")
+    bin_counts = np.bincount(combo_mis[combo_mis < num_mass_bins],
+                             minlength=num_mass_bins)[:num_mass_bins]
+    bin_starts = np.zeros(num_mass_bins, dtype=np.int64)
+    bin_starts[1:] = np.cumsum(bin_counts)[:-1]
+
+    return order.astype(np.int64), bin_starts, bin_counts.astype(np.int64)
+
+def bin_combo_abundances(combo_abs, bin_index, num_mass_bins):
+    """
+    Sum the combo abundances of every mass bin. `bin_index` comes from
+    `mass_bin_index`. Returns an array in the shape
+    (num_enrichments, num_mass_bins).
+
+    """
+    order, bin_starts, bin_counts = bin_index
+    return _dispatch(_bin_numpy, "_bin_jit",
+                     np.ascontiguousarray(combo_abs, dtype=np.float64),
+                     order, bin_starts, bin_counts, int(num_mass_bins))
+
+def renormalize_rows(distributions, cut):
+    """
+    Divide every row of `distributions` by the sum of its first `cut` mass
+    bins. See `mida.analysis.renormalize` for the choice of `cut`.
+
+    """
+    return _dispatch(_renormalize_numpy, "_renormalize_jit",
+                     np.ascontiguousarray(distributions, dtype=np.float64),
+                     int(cut))
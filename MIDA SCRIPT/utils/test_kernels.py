@@ -0,0 +1,62 @@
+"""
+Parity checks of the numba kernels against the numpy kernels, over the
+distributions of a few peptides. Skipped without numba.
+
+Run with 'python -m unittest mida.utils.test_kernels'.
+
+"""
+
+import unittest
+
+import numpy as np
+
+from mida import Peptide, chemical_data
+from mida.analysis import convert_p_to_abundances, renormalize_distributions
+from mida.utils import kernels
+
+SEQUENCES = ["GSVLSR", "LSVDGR", "PEPTIDEK", "MSCDEFKHW", "AAGLLKYWQRDEMNPSTCK"]
+
+def peptide_distributions():
+    """ Renormalized distributions of the test peptides at a few body water
+    enrichments, as the MIDA database is generated. """
+    h_abundances = convert_p_to_abundances(np.array([0.0, 0.01, 0.02, 0.03]),
+                                           chemical_data.natural_abundances[0])
+    distributions = []
+    for sequence in SEQUENCES:
+        peptide = Peptide(sequence, chemical_data)
+        distribution = peptide.get_distribution(labile_abundances=(h_abundances,),
+                                                mass_cutoff=4)
+        distributions.append(renormalize_distributions(peptide, distribution))
+    return distributions
+
+@unittest.skipIf(kernels.numba is None, "numba is not installed")
+class ParityTest(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = kernels.get_backend()
+
+    def tearDown(self):
+        kernels.set_backend(self.backend)
+
+    def test_peptides(self):
+        kernels.set_backend("numpy")
+        expected = peptide_distributions()
+        # raises on any difference between the kernels
+        kernels.set_backend("parity")
+        result = peptide_distributions()
+        for e, r in zip(expected, result):
+            self.assertTrue(np.array_equal(e, r))
+
+    def test_shape_mismatch(self):
+        kernels.set_backend("parity")
+        convolve_jit = kernels._convolve_jit
+        kernels._convolve_jit = lambda *args: np.zeros((3, 1))
+        try:
+            with self.assertRaises(AssertionError) as context:
+                kernels.convolve_distributions(np.ones((2, 3)), np.ones((2, 3)), 4)
+        finally:
+            kernels._convolve_jit = convolve_jit
+        self.assertIn("shape (2, 4) from numpy, (3, 1) from jit", str(context.exception))
+
+if __name__ == "__main__":
+    unittest.main()
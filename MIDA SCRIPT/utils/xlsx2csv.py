@@ -7,8 +7,10 @@ This file is part of `MIDA`.
 """
 
 import csv, datetime, zipfile, sys, os
+import multiprocessing
 import xml.parsers.expat
-from xml.dom import minidom
+from collections import OrderedDict
+from cStringIO import StringIO
 from optparse import OptionParser
 
 # see also ruby-roo lib at: http://github.com/hmcgowan/roo
@@ -82,6 +84,13 @@ STANDARD_FORMATS = {
   49 : '@',
 }
 
+# size of the chunks we decompress and feed to expat when streaming a sheet
+CHUNK_SIZE = 64 * 1024
+
+# day zero of excel serial dates, and the style entry for unformatted cells
+EXCEL_EPOCH = datetime.datetime(1899, 12, 30)
+NO_FORMAT = (None, None)
+
 #
 # usage: xlsx2csv("test.xslx", open("test.csv", "w+"))
 # parameters:
@@ -90,8 +99,9 @@ STANDARD_FORMATS = {
 #   delimiter - csv columns delimiter symbol
 #   sheet_delimiter - sheets delimiter used when processing all sheets
 #   skip_empty_lines - skip empty lines
+#   jobs - number of processes to convert sheets in when processing all sheets
 #
-def xlsx2csv(infilepath, outfile, sheetid=1, dateformat=None, delimiter=",", sheetdelimiter="--------", skip_empty_lines=False):
+def xlsx2csv(infilepath, outfile, sheetid=1, dateformat=None, delimiter=",", sheetdelimiter="--------", skip_empty_lines=False, jobs=1):
     writer = csv.writer(outfile, quoting=csv.QUOTE_MINIMAL, delimiter=delimiter)
     ziphandle = zipfile.ZipFile(infilepath)
     try:
@@ -103,70 +113,188 @@ def xlsx2csv(infilepath, outfile, sheetid=1, dateformat=None, delimiter=",", she
             sheet = None
             for s in workbook.sheets:
                 if s['id'] == sheetid:
-                    sheet = Sheet(shared_strings, styles, ziphandle.read("xl/worksheets/sheet%i.xml" %s['id']))
+                    sheet = Sheet(shared_strings, styles, ziphandle.open("xl/worksheets/sheet%i.xml" %s['id']))
                     break
             if not sheet:
                 raise Exception("Sheet %i Not Found" %sheetid)
             sheet.set_dateformat(dateformat)
             sheet.set_skip_empty_lines(skip_empty_lines)
             sheet.to_csv(writer)
+        elif jobs > 1 and len(workbook.sheets) > 1:
+            # Shared strings and styles are parsed once here and handed to
+            # every worker. The workers return csv text, which imap gives
+            # back in sheet order.
+            pool = multiprocessing.Pool(min(jobs, len(workbook.sheets)),
+                initializer=_init_sheet_worker,
+                initargs=(infilepath, shared_strings.strings, styles))
+            try:
+                tasks = [(s['id'], dateformat, delimiter, skip_empty_lines) for s in workbook.sheets]
+                for s, text in zip(workbook.sheets, pool.imap(_convert_sheet, tasks)):
+                    if sheetdelimiter != "":
+                        outfile.write(sheetdelimiter + " " + str(s['id']) + " - " + s['name'].encode('utf-8') + "\r\n")
+                    outfile.write(text)
+            finally:
+                pool.close()
+                pool.join()
         else:
             for s in workbook.sheets:
                 if sheetdelimiter != "":
                     outfile.write(sheetdelimiter + " " + str(s['id']) + " - " + s['name'].encode('utf-8') + "\r\n")
-                sheet = Sheet(shared_strings, styles, ziphandle.read("xl/worksheets/sheet%i.xml" %s['id']))
+                sheet = Sheet(shared_strings, styles, ziphandle.open("xl/worksheets/sheet%i.xml" %s['id']))
                 sheet.set_dateformat(dateformat)
                 sheet.set_skip_empty_lines(skip_empty_lines)
                 sheet.to_csv(writer)
     finally:
         ziphandle.close()
 
+# per-process state for the sheet workers, set by `_init_sheet_worker`
+_worker_state = {}
+
+def _init_sheet_worker(infilepath, strings, styles):
+    shared_strings = SharedStrings()
+    shared_strings.strings = strings
+    _worker_state['ziphandle'] = zipfile.ZipFile(infilepath)
+    _worker_state['shared_strings'] = shared_strings
+    _worker_state['styles'] = styles
+
+def _convert_sheet(task):
+    sheetid, dateformat, delimiter, skip_empty_lines = task
+    outfile = StringIO()
+    writer = csv.writer(outfile, quoting=csv.QUOTE_MINIMAL, delimiter=delimiter)
+    sheet = Sheet(_worker_state['shared_strings'], _worker_state['styles'],
+                  _worker_state['ziphandle'].open("xl/worksheets/sheet%i.xml" %sheetid))
+    sheet.set_dateformat(dateformat)
+    sheet.set_skip_empty_lines(skip_empty_lines)
+    sheet.to_csv(writer)
+    return outfile.getvalue()
+
+#
+# usage: for row in iter_rows("test.xlsx"): ...
+# Streams the sheet, yielding one tuple per row. Only the current chunk of the
+# sheet xml and the rows parsed from it are held in memory.
+# parameters:
+#   sheetid - sheet no to read
+#   typed - yield floats, dates and booleans instead of csv strings
+#   skip_empty_lines - skip empty lines
+#
+def iter_rows(infilepath, sheetid=1, typed=True, skip_empty_lines=False):
+    ziphandle = zipfile.ZipFile(infilepath)
+    try:
+        shared_strings = parse(ziphandle, SharedStrings, "xl/sharedStrings.xml")
+        styles = parse(ziphandle, Styles, "xl/styles.xml")
+        workbook = parse(ziphandle, Workbook, "xl/workbook.xml")
+
+        sheet = None
+        for s in workbook.sheets:
+            if s['id'] == sheetid:
+                sheet = Sheet(shared_strings, styles, ziphandle.open("xl/worksheets/sheet%i.xml" %s['id']))
+                break
+        if not sheet:
+            raise Exception("Sheet %i Not Found" %sheetid)
+        sheet.set_skip_empty_lines(skip_empty_lines)
+        for row in sheet.rows(typed=typed):
+            yield row
+    finally:
+        ziphandle.close()
+
+#
+# usage: frame = to_dataframe("test.xlsx")
+# Builds a pandas DataFrame straight from the streamed rows, one list per
+# column, without writing csv text in between. The first row is used as the
+# header unless header=False.
+#
+def to_dataframe(infilepath, sheetid=1, header=True, skip_empty_lines=True):
+    import pandas as pd
+
+    columns = []
+    names = None
+    num_rows = 0
+    for row in iter_rows(infilepath, sheetid=sheetid, typed=True, skip_empty_lines=skip_empty_lines):
+        if header and names is None:
+            names = list(row)
+            continue
+        # rows can be ragged, so pad the columns as they show up
+        while len(columns) < len(row):
+            columns.append([None] * num_rows)
+        for i in xrange(len(columns)):
+            columns[i].append(row[i] if i < len(row) else None)
+        num_rows += 1
+
+    if names is None:
+        names = []
+    names = names + [None] * (len(columns) - len(names))
+    names = [name if name not in (None, "") else "Unnamed: %i" % i for i, name in enumerate(names)]
+
+    data = OrderedDict()
+    for name, column in zip(names, columns):
+        data[name] = column
+    return pd.DataFrame(data, columns=names[:len(columns)])
+
 def parse(ziphandle, klass, filename):
     instance = klass()
     if filename in ziphandle.namelist():
-        instance.parse(ziphandle.read(filename))
+        instance.parse(ziphandle.open(filename))
     return instance
 
+def make_parser(handler):
+    parser = xml.parsers.expat.ParserCreate()
+    parser.buffer_text = True
+    parser.StartElementHandler = handler.handleStartElement
+    if hasattr(handler, 'handleCharData'):
+        parser.CharacterDataHandler = handler.handleCharData
+    if hasattr(handler, 'handleEndElement'):
+        parser.EndElementHandler = handler.handleEndElement
+    return parser
+
 class Workbook:
     def __init__(self):
         self.sheets = []
+        self.appName = None
+        self.in_sheets = False
 
     def parse(self, data):
-        workbookDoc = minidom.parseString(data)
-        appName = workbookDoc.firstChild.getElementsByTagName("fileVersion")[0]._attrs['appName'].value
-
-        sheets = workbookDoc.firstChild.getElementsByTagName("sheets")[0]
-        for sheetNode in sheets.childNodes:
-            attrs = sheetNode._attrs
-            name = attrs["name"].value
-            if appName == 'xl':
-                if attrs.has_key('r:id'): id = int(attrs["r:id"].value[3:])
-                else: id = int(attrs['sheetId'].value)
+        make_parser(self).ParseFile(data)
+
+    def handleStartElement(self, name, attrs):
+        if name == 'fileVersion':
+            self.appName = attrs.get('appName')
+        elif name == 'sheets':
+            self.in_sheets = True
+        elif self.in_sheets and name == 'sheet':
+            if self.appName == 'xl':
+                if attrs.has_key('r:id'): id = int(attrs["r:id"][3:])
+                else: id = int(attrs['sheetId'])
             else:
-                if attrs.has_key('sheetId'): id = int(attrs["sheetId"].value)
-                else: id = int(attrs['r:id'].value[3:])
-            self.sheets.append({'name': name, 'id': id})
+                if attrs.has_key('sheetId'): id = int(attrs["sheetId"])
+                else: id = int(attrs['r:id'][3:])
+            self.sheets.append({'name': attrs['name'], 'id': id})
+
+    def handleEndElement(self, name):
+        if name == 'sheets':
+            self.in_sheets = False
 
 class Styles:
     def __init__(self):
         self.numFmts = {}
         self.cellXfs = []
+        self.in_cellXfs = False
 
     def parse(self, data):
-        styles = minidom.parseString(data).firstChild
-        # numFmts
-        numFmtsElement = styles.getElementsByTagName("numFmts")
-        if len(numFmtsElement) == 1:
-            for numFmt in numFmtsElement[0].childNodes:
-                numFmtId = int(numFmt._attrs['numFmtId'].value)
-                formatCode = numFmt._attrs['formatCode'].value.lower().replace('\\', '')
-                self.numFmts[numFmtId] = formatCode
-        # cellXfs
-        cellXfsElement = styles.getElementsByTagName("cellXfs")
-        if len(cellXfsElement) == 1:
-            for cellXfs in cellXfsElement[0].childNodes:
-                numFmtId = int(cellXfs._attrs['numFmtId'].value)
-                self.cellXfs.append(numFmtId)
+        make_parser(self).ParseFile(data)
+
+    def handleStartElement(self, name, attrs):
+        if name == 'numFmt':
+            numFmtId = int(attrs['numFmtId'])
+            formatCode = attrs['formatCode'].lower().replace('\\', '')
+            self.numFmts[numFmtId] = formatCode
+        elif name == 'cellXfs':
+            self.in_cellXfs = True
+        elif self.in_cellXfs and name == 'xf':
+            self.cellXfs.append(int(attrs.get('numFmtId', 0)))
+
+    def handleEndElement(self, name):
+        if name == 'cellXfs':
+            self.in_cellXfs = False
 
 class SharedStrings:
     def __init__(self):
@@ -177,11 +305,8 @@ class SharedStrings:
         self.value = ""
 
     def parse(self, data):
-        self.parser = xml.parsers.expat.ParserCreate()
-        self.parser.CharacterDataHandler = self.handleCharData
-        self.parser.StartElementHandler = self.handleStartElement
-        self.parser.EndElementHandler = self.handleEndElement
-        self.parser.Parse(data)
+        self.parser = make_parser(self)
+        self.parser.ParseFile(data)
 
     def handleCharData(self, data):
         if self.t:
@@ -204,7 +329,6 @@ class SharedStrings:
 class Sheet:
     def __init__(self, sharedString, styles, data):
         self.parser = None
-        self.writer = None
         self.sharedString = None
         self.styles = None
 
@@ -219,11 +343,15 @@ class Sheet:
         self.colType = None
         self.s_attr = None
         self.data = None
+        self.value = ""
 
         self.dateformat = None
         self.skip_empty_lines = False
+        self.typed = False
+        self.finished_rows = []
 
-        self.data = data
+        # either the whole sheet xml, or a file-like object to stream it from
+        self.source = data
         self.sharedStrings = sharedString.strings
         self.styles = styles
 
@@ -234,56 +362,121 @@ class Sheet:
         self.skip_empty_lines = skip
 
     def to_csv(self, writer):
-        self.writer = writer
-        self.parser = xml.parsers.expat.ParserCreate()
-        self.parser.CharacterDataHandler = self.handleCharData
-        self.parser.StartElementHandler = self.handleStartElement
-        self.parser.EndElementHandler = self.handleEndElement
-        self.parser.Parse(self.data)
+        for row in self.rows(typed=False):
+            writer.writerow([value.encode("utf-8") for value in row])
+
+    def rows(self, typed=True):
+        """
+        Generator over the rows of the sheet, as tuples. The sheet xml is fed
+        to expat in chunks, and the rows finished by each chunk are yielded
+        before the next one is read.
+
+        With typed=False the values are the unicode strings written by
+        `to_csv`. Otherwise numbers are floats, dates are datetimes, booleans
+        are bools and empty cells are None.
+        """
+        self.typed = typed
+        self.finished_rows = []
+        self.style_formats = self.build_style_formats()
+        self.parser = make_parser(self)
+
+        if hasattr(self.source, 'read'):
+            while True:
+                chunk = self.source.read(CHUNK_SIZE)
+                self.parser.Parse(chunk, not chunk)
+                for row in self.finished_rows:
+                    yield row
+                del self.finished_rows[:]
+                if not chunk:
+                    break
+        else:
+            self.parser.Parse(self.source, True)
+            for row in self.finished_rows:
+                yield row
+            del self.finished_rows[:]
 
     def handleCharData(self, data):
+        # expat can split the text of one value across calls
         if self.in_cell_value:
-            self.data = data # default value
-            if self.colType == "s": # shared string
-                self.data = self.sharedStrings[int(data)]
-            elif self.colType == "b": # boolean
-                self.data = (int(data) == 1 and "TRUE") or (int(data) == 0 and "FALSE") or data
-            elif self.s_attr:
-                s = int(self.s_attr)
-
-                # get cell format
-                format = None
-                xfs_numfmt = self.styles.cellXfs[s]
-                if self.styles.numFmts.has_key(xfs_numfmt):
-                    format = self.styles.numFmts[xfs_numfmt]
-                elif STANDARD_FORMATS.has_key(xfs_numfmt):
-                    format = STANDARD_FORMATS[xfs_numfmt]
-                # get format type
-                if format and FORMATS.has_key(format):
-                    format_type = FORMATS[format]
-
-                    if format_type == 'date': # date/time
-                        try:
-                            date = datetime.date(1899, 12, 30) + datetime.timedelta(float(data))
-                            if self.dateformat:
-                                # str(dateformat) - python2.5 bug, see: http://bugs.python.org/issue2782
-                                self.data = date.strftime(str(self.dateformat))
-                            else:
-                                dateformat = format.replace("yyyy", "%Y").replace("yy", "%y"). \
-                                  replace("hh:mm", "%h:%M").replace("hh", "%h").replace("ss", "%S"). \
-                                  replace("d", "%e").replace("%e%e", "%d"). \
-                                  replace("mmmm", "%B").replace("mmm", "%b").replace("mm", "%m"). \
-                                  replace("am/pm", "%p")
-                                self.data = date.strftime(str(dateformat)).strip()
-                        except (ValueError, OverflowError):
-                            # invalid date format
-                            self.data = data
-                    elif format_type == 'time': # time
-                        self.data = str(float(data) * 24*60*60)
+            self.value += data
         # does not support it
         #elif self.in_cell_formula:
         #    self.formula = data
 
+    def build_style_formats(self):
+        """
+        Resolve the number format of every cell style once per sheet, keyed by
+        the raw "s" attribute, so the cell handler only does one dict lookup.
+        Each entry is the format type ('date', 'time', ... or None) and, for
+        date formats, a formatter for the csv text.
+        """
+        style_formats = {}
+        for s, xfs_numfmt in enumerate(self.styles.cellXfs):
+            # get cell format
+            format = None
+            if self.styles.numFmts.has_key(xfs_numfmt):
+                format = self.styles.numFmts[xfs_numfmt]
+            elif STANDARD_FORMATS.has_key(xfs_numfmt):
+                format = STANDARD_FORMATS[xfs_numfmt]
+            # get format type
+            format_type = None
+            if format and FORMATS.has_key(format):
+                format_type = FORMATS[format]
+
+            date_formatter = None
+            if format_type == 'date':
+                if self.dateformat:
+                    # str(dateformat) - python2.5 bug, see: http://bugs.python.org/issue2782
+                    pattern = str(self.dateformat)
+                    date_formatter = lambda date, pattern=pattern: date.strftime(pattern)
+                else:
+                    pattern = str(format.replace("yyyy", "%Y").replace("yy", "%y"). \
+                      replace("hh:mm", "%h:%M").replace("hh", "%h").replace("ss", "%S"). \
+                      replace("d", "%e").replace("%e%e", "%d"). \
+                      replace("mmmm", "%B").replace("mmm", "%b").replace("mm", "%m"). \
+                      replace("am/pm", "%p"))
+                    date_formatter = lambda date, pattern=pattern: date.strftime(pattern).strip()
+
+            style_formats[str(s)] = (format_type, date_formatter)
+        return style_formats
+
+    def convertValue(self, data):
+        self.data = data # default value
+        colType = self.colType
+        if colType is None or colType == "n": # number
+            format_type = None
+            if self.s_attr:
+                format_type, date_formatter = self.style_formats.get(self.s_attr, NO_FORMAT)
+
+            if format_type is None or format_type == 'float' or format_type == 'percentage':
+                if self.typed:
+                    try:
+                        self.data = float(data)
+                    except ValueError:
+                        pass
+            elif format_type == 'date': # date/time
+                try:
+                    if self.typed:
+                        self.data = EXCEL_EPOCH + datetime.timedelta(float(data))
+                    else:
+                        self.data = date_formatter(EXCEL_EPOCH.date() + datetime.timedelta(float(data)))
+                except (ValueError, OverflowError):
+                    # invalid date format
+                    self.data = data
+            elif format_type == 'time': # time
+                if self.typed:
+                    self.data = float(data) * 24*60*60
+                else:
+                    self.data = str(float(data) * 24*60*60)
+        elif colType == "s": # shared string
+            self.data = self.sharedStrings[int(data)]
+        elif colType == "b": # boolean
+            if self.typed:
+                self.data = int(data) == 1
+            else:
+                self.data = (int(data) == 1 and "TRUE") or (int(data) == 0 and "FALSE") or data
+        # anything else (formula strings, errors) is kept as text
+
     def handleStartElement(self, name, attrs):
         if self.in_row and name == 'c':
             self.colType = attrs.get("t")
@@ -291,10 +484,11 @@ class Sheet:
             cellId = attrs.get("r")
             self.colNum = cellId[:len(cellId)-len(self.rowNum)]
             #self.formula = None
-            self.data = ""
+            self.data = None if self.typed else ""
             self.in_cell = True
         elif self.in_cell and name == 'v':
             self.in_cell_value = True
+            self.value = ""
         #elif self.in_cell and name == 'f':
         #    self.in_cell_formula = True
         elif self.in_sheet and name == 'row' and attrs.has_key('r'):
@@ -310,6 +504,7 @@ class Sheet:
     def handleEndElement(self, name):
         if self.in_cell and name == 'v':
             self.in_cell_value = False
+            self.convertValue(self.value)
         #elif self.in_cell and name == 'f':
         #    self.in_cell_formula = False
         elif self.in_cell and name == 'c':
@@ -319,21 +514,40 @@ class Sheet:
             self.in_cell = False
         if self.in_row and name == 'row':
             if len(self.columns.keys()) > 0:
-                d = [""] * (max(self.columns.keys()) + 1)
+                empty = None if self.typed else ""
+                d = [empty] * (max(self.columns.keys()) + 1)
                 for k in self.columns.keys():
-                    d[k] = self.columns[k].encode("utf-8")
+                    d[k] = self.columns[k]
                 if self.spans:
                     l = self.spans[0] + self.spans[1] - 1
                     if len(d) < l:
-                        d+= (l - len(d)) * ['']
-                # write line to csv
-                if not self.skip_empty_lines or d.count('') != len(d):
-                    self.writer.writerow(d)
+                        d+= (l - len(d)) * [empty]
+                # hand the row to `rows`
+                if not self.skip_empty_lines or d.count(empty) != len(d):
+                    self.finished_rows.append(tuple(d))
             self.in_row = False
         elif self.in_sheet and name == 'sheetData':
             self.in_sheet = False
 
-def convert_recursive(path, kwargs):
+def convert_recursive(path, kwargs, jobs=1):
+    if jobs > 1:
+        # convert whole files in the pool, one sheet at a time in each
+        fullpaths = find_xlsx(path)
+        pool = multiprocessing.Pool(jobs)
+        try:
+            failures = []
+            for message, failure in pool.imap(_convert_file, [(fullpath, kwargs) for fullpath in fullpaths]):
+                print(message)
+                if failure is not None:
+                    failures.append(failure)
+        finally:
+            pool.close()
+            pool.join()
+        # fail like the serial conversion does, once the other files are done
+        if failures:
+            raise Exception("Conversion failed for %d of %d files: %s" % (len(failures), len(fullpaths), "; ".join(failures)))
+        return
+
     for name in os.listdir(path):
         fullpath = os.path.join(path, name)
         if os.path.isdir(fullpath):
@@ -349,6 +563,40 @@ def convert_recursive(path, kwargs):
                     print("File is not a zip file")
                 f.close()
 
+def find_xlsx(path):
+    """ All .xlsx files under `path`, in the order convert_recursive visits them. """
+    fullpaths = []
+    for name in os.listdir(path):
+        fullpath = os.path.join(path, name)
+        if os.path.isdir(fullpath):
+            fullpaths.extend(find_xlsx(fullpath))
+        elif fullpath.lower().endswith(".xlsx"):
+            fullpaths.append(fullpath)
+    return fullpaths
+
+def _convert_file(task):
+    """ Convert one file in a worker. Returns the message to print and the
+    failure, or None if the file was converted. """
+    fullpath, kwargs = task
+    outfilepath = fullpath[:-4] + 'csv'
+    message = "Converting %s to %s" %(fullpath, outfilepath)
+    failure = None
+    f = open(outfilepath, 'w+')
+    try:
+        xlsx2csv(fullpath, f, **kwargs)
+    except zipfile.BadZipfile:
+        message += "\nFile is not a zip file"
+    except Exception as e:
+        # let the other files finish, and report the failure at the end
+        failure = "%s: %s" % (fullpath, e)
+        message += "\nConversion failed: %s" % e
+    finally:
+        f.close()
+    if failure is not None:
+        # don't leave a partial csv behind
+        os.remove(outfilepath)
+    return message, failure
+
 if __name__ == "__main__":
     parser = OptionParser(usage = "%prog [options] infile [outfile]", version="0.11")
     parser.add_option("-s", "--sheet", dest="sheetid", default=1, type="int",
@@ -363,6 +611,8 @@ if __name__ == "__main__":
       help="skip empty lines")
     parser.add_option("-r", "--recursive", dest="recursive", default=False, action="store_true",
       help="convert recursively")
+    parser.add_option("-j", "--jobs", dest="jobs", default=1, type="int",
+      help="number of processes to convert sheets (with -s 0) or files (with -r) in")
 
     (options, args) = parser.parse_args()
 
@@ -387,7 +637,7 @@ if __name__ == "__main__":
 
     if options.recursive:
         if len(args) == 1:
-            convert_recursive(args[0], kwargs)
+            convert_recursive(args[0], kwargs, jobs=options.jobs)
         else:
             parser.print_help()
     else:
@@ -397,4 +647,4 @@ if __name__ == "__main__":
             if len(args) > 1:
                 outfile = open(args[1], 'w+')
             else: outfile = sys.stdout
-            xlsx2csv(args[0], outfile, **kwargs)
+            xlsx2csv(args[0], outfile, jobs=options.jobs, **kwargs)